@@ -0,0 +1,634 @@
+"""
+Benchmarks for the overhead of tracking and the throughput of saving counts.
+
+Runs streamlit-analytics with fake `streamlit` and `google.cloud.firestore` modules
+(see `tests/fakes.py`), so neither needs to be installed. Each benchmark returns a
+dict of results. All results are written as json, so they can be compared between
+commits:
+
+    python benchmarks/run.py --output before.json
+    git checkout my-branch
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+sys.path.insert(0, str(REPO_DIR))
+
+from tests import fakes  # noqa: E402
+
+fakes.install()
+
+import streamlit as st  # noqa: E402
+
+import streamlit_analytics  # noqa: E402
+from streamlit_analytics import main, storage  # noqa: E402
+from streamlit_analytics.store import CounterStore  # noqa: E402
+from streamlit_analytics.utils import flatten_counts  # noqa: E402
+from streamlit_analytics.widget_index import WidgetIndex  # noqa: E402
+
+OPTIONS = ("option 1", "option 2", "option 3")
+
+# Widgets of examples/all-widgets.py as (label, function to get a random new value).
+# The same widgets are also shown in the sidebar, with label prefix "sidebar_".
+WIDGETS = [
+    ("checkbox", lambda rng: rng.random() < 0.5),
+    ("button", lambda rng: True),
+    ("radio", lambda rng: rng.choice(OPTIONS[:2])),
+    ("selectbox", lambda rng: rng.choice(OPTIONS)),
+    ("multiselect", lambda rng: rng.sample(OPTIONS[:2], rng.randint(0, 2))),
+    ("slider", lambda rng: rng.randint(0, 100)),
+    ("double-ended slider", lambda rng: tuple(sorted(rng.sample(range(101), 2)))),
+    ("select_slider", lambda rng: rng.choice(OPTIONS[:2])),
+    ("text_input", lambda rng: f"text {rng.randrange(1000)}"),
+    ("number_input", lambda rng: rng.uniform(0, 1000)),
+    ("text_area", lambda rng: f"text {rng.randrange(1000)}"),
+    (
+        "date_input",
+        lambda rng: datetime.date(2021, 1, 1) + datetime.timedelta(rng.randrange(365)),
+    ),
+    ("time_input", lambda rng: datetime.time(rng.randrange(24), rng.randrange(60))),
+    ("file_uploader", lambda rng: f"file {rng.randrange(10)}"),
+    ("color_picker", lambda rng: f"#{rng.randrange(16 ** 6):06x}"),
+]
+
+
+def run_app():
+    """The script of examples/all-widgets.py."""
+    for obj, prefix in ((st, ""), (st.sidebar, "sidebar_")):
+        obj.checkbox(prefix + "checkbox")
+        obj.button(prefix + "button")
+        obj.radio(prefix + "radio", OPTIONS[:2])
+        obj.selectbox(prefix + "selectbox", OPTIONS)
+        obj.multiselect(prefix + "multiselect", OPTIONS[:2])
+        obj.slider(prefix + "slider")
+        obj.slider(prefix + "double-ended slider", value=[0, 100])
+        obj.select_slider(prefix + "select_slider", OPTIONS[:2])
+        obj.text_input(prefix + "text_input")
+        obj.number_input(prefix + "number_input")
+        obj.text_area(prefix + "text_area")
+        obj.date_input(prefix + "date_input")
+        obj.time_input(prefix + "time_input")
+        obj.file_uploader(prefix + "file_uploader")
+        obj.color_picker(prefix + "color_picker")
+
+
+def user_input(rng):
+    """Change the value of one random widget, like a user would before a rerun."""
+    label, new_value = rng.choice(WIDGETS)
+    if rng.random() < 0.5:
+        label = "sidebar_" + label
+    fakes.set_value(label, new_value(rng))
+    if label.endswith("button"):
+        return label  # buttons are only True for one rerun
+    return None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def counts_size():
+    """Return the number of counters and the size of all counts as json."""
+    snapshot = main._store.snapshot()
+    return len(flatten_counts(snapshot)), len(json.dumps(snapshot, default=str))
+
+
+def run_sessions(
+    num_sessions,
+    num_reruns,
+    seed,
+    after_rerun=None,
+    session_reruns=None,
+    **track_kwargs,
+):
+    """
+    Run the app in `num_sessions` threads at the same time, `num_reruns` times each.
+    If `session_reruns` is set, each thread starts a new session after that many.
+
+    Each rerun is timed with and without tracking. Returns the wall time and the
+    per-rerun times in seconds, as (wall time, tracked times, untracked times).
+    """
+    tracked = []
+    untracked = []
+    results_lock = threading.Lock()
+    barrier = threading.Barrier(num_sessions + 1)
+
+    def session(i):
+        rng = random.Random(seed * 1000 + i)
+        fakes.clear_session()
+        session_tracked = []
+        session_untracked = []
+        barrier.wait()
+        for rerun in range(num_reruns):
+            if session_reruns is not None and rerun and rerun % session_reruns == 0:
+                fakes.clear_session()
+            button = user_input(rng)
+
+            start = time.perf_counter()
+            run_app()
+            session_untracked.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with streamlit_analytics.track(**track_kwargs):
+                run_app()
+            session_tracked.append(time.perf_counter() - start)
+
+            if button is not None:
+                fakes.set_value(button, False)
+            if after_rerun is not None:
+                after_rerun()
+        with results_lock:
+            tracked.extend(session_tracked)
+            untracked.extend(session_untracked)
+
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(num_sessions)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, tracked, untracked
+
+
+def bench_tracking(args):
+    """Overhead of tracking a rerun, with counts kept in memory only."""
+    main.reset_counts()
+    counters_before, bytes_before = counts_size()
+    wall, tracked, untracked = run_sessions(args.sessions, args.reruns, args.seed)
+    counters_after, bytes_after = counts_size()
+    # Same rerun with and without tracking, so the difference is the overhead.
+    overhead = [t - u for t, u in zip(tracked, untracked)]
+    reruns = len(tracked)
+    return {
+        "reruns": reruns,
+        "reruns_per_second": reruns / wall,
+        "rerun_p50_us": percentile(tracked, 0.5) * 1e6,
+        "rerun_p99_us": percentile(tracked, 0.99) * 1e6,
+        "overhead_p50_us": percentile(overhead, 0.5) * 1e6,
+        "overhead_p99_us": percentile(overhead, 0.99) * 1e6,
+        "counters": counters_after,
+        "counts_json_bytes": bytes_after,
+        "counts_growth_bytes_per_rerun": (bytes_after - bytes_before) / reruns,
+        "total_script_runs_ok": main.counts["total_script_runs"] == reruns,
+    }
+
+
+def bench_json(args):
+    """Saving to a json file at the end of every rerun."""
+    main.reset_counts()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "counts.json"
+        written = []
+        written_lock = threading.Lock()
+
+        def after_rerun():
+            # Every save writes the whole file.
+            size = path.stat().st_size
+            with written_lock:
+                written.append(size)
+
+        wall, tracked, _ = run_sessions(
+            args.sessions,
+            args.reruns,
+            args.seed,
+            after_rerun=after_rerun,
+            load_from_json=path,
+            save_to_json=path,
+        )
+    reruns = len(tracked)
+    return {
+        "reruns_per_second": reruns / wall,
+        "rerun_p50_us": percentile(tracked, 0.5) * 1e6,
+        "rerun_p99_us": percentile(tracked, 0.99) * 1e6,
+        "bytes_written_per_rerun": sum(written) / reruns,
+    }
+
+
+def bench_firestore(args, delta):
+    """Saving to the fake firestore at the end of every rerun."""
+    main.reset_counts()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        key_file = Path(tmp_dir) / "firestore-key.json"
+        key_file.write_text("{}")
+        collection = "delta" if delta else "full"
+        writes_before = dict(fakes.firestore_writes)
+        wall, tracked, _ = run_sessions(
+            args.sessions,
+            args.reruns,
+            args.seed,
+            firestore_key_file=str(key_file),
+            firestore_collection_name=collection,
+            firestore_delta=delta,
+        )
+    reruns = len(tracked)
+    writes = fakes.firestore_writes["count"] - writes_before["count"]
+    written = fakes.firestore_writes["bytes"] - writes_before["bytes"]
+    return {
+        "reruns_per_second": reruns / wall,
+        "rerun_p50_us": percentile(tracked, 0.5) * 1e6,
+        "rerun_p99_us": percentile(tracked, 0.99) * 1e6,
+        "writes_per_rerun": writes / reruns,
+        "bytes_written_per_rerun": written / reruns,
+    }
+
+
+def bench_firestore_async(args):
+    """Saving to a slow fake firestore, from the script thread vs. the event loop."""
+    results = {"latency_ms": args.firestore_latency * 1e3}
+    fakes.firestore_latency = args.firestore_latency
+    try:
+        for mode in ("sync", "async"):
+            main.reset_counts()
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                key_file = Path(tmp_dir) / "firestore-key.json"
+                key_file.write_text("{}")
+                collection = f"slow_{mode}"
+                writes_before = fakes.firestore_writes["count"]
+                wall, tracked, _ = run_sessions(
+                    args.sessions,
+                    args.reruns,
+                    args.seed,
+                    firestore_key_file=str(key_file),
+                    firestore_collection_name=collection,
+                    firestore_delta=True,
+                    firestore_async=mode == "async",
+                )
+                start = time.perf_counter()
+                # Like at exit: Loads what's still on its way and sends the rest.
+                storage.close_all()
+                drain = time.perf_counter() - start
+            reruns = len(tracked)
+            saved = fakes.firestore_docs[(collection, "counts")]
+            results[mode] = {
+                "reruns_per_second": reruns / wall,
+                "rerun_p50_us": percentile(tracked, 0.5) * 1e6,
+                "rerun_p99_us": percentile(tracked, 0.99) * 1e6,
+                "writes_per_rerun": (fakes.firestore_writes["count"] - writes_before)
+                / reruns,
+                "drain_ms": drain * 1e3,
+                "saved_script_runs_ok": saved["total_script_runs"] == reruns,
+            }
+    finally:
+        fakes.firestore_latency = 0.0
+    return results
+
+
+def bench_sampling(args):
+    """Overhead of tracking and accuracy of the estimates when sampling sessions."""
+    results = {}
+    for rate in (1, 0.5, 0.1):
+        main.reset_counts()
+        # One thread, as the mean overhead would mostly be time spent waiting for
+        # other threads otherwise. Short sessions, so enough of them are sampled at
+        # low rates.
+        wall, tracked, untracked = run_sessions(
+            1,
+            args.sessions * args.reruns,
+            args.seed,
+            session_reruns=10,
+            sample_rate=rate,
+        )
+        overhead = sum(t - u for t, u in zip(tracked, untracked)) / len(tracked)
+        estimate = main.counts["total_script_runs"] / rate
+        results[f"overhead_mean_us_at_{rate:g}"] = overhead * 1e6
+        error = abs(estimate - len(tracked)) / len(tracked)
+        results[f"script_runs_error_at_{rate:g}"] = error
+    for rate in (0.5, 0.1):
+        results[f"overhead_vs_full_at_{rate:g}"] = (
+            results[f"overhead_mean_us_at_{rate:g}"] / results["overhead_mean_us_at_1"]
+        )
+    return results
+
+
+def bench_store_contention(args):
+    """Increments from many threads at once, on the store and on a plain dict."""
+    num_threads = max(args.sessions, 2)
+    increments = 20000
+    paths = [("widgets", f"label {i}", "option") for i in range(8)]
+
+    def run(incr, data):
+        def worker(i):
+            for j in range(increments):
+                incr(paths[(i + j) % len(paths)])
+
+        threads = [
+            threading.Thread(target=worker, args=(i,)) for i in range(num_threads)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - start
+        lost = num_threads * increments - sum(
+            data["widgets"][path[1]][path[2]] for path in paths
+        )
+        return num_threads * increments / wall, lost
+
+    def dict_incr(path):
+        # What the counts dict did before there was a store: unsynchronized.
+        widget = data["widgets"].setdefault(path[1], {})
+        widget[path[2]] = widget.get(path[2], 0) + 1
+
+    data = {"widgets": {}}
+    dict_ops, dict_lost = run(dict_incr, data)
+    store = CounterStore({"widgets": {}})
+    store_ops, store_lost = run(store.incr, store.data)
+    return {
+        "threads": num_threads,
+        "store_increments_per_second": store_ops,
+        "store_lost_increments": store_lost,
+        "dict_increments_per_second": dict_ops,
+        "dict_lost_increments": dict_lost,
+    }
+
+
+def deep_size(obj, seen=None):
+    """Return the memory used by `obj` and everything it references, in bytes."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(vars(obj), seen)
+    for cls in type(obj).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if hasattr(obj, name):
+                size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def bench_session_state(args):
+    """Memory of the session state of one session, with large text inputs."""
+    main.reset_counts()
+    fakes.clear_session()
+    rng = random.Random(args.seed)
+    options = [f"option {i}" for i in range(100)]
+    for i in range(args.reruns):
+        # 100 kB of text in each text area, and lots of selected options.
+        for label in ("text_area", "sidebar_text_area"):
+            fakes.set_value(label, f"{i} " + "x" * 100000)
+        fakes.set_value("big multiselect", rng.sample(options, 50))
+        with streamlit_analytics.track(max_values_per_widget=10):
+            run_app()
+            st.multiselect("big multiselect", options)
+    return {"session_state_bytes": deep_size(fakes.session_state())}
+
+
+def bench_select_options(args):
+    """Reruns with a selectbox and a multiselect with 10k options each."""
+    main.reset_counts()
+    fakes.clear_session()
+    options = [f"option {i}" for i in range(10000)]
+    rng = random.Random(args.seed)
+    times = {"tracked": [], "untracked": []}
+    for _ in range(args.reruns):
+        fakes.set_value("big selectbox", rng.choice(options))
+        fakes.set_value("big multiselect", rng.sample(options, 3))
+        for mode in ("untracked", "tracked"):
+            # Apps usually build their options anew on every rerun.
+            rerun_options = list(options)
+            start = time.perf_counter()
+            if mode == "tracked":
+                streamlit_analytics.start_tracking()
+            st.selectbox("big selectbox", rerun_options)
+            st.multiselect("big multiselect", rerun_options)
+            if mode == "tracked":
+                streamlit_analytics.stop_tracking()
+            times[mode].append(time.perf_counter() - start)
+    overhead = [t - u for t, u in zip(times["tracked"], times["untracked"])]
+    return {
+        "options": len(options),
+        "first_rerun_us": times["tracked"][0] * 1e6,
+        "rerun_p50_us": percentile(times["tracked"], 0.5) * 1e6,
+        "overhead_p50_us": percentile(overhead, 0.5) * 1e6,
+    }
+
+
+def bench_widget_memory(args):
+    """Memory and time to count 100k (label, option) pairs in the store and index it."""
+    rng = random.Random(args.seed)
+    paths = [
+        ("widgets", f"label {i}", f"option {j}")
+        for i in range(1000)
+        for j in range(100)
+    ]
+    counts = [rng.randrange(1, 10000) for _ in paths]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        store = CounterStore({"widgets": {}})
+        start = time.perf_counter()
+        for path, n in zip(paths, counts):
+            store.incr(path, n)
+        for path in paths:
+            store.incr(path)
+        incr = time.perf_counter() - start
+        store.indexed_widgets()
+        memory, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "pairs": len(paths),
+        "incr_us": incr / (2 * len(paths)) * 1e6,
+        "memory_mb": memory / 1e6,
+    }
+
+
+def bench_widget_index(args):
+    """Top 100 rows of 100k (label, option) pairs, from the index vs. sorting."""
+    rng = random.Random(args.seed)
+    widgets = {
+        f"label {i}": {f"option {j}": rng.randrange(10000) for j in range(100)}
+        for i in range(1000)
+    }
+    start = time.perf_counter()
+    index = WidgetIndex()
+    index.build(widgets)
+    build = time.perf_counter() - start
+
+    def best_of(func, repeat=5):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def walk_and_sort():
+        rows = [
+            (label, option, count)
+            for label, options in widgets.items()
+            for option, count in options.items()
+        ]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:100]
+
+    return {
+        "pairs": len(index),
+        "build_ms": build * 1e3,
+        "top100_index_ms": best_of(lambda: index.top(100)) * 1e3,
+        "top100_search_ms": best_of(lambda: index.top(100, search="option 1")) * 1e3,
+        "top100_walk_and_sort_ms": best_of(walk_and_sort) * 1e3,
+    }
+
+
+# Modules that should only be imported when the features that need them are used.
+HEAVY_MODULES = ("pandas", "altair", "google.cloud.firestore", "sqlite3")
+
+
+def bench_import_time(args):
+    """Time to import streamlit_analytics, with only (fake) streamlit installed."""
+    code = (
+        "import sys; from tests import fakes; fakes.install(firestore=False); "
+        "import streamlit_analytics; "
+        f"print([m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    )
+    env = dict(os.environ, PYTHONPATH=str(REPO_DIR))
+    cumulative = []
+    heavy = None
+    for _ in range(5):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        heavy = result.stdout.strip()
+        # Lines look like "import time:  self [us] | cumulative | imported package".
+        for line in result.stderr.splitlines():
+            match = re.match(
+                r"import time:\s*\d+ \|\s*(\d+) \| streamlit_analytics$", line
+            )
+            if match:
+                cumulative.append(int(match.group(1)))
+    return {
+        "import_ms": min(cumulative) / 1e3 if cumulative else None,
+        "heavy_modules_imported": heavy,
+    }
+
+
+BENCHMARKS = {
+    "tracking": bench_tracking,
+    "json": bench_json,
+    "firestore_full": lambda args: bench_firestore(args, delta=False),
+    "firestore_delta": lambda args: bench_firestore(args, delta=True),
+    "firestore_async": bench_firestore_async,
+    "sampling": bench_sampling,
+    "session_state": bench_session_state,
+    "store_contention": bench_store_contention,
+    "select_options": bench_select_options,
+    "widget_index": bench_widget_index,
+    "widget_memory": bench_widget_memory,
+    "import_time": bench_import_time,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=str(REPO_DIR),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print the change of every number in `new` compared to `old`."""
+    print(f"Comparing {old.get('commit')} (old) with {new.get('commit')} (new):")
+    if old.get("params") != new["params"]:
+        print(f"  Warning: different params, {old.get('params')} vs. {new['params']}")
+    for name, results in new["results"].items():
+        old_results = old["results"].get(name, {})
+        for key, value in results.items():
+            old_value = old_results.get(key)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if not isinstance(old_value, (int, float)) or not old_value:
+                print(f"  {name}.{key}: {value:.6g} (new)")
+                continue
+            change = (value - old_value) / old_value * 100
+            print(f"  {name}.{key}: {old_value:.6g} -> {value:.6g} ({change:+.1f}%)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent sessions")
+    parser.add_argument("--reruns", type=int, default=200, help="reruns per session")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--firestore-latency",
+        type=float,
+        default=0.02,
+        help="seconds per call to the fake firestore in the firestore_async benchmark",
+    )
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run"
+    )
+    parser.add_argument("--output", help="json file to write the results to")
+    parser.add_argument("--compare", help="json file of an earlier run to compare to")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = BENCHMARKS[name](args)
+    output = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {
+            "sessions": args.sessions,
+            "reruns": args.reruns,
+            "seed": args.seed,
+            "firestore_latency": args.firestore_latency,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main_cli()
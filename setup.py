@@ -30,8 +30,8 @@ setup(
         "streamlit >= 0.84.0",
         "pandas",
         "altair",
-        "google-cloud-firestore",
     ],
+    extras_require={"firestore": ["google-cloud-firestore"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.6",
@@ -1,3 +1,4 @@
-__version__ = "0.4.1"
+__version__ = "0.5.0"
 
-from .main import counts, start_tracking, stop_tracking, track
+from .main import counts, get_counts, start_tracking, stop_tracking, track
+from .stats import get_stats
@@ -0,0 +1,283 @@
+"""
+Loads and saves count data from/to firestore with firestore's AsyncClient, so script
+runs don't wait for firestore.
+
+All firestore calls run on one event loop in a background thread. Script runs put
+their writes into a queue and return right away. The loop keeps at most one write per
+document in flight and combines the writes that arrive in the meantime into the next
+one: Increments are summed up and a full overwrite replaces everything before it.
+Writes to different documents run concurrently. Unique visitor sketches in delta
+writes are merged with the ones in the document right before sending them (see
+`firestore.merge_visitors`). Each write times out after `timeout` seconds and is
+retried up to `retries` times, waiting `backoff` seconds before the first retry and
+twice as long before each further one. If it still fails, it's kept and sent together
+with the next write.
+
+AsyncClient connects to the firestore emulator if FIRESTORE_EMULATOR_HOST is set,
+e.g. to test all of this locally.
+"""
+
+import asyncio
+import random
+import threading
+import time
+import traceback
+
+from . import firestore
+
+# Longest time to wait between two retries, in seconds.
+MAX_BACKOFF = 60
+
+
+def _merge_increments(data, other):
+    """Return the data of a merged write of `data` and then `other`."""
+    Increment = firestore.import_firestore().Increment
+    merged = dict(data)
+    for key, value in other.items():
+        old = merged.get(key)
+        if isinstance(value, dict) and isinstance(old, dict):
+            merged[key] = _merge_increments(old, value)
+        elif isinstance(value, Increment) and isinstance(old, Increment):
+            merged[key] = Increment(old.value + value.value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _combine(pending, write):
+    """Add `write` (as (data, merge)) to the `pending` writes of a document."""
+    if not write[1]:
+        # Overwrites everything, so earlier writes don't matter anymore.
+        pending[:] = [write]
+    elif pending and pending[-1][1]:
+        pending[-1] = (_merge_increments(pending[-1][0], write[0]), True)
+    else:
+        pending.append(write)
+
+
+def _put_back(pending, write):
+    """Put a `write` that failed back in front of the `pending` writes."""
+    if pending and not pending[0][1]:
+        return  # a later overwrite replaces it anyway
+    if write[1] and pending:
+        pending[0] = (_merge_increments(write[0], pending[0][0]), True)
+    else:
+        pending.insert(0, write)
+
+
+class _Document:
+    """Writes to one counts document that are waiting to be sent."""
+
+    def __init__(self, key_file, collection_name):
+        self.key_file = key_file
+        self.collection_name = collection_name
+        self.settings = None  # (timeout, retries, backoff) of the last write
+        self.pending = []  # [(data, merge)]
+        self.task = None  # sends `pending`, while there is anything to send
+        self.ref = None  # (key file version, AsyncDocumentReference)
+
+
+class AsyncWriter:
+    """Runs an event loop in a daemon thread, which sends all writes to firestore."""
+
+    def __init__(self):
+        self.closed = False
+        self._loop = asyncio.new_event_loop()
+        self._queue = None
+        self._docs = {}  # only used from the loop thread
+        ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(ready,),
+            name="streamlit-analytics-firestore",
+            daemon=True,
+        )
+        self._thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        dispatcher = self._loop.create_task(self._dispatch())
+        ready.set()
+        self._loop.run_forever()
+
+        # Stopped by `close`, cancel whatever is still running.
+        tasks = [dispatcher] + [
+            doc.task for doc in self._docs.values() if doc.task is not None
+        ]
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+
+    def submit(self, key, key_file, collection_name, write, settings):
+        """
+        Queue `write` (as (data, merge)) to the document at `key`, from any thread.
+
+        `settings` are (timeout, retries, backoff), see the module docstring.
+        """
+        item = (key, key_file, collection_name, write, settings)
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def fetch(self, key_file, collection_name, timeout):
+        """
+        Start getting the data of the counts document (None if missing), from any
+        thread. Returns a `concurrent.futures.Future` of it.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self._get(key_file, collection_name, timeout), self._loop
+        )
+
+    def _document(self, key, key_file, collection_name):
+        doc = self._docs.get(key)
+        if doc is None:
+            doc = self._docs[key] = _Document(key_file, collection_name)
+        return doc
+
+    def _ref(self, doc):
+        # Create a new client if the key file is new or was changed.
+        version = firestore.key_file_version(doc.key_file)
+        if doc.ref is None or doc.ref[0] != version:
+            start = time.perf_counter()
+            client = firestore.import_firestore().AsyncClient.from_service_account_json(
+                doc.key_file
+            )
+            ref = client.collection(doc.collection_name).document("counts")
+            firestore.add_stats(
+                clients_created=1, client_creation_seconds=time.perf_counter() - start
+            )
+            doc.ref = (version, ref)
+        return doc.ref[1]
+
+    async def _get(self, key_file, collection_name, timeout):
+        key = firestore.doc_key(key_file, collection_name)
+        ref = self._ref(self._document(key, key_file, collection_name))
+        snapshot = await asyncio.wait_for(ref.get(), timeout)
+        return snapshot.to_dict()
+
+    async def _dispatch(self):
+        while True:
+            key, key_file, collection_name, write, settings = await self._queue.get()
+            doc = self._document(key, key_file, collection_name)
+            doc.settings = settings
+            _combine(doc.pending, write)
+            self._start_sending(doc)
+            self._queue.task_done()
+
+    def _start_sending(self, doc):
+        if doc.pending and (doc.task is None or doc.task.done()):
+            doc.task = self._loop.create_task(self._send(doc))
+
+    async def _send(self, doc):
+        while doc.pending:
+            write = doc.pending.pop(0)
+            try:
+                await self._write(doc, write)
+            except Exception:
+                # Firestore is slow or down. Try again with the next write.
+                traceback.print_exc()
+                _put_back(doc.pending, write)
+                firestore.add_stats(failed_saves=1)
+                return
+
+    async def _write(self, doc, write):
+        timeout, retries, backoff = doc.settings
+        for attempt in range(retries + 1):
+            try:
+                start = time.perf_counter()
+                ref = self._ref(doc)
+                data, merge = write
+                if merge and "unique_visitors" in data:
+                    snapshot = await asyncio.wait_for(
+                        ref.get(field_paths=["unique_visitors"]), timeout
+                    )
+                    data = firestore.merge_visitors(data, snapshot.to_dict())
+                await asyncio.wait_for(ref.set(data, merge=merge), timeout)
+            except Exception:
+                if attempt == retries:
+                    raise
+                firestore.add_stats(retries=1)
+                # Random factor, so replicas of an app don't all retry at once.
+                delay = min(MAX_BACKOFF, backoff * 2**attempt)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            else:
+                firestore.record_save(time.perf_counter() - start)
+                return
+
+    async def _drain(self):
+        await self._queue.join()
+        # Wait for the writes in flight, then try once more to send those that failed.
+        for retry_failed in (False, True):
+            if retry_failed:
+                for doc in self._docs.values():
+                    self._start_sending(doc)
+            tasks = [doc.task for doc in self._docs.values() if doc.task is not None]
+            if tasks:
+                await asyncio.wait(tasks)
+
+    def close(self, timeout=None):
+        """Wait up to `timeout` seconds for all writes to be sent, then stop."""
+        if self.closed:
+            return
+        self.closed = True
+        future = asyncio.run_coroutine_threadsafe(self._drain(), self._loop)
+        try:
+            future.result(timeout)
+        except Exception:
+            print("Couldn't save all counts to firestore before closing:")
+            traceback.print_exc()
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+
+
+# The writer that is currently running. Like `counts`, this is shared across all users
+# of the streamlit app.
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.closed:
+            _writer = AsyncWriter()
+        return _writer
+
+
+def fetch(service_account_json, collection_name, timeout=10):
+    """
+    Start getting the data of the counts document (None if missing), and return right
+    away with a `concurrent.futures.Future` of it.
+
+    The future gets an asyncio.TimeoutError if firestore doesn't answer within
+    `timeout` seconds.
+    """
+    return _get_writer().fetch(service_account_json, collection_name, timeout)
+
+
+def send(
+    write,
+    service_account_json,
+    collection_name,
+    timeout=10,
+    retries=5,
+    backoff=0.5,
+):
+    """
+    Queue `write` (as (data, merge), see `firestore.delta_write`) to be sent to the
+    counts document, and return right away.
+    """
+    key = firestore.doc_key(service_account_json, collection_name)
+    _get_writer().submit(
+        key, service_account_json, collection_name, write, (timeout, retries, backoff)
+    )
+
+
+def close(timeout=None):
+    """Send all queued writes, waiting up to `timeout` seconds, and stop the loop."""
+    with _writer_lock:
+        writer = _writer
+    if writer is not None:
+        writer.close(timeout)
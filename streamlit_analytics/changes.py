@@ -0,0 +1,82 @@
+"""
+Detects which widget values changed between script runs of a session.
+
+Only a fixed-size hash of each value is kept in the session state, not the value
+itself. This keeps the memory per session small, even for apps with large text areas
+and lots of concurrent sessions.
+"""
+
+import hashlib
+
+# Size of the hashes in bytes. With 8 bytes, two different values of a widget get the
+# same hash (and the change isn't counted) with a chance of 1 in 2^64.
+DIGEST_SIZE = 8
+
+
+def digest(value):
+    """Return a fixed-size hash of `value`, which stays the same across script runs."""
+    # The type is part of the hash, so e.g. 1 and "1" differ. Python's own `hash` can't
+    # be used, as it maps some values to the same number, e.g. -1 and -2.
+    data = f"{type(value).__name__}:{value!r}".encode("utf-8", "surrogatepass")
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+class _Entry:
+    """Hash of the last value of a widget, and of its selected options (multiselect)."""
+
+    __slots__ = ("value", "options")
+
+    def __init__(self, value, options=None):
+        self.value = value
+        self.options = options
+
+
+class ChangeTracker:
+    """Hashes of the last value of each widget in a session, by label."""
+
+    __slots__ = ("_entries",)
+
+    def __init__(self):
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, label):
+        return label in self._entries
+
+    def update(self, label, value):
+        """Remember `value` for widget `label`. Returns True if it changed."""
+        value_digest = digest(value)
+        entry = self._entries.get(label)
+        if entry is None:
+            self._entries[label] = _Entry(value_digest)
+            return True
+        if entry.value == value_digest:
+            return False
+        entry.value = value_digest
+        entry.options = None
+        return True
+
+    def update_options(self, label, selected):
+        """
+        Remember the `selected` options of widget `label`.
+
+        Returns the options that weren't selected before, in the order of `selected`.
+        """
+        digests = [digest(option) for option in selected]
+        entry = self._entries.get(label)
+        previous = () if entry is None or entry.options is None else entry.options
+        new_options = []
+        seen = set()
+        for option, option_digest in zip(selected, digests):
+            if option_digest not in previous and option_digest not in seen:
+                new_options.append(option)
+            seen.add(option_digest)
+        options = frozenset(digests)
+        if entry is None:
+            self._entries[label] = _Entry(None, options)
+        else:
+            entry.value = None
+            entry.options = options
+        return new_options
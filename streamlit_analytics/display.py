@@ -2,15 +2,292 @@
 Displays the analytics results within streamlit.
 """
 
-import altair as alt
-import pandas as pd
+import datetime
+import math
+
 import streamlit as st
 
-from . import utils
+from . import stats, utils
+from .hyperloglog import UniqueVisitors
+from .timeseries import TimeBuckets, nest_bucket, range_counts
+from .widget_index import WidgetIndex
+
+# How many rows the widget table can show.
+TOP_ROWS_CHOICES = [100, 1000, 10000]
+
+# Chart, widget index, hourly counts and unique visitors that were shown last, with
+# the versions of the keys in `counts` they were computed from, see `_prepare`.
+_prepared = {"versions": {}}
+
+
+def _estimate(n, sample_rate):
+    """
+    Return the estimated total of a count `n` from sampled sessions and its margin of
+    error (95% confidence).
+
+    The margin assumes that events are sampled independently. As all events of a
+    session are sampled together, it's too small for counts from only a few sessions.
+    """
+    if sample_rate >= 1:
+        return n, 0
+    return n / sample_rate, 1.96 * math.sqrt(n * (1 - sample_rate)) / sample_rate
+
+
+def _format_count(n, sample_rate):
+    """Format a count, as estimate with margin of error if sessions are sampled."""
+    if sample_rate >= 1:
+        return n
+    estimate, margin = _estimate(n, sample_rate)
+    return f"{estimate:,.0f} ± {margin:,.0f}"
+
+
+def _make_chart(per_day, sample_rate=1):
+    """Return an altair chart with pageviews and script runs per day."""
+    # Imported here, as they take a while and are only needed for the dashboard.
+    import altair as alt
+    import pandas as pd
+
+    try:
+        alt.themes.enable("streamlit")
+    except:
+        pass  # probably old Streamlit version
+    df = pd.DataFrame(per_day)
+    if sample_rate < 1:
+        df[["pageviews", "script_runs"]] /= sample_rate
+    base = alt.Chart(df).encode(
+        x=alt.X("monthdate(days):O", axis=alt.Axis(title="", grid=True))
+    )
+    line1 = base.mark_line(point=True, stroke="#5276A7").encode(
+        alt.Y(
+            "pageviews:Q",
+            axis=alt.Axis(
+                titleColor="#5276A7",
+                tickColor="#5276A7",
+                labelColor="#5276A7",
+                format=".0f",
+                tickMinStep=1,
+            ),
+            scale=alt.Scale(domain=(0, df["pageviews"].max() + 1)),
+        )
+    )
+    line2 = base.mark_line(point=True, stroke="#57A44C").encode(
+        alt.Y(
+            "script_runs:Q",
+            axis=alt.Axis(
+                title="script runs",
+                titleColor="#57A44C",
+                tickColor="#57A44C",
+                labelColor="#57A44C",
+                format=".0f",
+                tickMinStep=1,
+            ),
+        )
+    )
+    layer = (
+        alt.layer(line1, line2)
+        .resolve_scale(y="independent")
+        .configure_axis(titleFontSize=15, labelFontSize=12, titlePadding=10)
+    )
+    return layer
+
+
+def _show_rolled_up(rolled_up, sample_rate=1):
+    """
+    Show pageviews and script runs of the days that were dropped from "per_day" and
+    summed up per week or month (see `per_day_retention`), as table.
+    """
+    import pandas as pd
+
+    df = pd.DataFrame(
+        {
+            "period": rolled_up["periods"],
+            "pageviews": [
+                _format_count(n, sample_rate) for n in rolled_up["pageviews"]
+            ],
+            "script runs": [
+                _format_count(n, sample_rate) for n in rolled_up["script_runs"]
+            ],
+        }
+    )
+    with st.expander("Older days, summed up per period"):
+        st.dataframe(df)
+
+
+def _count_visitors(visitors, today):
+    """Return the estimated unique visitors of all time, `today` and the last 7 days."""
+    visitors = UniqueVisitors.load(visitors)
+    return (
+        visitors.count(),
+        visitors.count([today]),
+        visitors.count(range(today - 6, today + 1)),
+    )
+
+
+def _prepare(counts, versions, widget_index=None, hourly=None, sample_rate=1):
+    """
+    Return chart, widget index (see `widget_index.py`), hourly counts (as
+    `timeseries.TimeBuckets` of "per_hour" and "per_hour_rolled_up") and unique
+    visitors (see `_count_visitors`) for `counts`.
+
+    They are reused from the last call if the versions of their keys in `versions`
+    ({key: version}) didn't change. The index and hourly counts are only built if no
+    `widget_index` / `hourly` is given. The chart is scaled up by 1 / `sample_rate`.
+    """
+    global _prepared
+    old = _prepared
+
+    def unchanged(key):
+        return (
+            versions is not None
+            and key in old["versions"]
+            and versions.get(key) == old["versions"][key]
+        )
+
+    prepared = {"versions": versions or {}, "sample_rate": sample_rate}
+    if unchanged("per_day") and old.get("sample_rate") == sample_rate:
+        prepared["chart"] = old["chart"]
+    else:
+        prepared["chart"] = _make_chart(counts["per_day"], sample_rate)
+    if widget_index is not None:
+        prepared["index"] = widget_index
+    elif unchanged("widgets") and old.get("built_index") is not None:
+        prepared["index"] = prepared["built_index"] = old["built_index"]
+    else:
+        prepared["index"] = prepared["built_index"] = WidgetIndex()
+        prepared["index"].build(counts["widgets"])
+    if hourly is not None:
+        prepared["hourly"] = hourly
+    elif (
+        unchanged("per_hour")
+        and unchanged("per_hour_rolled_up")
+        and old.get("built_hourly") is not None
+    ):
+        prepared["hourly"] = prepared["built_hourly"] = old["built_hourly"]
+    else:
+        prepared["hourly"] = prepared["built_hourly"] = tuple(
+            TimeBuckets.from_dict(counts.get(key, {}), unit)
+            for key, unit in utils.BUCKETS.items()
+        )
+    today = datetime.date.today().toordinal()
+    if unchanged("unique_visitors") and old.get("visitors_day") == today:
+        prepared["visitors"] = old["visitors"]
+    else:
+        prepared["visitors"] = _count_visitors(counts.get("unique_visitors"), today)
+    prepared["visitors_day"] = today
+    _prepared = prepared
+    return prepared
+
+
+def _show_widgets(index, sample_rate=1):
+    """
+    Show widget counts as a table, with the most frequent ones first.
+
+    If sessions are sampled, counts are estimates with a column for their margin of
+    error, see `_estimate`.
+    """
+    import pandas as pd
 
+    columns = ["count"] if sample_rate >= 1 else ["count", "±"]
 
-def show_results(counts, reset_callback, unsafe_password=None):
-    """Show analytics results in streamlit, asking for password if given."""
+    def count_columns(count):
+        if sample_rate >= 1:
+            return (count,)
+        estimate, margin = _estimate(count, sample_rate)
+        return round(estimate), round(margin)
+
+    col1, col2 = st.columns([3, 1])
+    search = col1.text_input("Search widgets and values")
+    limit = col2.selectbox("Show top", TOP_ROWS_CHOICES)
+    rows = index.top(limit, search)
+    df = pd.DataFrame(
+        [
+            (str(label), "" if option is None else str(option)) + count_columns(count)
+            for label, option, count in rows
+        ],
+        columns=["widget", "value"] + columns,
+    )
+    st.dataframe(df)
+    st.caption(f"Showing {len(rows)} of {len(index)} rows.")
+    with st.expander("Total interactions per widget"):
+        totals = sorted(index.totals.items(), key=lambda item: item[1], reverse=True)
+        st.dataframe(
+            pd.DataFrame(
+                [(str(label),) + count_columns(total) for label, total in totals],
+                columns=["widget"] + columns,
+            )
+        )
+
+
+def _pick_range(hours, days):
+    """
+    Let the user pick a date range of the hourly counts.
+
+    Returns it as (start, end) hour ordinals, or None to show all counts.
+    """
+    if not st.checkbox("Only show a date range"):
+        return None
+    days_seen = [t // 24 for t in (hours.first, hours.last) if t is not None]
+    days_seen += [t for t in (days.first, days.last) if t is not None]
+    first = datetime.date.fromordinal(min(days_seen))
+    last = datetime.date.fromordinal(max(days_seen))
+    picked = st.date_input(
+        "Date range", value=(first, last), min_value=first, max_value=last
+    )
+    if not isinstance(picked, (list, tuple)):
+        picked = (picked,)
+    if not picked:
+        return None
+    # While picking, streamlit returns only the start date.
+    return picked[0].toordinal() * 24, (picked[-1].toordinal() + 1) * 24
+
+
+def _show_stats():
+    """Show how long streamlit-analytics took for each phase, see `stats.py`."""
+    import pandas as pd
+
+    st.header("Performance")
+    st.markdown(
+        """
+        Time spent by streamlit-analytics itself, in microseconds. Percentiles are the
+        upper bounds of histogram buckets.
+        """
+    )
+
+    def micros(seconds):
+        return None if seconds is None else round(seconds * 1e6, 1)
+
+    rows = [
+        (
+            phase,
+            phase_stats["count"],
+            micros(phase_stats["mean_seconds"]),
+            micros(phase_stats["p50_seconds"]),
+            micros(phase_stats["p99_seconds"]),
+        )
+        for phase, phase_stats in stats.get_stats().items()
+    ]
+    st.dataframe(pd.DataFrame(rows, columns=["phase", "count", "mean", "p50", "p99"]))
+
+
+def show_results(
+    counts,
+    reset_callback,
+    unsafe_password=None,
+    versions=None,
+    widget_index=None,
+    hourly=None,
+    sample_rate=1,
+):
+    """
+    Show analytics results in streamlit, asking for password if given.
+
+    If `versions` ({key in counts: version}) is given, the chart etc. are only
+    computed again if the versions of the keys they use changed since the last call.
+    `widget_index` can be an up-to-date index of `counts["widgets"]` and `hourly`
+    up-to-date `TimeBuckets` of "per_hour" and "per_hour_rolled_up", so they don't
+    need to be built here. If only a fraction `sample_rate` of sessions was tracked,
+    counts are scaled up and shown with their margin of error.
+    """
 
     # Show header.
     st.title("Analytics Dashboard")
@@ -37,65 +314,46 @@ def show_results(counts, reset_callback, unsafe_password=None):
         # Show traffic.
         st.header("Traffic")
         st.write(f"since {counts['start_time']}")
-        col1, col2, col3 = st.columns(3)
+        if sample_rate < 1:
+            st.caption(
+                f"Only {sample_rate:.1%} of sessions are tracked, so all numbers are "
+                "estimates, with their margin of error (95% confidence) after the ±."
+            )
+        prepared = _prepare(counts, versions, widget_index, hourly, sample_rate)
+        col1, col2, col3, col4, col5 = st.columns(5)
         col1.metric(
             "Pageviews",
-            counts["total_pageviews"],
+            _format_count(counts["total_pageviews"], sample_rate),
             help="Every time a user (re-)loads the site.",
         )
         col2.metric(
             "Script runs",
-            counts["total_script_runs"],
+            _format_count(counts["total_script_runs"], sample_rate),
             help="Every time Streamlit reruns upon changes or interactions.",
         )
         col3.metric(
+            "Sessions",
+            _format_count(counts.get("total_sessions", 0), sample_rate),
+            help="Visits of a user. A new one starts after a while without interaction (30 minutes by default).",
+        )
+        col4.metric(
             "Time spent",
-            utils.format_seconds(counts["total_time_seconds"]),
-            help="Time from initial page load to last widget interaction, summed over all users.",
+            utils.format_seconds(counts["total_time_seconds"] / sample_rate),
+            help="Time from initial page load to last widget interaction within each session, summed over all users.",
+        )
+        visitors, visitors_today, visitors_week = prepared["visitors"]
+        col5.metric(
+            "Unique visitors",
+            f"{visitors:,}",
+            help=f"Different browsers that visited the site (estimated, about 2% off). Today: {visitors_today:,}, last 7 days: {visitors_week:,}.",
         )
         st.write("")
 
         # Plot altair chart with pageviews and script runs.
-        try:
-            alt.themes.enable("streamlit")
-        except:
-            pass  # probably old Streamlit version
-        df = pd.DataFrame(counts["per_day"])
-        base = alt.Chart(df).encode(
-            x=alt.X("monthdate(days):O", axis=alt.Axis(title="", grid=True))
-        )
-        line1 = base.mark_line(point=True, stroke="#5276A7").encode(
-            alt.Y(
-                "pageviews:Q",
-                axis=alt.Axis(
-                    titleColor="#5276A7",
-                    tickColor="#5276A7",
-                    labelColor="#5276A7",
-                    format=".0f",
-                    tickMinStep=1,
-                ),
-                scale=alt.Scale(domain=(0, df["pageviews"].max() + 1)),
-            )
-        )
-        line2 = base.mark_line(point=True, stroke="#57A44C").encode(
-            alt.Y(
-                "script_runs:Q",
-                axis=alt.Axis(
-                    title="script runs",
-                    titleColor="#57A44C",
-                    tickColor="#57A44C",
-                    labelColor="#57A44C",
-                    format=".0f",
-                    tickMinStep=1,
-                ),
-            )
-        )
-        layer = (
-            alt.layer(line1, line2)
-            .resolve_scale(y="independent")
-            .configure_axis(titleFontSize=15, labelFontSize=12, titlePadding=10)
-        )
-        st.altair_chart(layer, use_container_width=True)
+        st.altair_chart(prepared["chart"], use_container_width=True)
+        rolled_up = counts.get("rolled_up") or {}
+        if rolled_up.get("periods"):
+            _show_rolled_up(rolled_up, sample_rate)
 
         # Show widget interactions.
         st.header("Widget interactions")
@@ -111,7 +369,26 @@ def show_results(counts, reset_callback, unsafe_password=None):
             """,
             unsafe_allow_html=True,
         )
-        st.write(counts["widgets"])
+        index = prepared["index"]
+        hours, days = prepared["hourly"]
+        time_range = _pick_range(hours, days) if hours or days else None
+        if time_range is not None:
+            # Sums up the hourly counts of the range from O(log n) index nodes.
+            range_total = range_counts(hours, days, *time_range)
+            pageviews = _format_count(range_total.get(("pageviews",), 0), sample_rate)
+            script_runs = _format_count(
+                range_total.get(("script_runs",), 0), sample_rate
+            )
+            st.write(
+                f"{pageviews} pageviews and {script_runs} script runs in this range. "
+                "Older days are only counted as a whole."
+            )
+            index = WidgetIndex()
+            index.build(nest_bucket(range_total).get("widgets", {}))
+        _show_widgets(index, sample_rate)
+
+        if stats.enabled:
+            _show_stats()
 
         # Show button to reset analytics.
         st.header("Danger zone")
@@ -0,0 +1,108 @@
+"""
+Stores every tracked interaction as a line in a local log file.
+
+Appending one small line per interaction is much cheaper than writing all counts on
+every script run. From time to time, the log is compacted, i.e. the new lines are
+folded into a snapshot file with the usual `counts` format. On startup, the snapshot
+is loaded and only the lines after it are replayed. The log itself is never
+shortened, so it also keeps all raw events (with timestamps) for later analysis.
+
+Each line is a json list: [unix timestamp, amount, *path], where path is like in
+`utils.flatten_counts` (days and hours may be ordinals, see `utils.readable_path`).
+Resetting the counts is logged as [unix timestamp, 0, "reset", start time]. Unique
+visitor sketches are logged as the new rank of each register that changed, see
+`CounterStore.add_visitor`.
+"""
+
+import json
+import threading
+import time
+from pathlib import Path
+
+from . import json_file
+from .utils import add_counts, empty_counts, readable_path
+
+
+def _fold(counts, lines):
+    """Apply the events in `lines` to `counts`. Returns the (maybe new) counts."""
+    for line in lines:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue  # line was cut off when the app crashed
+        path = tuple(event[2:])
+        if path[0] == "reset":
+            counts = empty_counts(path[1])
+            continue
+        add_counts(counts, {readable_path(path): event[1]})
+    return counts
+
+
+class EventLog:
+    """An append-only log of interactions at `path`, with a snapshot next to it."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.snapshot_path = self.path.with_name(self.path.name + ".snapshot.json")
+        self._write_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        # Lines are buffered in memory and written in chunks (see `flush`). The file
+        # is opened on first use.
+        self._file = None
+
+    def append(self, path, amount):
+        """Log that `amount` was added to the counter at `path`."""
+        line = json.dumps([round(time.time(), 3), amount, *path], default=str)
+        with self._write_lock:
+            if self._file is None:
+                self._file = self.path.open("a", buffering=64 * 1024)
+            self._file.write(line + "\n")
+
+    def flush(self):
+        """Write buffered lines to the log file."""
+        with self._write_lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _read(self):
+        """Return the snapshot and the complete lines after it, and where they end."""
+        try:
+            with self.snapshot_path.open("r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            snapshot = {"offset": 0, "counts": empty_counts()}
+        try:
+            with self.path.open("rb") as f:
+                f.seek(snapshot["offset"])
+                tail = f.read()
+        except FileNotFoundError:
+            tail = b""
+        # Ignore the last line if it's not complete yet.
+        tail = tail[: tail.rfind(b"\n") + 1]
+        lines = tail.decode("utf-8").splitlines()
+        return snapshot, lines, snapshot["offset"] + len(tail)
+
+    def load(self, counts):
+        """Load the snapshot and all events after it into `counts`."""
+        self.flush()
+        snapshot, lines, _ = self._read()
+        log_counts = _fold(snapshot["counts"], lines)
+        for key in log_counts:
+            if key in counts and log_counts[key] is not None:
+                counts[key] = log_counts[key]
+
+    def compact(self):
+        """Fold all new events into the snapshot file."""
+        self.flush()
+        with self._compact_lock:
+            snapshot, lines, offset = self._read()
+            if not lines:
+                return
+            counts = _fold(snapshot["counts"], lines)
+            json_file.save({"offset": offset, "counts": counts}, self.snapshot_path)
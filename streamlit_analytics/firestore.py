@@ -1,24 +1,283 @@
-from google.cloud import firestore
+import os
+import threading
+import time
+
+from .hyperloglog import HyperLogLog, UniqueVisitors
+from .utils import (
+    BUCKETS,
+    SERIES,
+    add_counts,
+    empty_counts,
+    flatten_counts,
+    readable_path,
+)
+
+# Firestore clients and document references, by (key file, collection name). They are
+# created once and reused across script runs and users, so we don't re-read the key
+# file, authenticate and open a new channel on every save.
+_docs = {}
+_docs_lock = threading.Lock()
+
+# Timings to check how much the cache saves. Times are in seconds.
+stats = {
+    "clients_created": 0,
+    "client_creation_seconds": 0.0,
+    "saves": 0,
+    "save_seconds": 0.0,
+    "last_save_seconds": 0.0,
+    "retries": 0,
+    "failed_saves": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def add_stats(**amounts):
+    """Add `amounts` to the numbers in `stats`."""
+    with _stats_lock:
+        for name, amount in amounts.items():
+            stats[name] += amount
+
+
+def record_save(seconds):
+    """Add a save that took `seconds` to `stats`."""
+    with _stats_lock:
+        stats["saves"] += 1
+        stats["save_seconds"] += seconds
+        stats["last_save_seconds"] = seconds
+
+
+def import_firestore():
+    """
+    Import google.cloud.firestore.
+
+    This only happens once firestore is used, as it's an optional dependency and
+    slow to import.
+    """
+    try:
+        from google.cloud import firestore
+    except ImportError:
+        raise ImportError(
+            "Using firestore requires google-cloud-firestore. Install it with "
+            "`pip install streamlit-analytics[firestore]`."
+        ) from None
+    return firestore
+
+
+def key_file_version(service_account_json):
+    """Return something that changes when the key file is modified."""
+    stat = os.stat(service_account_json)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def doc_key(service_account_json, collection_name):
+    """Identifies the counts document of a key file and collection."""
+    return os.path.abspath(service_account_json), collection_name
+
+
+def _get_doc(service_account_json, collection_name):
+    """Return the (cached) reference to the counts document in firestore."""
+    key = doc_key(service_account_json, collection_name)
+    version = key_file_version(service_account_json)
+    with _docs_lock:
+        cached = _docs.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        # Key file is new or was changed, so create a new client.
+        start = time.perf_counter()
+        firestore = import_firestore()
+        db = firestore.Client.from_service_account_json(service_account_json)
+        doc = db.collection(collection_name).document("counts")
+        add_stats(
+            clients_created=1, client_creation_seconds=time.perf_counter() - start
+        )
+        _docs[key] = (version, doc)
+        return doc
+
+
+def clear_cache():
+    """Forget all cached firestore clients."""
+    with _docs_lock:
+        _docs.clear()
+
+
+def fetch(service_account_json, collection_name):
+    """Return the data of the counts document in firestore (None if missing)."""
+    doc = _get_doc(service_account_json, collection_name)
+    return doc.get().to_dict()
 
 
 def load(counts, service_account_json, collection_name):
-    """Load count data from firestore into `counts`."""
+    """
+    Load count data from firestore into `counts`. Returns False if there was nothing
+    to load.
+    """
+    return apply_loaded(counts, fetch(service_account_json, collection_name))
+
 
-    # Retrieve data from firestore.
-    db = firestore.Client.from_service_account_json(service_account_json)
-    col = db.collection(collection_name)
-    firestore_counts = col.document("counts").get().to_dict()
+def apply_loaded(counts, firestore_counts):
+    """
+    Put the data of the counts document (None if missing) into `counts`. Returns False
+    if there was nothing to put in.
+    """
+    if firestore_counts is None:
+        return False
 
     # Update all fields in counts that appear in both counts and firestore_counts.
-    if firestore_counts is not None:
-        for key in firestore_counts:
-            if key in counts:
-                counts[key] = firestore_counts[key]
+    for key in firestore_counts:
+        if key in counts:
+            counts[key] = firestore_counts[key]
+
+    # Delta saves store daily counts in maps, as list items can't be incremented.
+    for series_key in SERIES:
+        series_counts = firestore_counts.get(f"{series_key}_counts", {})
+        add_counts(
+            counts,
+            {
+                (series_key, day, key): n
+                for day, day_counts in series_counts.items()
+                for key, n in day_counts.items()
+            },
+        )
+    return True
+
+
+def _to_increments(changes):
+    """
+    Convert changes as {path: change} to a nested dict of firestore increments.
+
+    Hourly/daily buckets only go down when they're rolled up and dropped (see
+    `CounterStore._roll_up_hours`), so they're deleted then, and the document doesn't
+    keep growing. Changed registers of unique visitor sketches are put in as
+    {register: rank}, see `merge_visitors`.
+    """
+    firestore = import_firestore()
+    counters = {}
+    visitors = {}
+    for path, n in changes.items():
+        path = readable_path(path)
+        if path[0] == "unique_visitors":
+            if len(path) == 2:
+                visitors.setdefault("per_day", {})[path[1]] = firestore.DELETE_FIELD
+            elif path[1] == "all_time":
+                visitors.setdefault("all_time", {})[path[2]] = n
+            else:
+                days = visitors.setdefault("per_day", {})
+                if days.get(path[1]) is not firestore.DELETE_FIELD:
+                    days.setdefault(path[1], {})[path[2]] = n
+        else:
+            counters[path] = counters.get(path, 0) + n
+
+    dropped = {path[:2] for path, n in counters.items() if path[0] in BUCKETS and n < 0}
+    data = {}
+    for path, n in counters.items():
+        if path[:2] in dropped:
+            data.setdefault(path[0], {})[str(path[1])] = firestore.DELETE_FIELD
+            continue
+        if not n:
+            continue  # e.g. an hour that was counted and rolled up since
+        if path[0] in SERIES:
+            # Save under a different key than the lists that `save` writes (see `load`).
+            path = (f"{path[0]}_counts",) + path[1:]
+        parent = data
+        for key in path[:-1]:
+            parent = parent.setdefault(str(key), {})
+        parent[str(path[-1])] = firestore.Increment(n)
+    if visitors:
+        data["unique_visitors"] = visitors
+    return data
+
+
+def delta_write(delta):
+    """
+    Return what a delta save needs to write for the changes in `delta` (see
+    `storage.DeltaBuffer`), as (data, merge), or None if nothing changed.
+
+    Counters are sent as increments, which firestore applies atomically, so multiple
+    apps/replicas can save to the same document without overwriting each other's
+    counts. Counters can also go down, e.g. when a rare widget value is merged into
+    the "other" bucket. If counts were reset, everything is overwritten with the
+    counts since then.
+    """
+    reset = next((path for path in delta if path[0] == "reset"), None)
+    if reset is not None:
+        data = empty_counts(reset[1])
+        add_counts(
+            data,
+            {readable_path(path): n for path, n in delta.items() if path != reset},
+        )
+        return data, False
+    data = _to_increments(delta)
+    return (data, True) if data else None
+
+
+def add_all_write(counts):
+    """
+    Return a delta write (see `delta_write`) that adds all of `counts` to what's in
+    firestore, e.g. because nothing was loaded from it.
+    """
+    flat = flatten_counts(counts)
+    flat.update(UniqueVisitors.load(counts.get("unique_visitors")).registers())
+    data = _to_increments(flat)
+    data["start_time"] = counts["start_time"]
+    return data, True
+
+
+def merge_visitors(data, remote):
+    """
+    Return the `data` of a delta write, with the changed registers of its unique
+    visitor sketches applied to the sketches in `remote` (the data of the document, or
+    None).
+
+    Sketches can't be sent as increments, so delta saves read them first and write
+    back the merged ones. If another replica writes a sketch in between, what it added
+    is missing until it writes that sketch again.
+    """
+    fields = data.get("unique_visitors")
+    if not fields:
+        return data
+    remote = ((remote or {}).get("unique_visitors")) or {}
+
+    def merged(registers, remote_sketch):
+        if not isinstance(registers, dict):
+            return registers  # DELETE_FIELD
+        if remote_sketch:
+            sketch = HyperLogLog.from_base64(remote_sketch)
+        else:
+            sketch = HyperLogLog()
+        for i, rank in registers.items():
+            sketch.set(int(i), rank)
+        return sketch.to_base64()
+
+    merged_fields = {}
+    if "all_time" in fields:
+        merged_fields["all_time"] = merged(fields["all_time"], remote.get("all_time"))
+    if "per_day" in fields:
+        remote_days = remote.get("per_day") or {}
+        merged_fields["per_day"] = {
+            day: merged(registers, remote_days.get(day))
+            for day, registers in fields["per_day"].items()
+        }
+    return dict(data, unique_visitors=merged_fields)
+
+
+def send(write, service_account_json, collection_name):
+    """
+    Send `write` (as (data, merge), see `delta_write`) to the counts document.
+
+    Unique visitor sketches are merged with the ones in firestore first, see
+    `merge_visitors`.
+    """
+    doc = _get_doc(service_account_json, collection_name)
+    start = time.perf_counter()
+    data, merge = write
+    if merge and "unique_visitors" in data:
+        remote = doc.get(field_paths=["unique_visitors"]).to_dict()
+        data = merge_visitors(data, remote)
+    doc.set(data, merge=merge)  # creates if doesn't exist
+    record_save(time.perf_counter() - start)
 
 
 def save(counts, service_account_json, collection_name):
-    """Save count data from `counts` to firestore."""
-    db = firestore.Client.from_service_account_json(service_account_json)
-    col = db.collection(collection_name)
-    doc = col.document("counts")
-    doc.set(counts)  # creates if doesn't exist
+    """Save count data from `counts` to firestore, overwriting what's there."""
+    send((counts, False), service_account_json, collection_name)
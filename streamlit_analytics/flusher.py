@@ -0,0 +1,134 @@
+"""
+Saves analytics results from a background thread instead of on every script run.
+"""
+
+import atexit
+import threading
+import traceback
+
+# Flushers that are currently running, by key. Like `counts`, this is shared across
+# all users of the streamlit app.
+_flushers = {}
+_flushers_lock = threading.Lock()
+
+
+def _check_settings(interval, max_dirty):
+    if interval is None and max_dirty is None:
+        raise ValueError("Need to set at least one of `interval` and `max_dirty`")
+
+
+class Flusher:
+    """
+    Calls `save_func` from a daemon thread whenever there are unsaved changes.
+
+    Script runs only call `mark_dirty`. The changes are saved every `interval` seconds
+    or as soon as `max_dirty` script runs were marked dirty, whichever comes first.
+    Anything that's still unsaved is flushed when the interpreter exits.
+    """
+
+    def __init__(self, save_func, interval=None, max_dirty=None, name="flusher"):
+        _check_settings(interval, max_dirty)
+        self.save_func = save_func
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self._dirty = 0
+        self._dirty_lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name=f"streamlit-analytics-{name}", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def configure(self, interval=None, max_dirty=None):
+        """Change `interval` and `max_dirty`, saving any changes right away."""
+        _check_settings(interval, max_dirty)
+        self.interval = interval
+        self.max_dirty = max_dirty
+        # Otherwise, the thread keeps waiting for the old interval.
+        self._wake.set()
+
+    def mark_dirty(self):
+        """Mark that `counts` changed and needs to be saved."""
+        with self._dirty_lock:
+            self._dirty += 1
+            wake = self.max_dirty is not None and self._dirty >= self.max_dirty
+        if wake:
+            self._wake.set()
+
+    def flush(self):
+        """Save now if anything changed. Returns whether `save_func` was called."""
+        with self._save_lock:
+            with self._dirty_lock:
+                dirty = self._dirty
+                self._dirty = 0
+            if not dirty:
+                return False
+            try:
+                self.save_func()
+            except Exception:
+                # Keep the changes marked, so they are saved with the next flush.
+                with self._dirty_lock:
+                    self._dirty += dirty
+                raise
+            return True
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stopped:
+                break
+            try:
+                self.flush()
+            except Exception:
+                # Don't let a failed save (e.g. network hiccup) kill the thread.
+                traceback.print_exc()
+
+    def stop(self):
+        """Stop the background thread and save any remaining changes."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self._wake.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+        self.flush()
+
+
+def get(key, save_func, interval=None, max_dirty=None):
+    """
+    Return the running flusher for `key`, starting a new one if there is none yet.
+
+    `key` identifies the place the data is saved to (e.g. firestore key file and
+    collection), so all script runs that save to the same place share one thread. If
+    it's running with another `interval` or `max_dirty`, these are changed.
+    """
+    with _flushers_lock:
+        f = _flushers.get(key)
+        if f is None:
+            f = _flushers[key] = Flusher(
+                save_func, interval=interval, max_dirty=max_dirty, name=key[0]
+            )
+        elif (f.interval, f.max_dirty) != (interval, max_dirty):
+            f.configure(interval, max_dirty)
+        return f
+
+
+def stop(key):
+    """Stop the flusher for `key` if there is one, saving any remaining changes."""
+    with _flushers_lock:
+        f = _flushers.pop(key, None)
+    if f is not None:
+        f.stop()
+
+
+def stop_all():
+    """Stop all running flushers, saving any remaining changes."""
+    with _flushers_lock:
+        flushers = list(_flushers.values())
+        _flushers.clear()
+    for f in flushers:
+        f.stop()
@@ -0,0 +1,147 @@
+"""
+Loads and saves count data from/to a local json file.
+"""
+
+import json
+import os
+import stat
+import tempfile
+import threading
+from pathlib import Path
+
+from .utils import add_counts, diff_counts, flatten_counts
+
+# One lock per file, so only one thread writes to it at a time.
+_locks = {}
+_locks_lock = threading.Lock()
+
+# Files this process has loaded or saved, with their modification time, and the start
+# time and flattened counts they contained at that point:
+# {absolute path: (mtime, start time, counts)}. Counts are only kept (i.e. not None)
+# if the file is checked for changes by others, see `load_once`.
+_file_states = {}
+
+# Permissions of new files are 0o666 minus the umask. Read it once, as it can only be
+# read by setting it.
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def _get_lock(path):
+    with _locks_lock:
+        return _locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _file_mode(path):
+    """Return the permissions of the file at `path`, or those of a new file."""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~_umask
+
+
+def load(counts, path):
+    """
+    Load count data from the json file at `path` into `counts`.
+
+    Raises FileNotFoundError if the file doesn't exist.
+    """
+    with Path(path).open("r") as f:
+        json_counts = json.load(f)
+    for key in json_counts:
+        if key in counts:
+            counts[key] = json_counts[key]
+
+
+def needs_load(path, check_mtime=False):
+    """Whether `load_once` would load anything."""
+    state = _file_states.get(os.path.abspath(path))
+    return state is None or (check_mtime and _mtime(path) != state[0])
+
+
+def load_once(counts, path, check_mtime=False):
+    """
+    Load count data from the json file at `path` into `counts`, once per process.
+
+    Later calls do nothing, unless `check_mtime` is True and the file was modified by
+    someone else (e.g. another process) since we last loaded or saved it. In that
+    case, the file is loaded again and everything this process counted since then is
+    added on top. Returns True if anything was loaded.
+    """
+    key = os.path.abspath(path)
+    with _get_lock(path):
+        state = _file_states.get(key)
+        if state is not None and (not check_mtime or _mtime(path) == state[0]):
+            return False
+
+        mtime = _mtime(path)
+        if mtime is None:
+            # Nothing to load yet. Counts so far didn't come from a file, so all of them
+            # get added if the file shows up later.
+            _file_states[key] = (None, None, {})
+            return False
+
+        if state is None:
+            load(counts, path)
+            _file_states[key] = (
+                mtime,
+                counts.get("start_time"),
+                flatten_counts(counts) if check_mtime else None,
+            )
+            return True
+
+        if state[1] is not None and state[1] != counts.get("start_time"):
+            # We reset the counts, don't bring back the old ones.
+            _file_states[key] = (mtime,) + state[1:]
+            return False
+
+        if state[2] is None:
+            # Saved without `check_mtime`, so we don't know what we counted since. Keep
+            # our counts, the next save overwrites the file like without checking.
+            _file_states[key] = (mtime, state[1], flatten_counts(counts))
+            return False
+
+        # File was changed by someone else, merge it with our new counts.
+        local_changes = diff_counts(state[2], flatten_counts(counts))
+        load(counts, path)
+        _file_states[key] = (mtime, counts.get("start_time"), flatten_counts(counts))
+        add_counts(counts, local_changes)
+        return True
+
+
+def save(counts, path, check_mtime=False):
+    """
+    Save count data from `counts` to the json file at `path`.
+
+    The data is written to a temporary file first, which then replaces the old file.
+    This way, the file never contains half-written data, even if the app crashes or
+    multiple threads save at the same time. The file keeps its permissions. Set
+    `check_mtime` if it's loaded with `load_once(check_mtime=True)`.
+    """
+    path = Path(path)
+    with _get_lock(path):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=path.parent, prefix=f".{path.name}.", suffix=".tmp"
+        )
+        try:
+            # mkstemp creates files that only we can read.
+            os.chmod(tmp_path, _file_mode(path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(counts, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        _file_states[os.path.abspath(path)] = (
+            _mtime(path),
+            counts.get("start_time"),
+            # Takes a while with lots of counts, so only if it's needed for merging.
+            flatten_counts(counts) if check_mtime else None,
+        )
@@ -3,207 +3,450 @@ Main API functions for the user to start and stop analytics tracking.
 """
 
 import datetime
-import json
+import decimal
+import http.cookies
+import importlib
+import math
+import threading
+import time
+import uuid
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Union
+from typing import List, Union
 
 import streamlit as st
 
-from . import display, firestore
+from . import display, firestore, stats, storage
+from .changes import ChangeTracker, digest
+from .hyperloglog import UniqueVisitors
+from .store import CounterStore
+from .timeseries import DailyCounts, TimeBuckets, hour_of
+from .widget_counts import WidgetCounts
 from .utils import replace_empty
 
 # Dict that holds all analytics results. Note that this is persistent across users,
-# as modules are only imported once by a streamlit app.
+# as modules are only imported once by a streamlit app. Use `get_counts` to read it.
 counts = {"loaded_from_firestore": False}
 
+# All changes to `counts` go through this store, as multiple users (i.e. threads) may
+# change it at the same time.
+_store = CounterStore(counts)
+
+# Options that were last registered for each select widget, see `_register_options`.
+_registered_options = {}
+
 
 def reset_counts():
     # Use yesterday as first entry to make chart look better.
-    yesterday = str(datetime.date.today() - datetime.timedelta(days=1))
-    counts["total_pageviews"] = 0
-    counts["total_script_runs"] = 0
-    counts["total_time_seconds"] = 0
-    counts["per_day"] = {"days": [str(yesterday)], "pageviews": [0], "script_runs": [0]}
-    counts["widgets"] = {}
-    counts["start_time"] = datetime.datetime.now().strftime("%d %b %Y, %H:%M:%S")
+    yesterday = datetime.date.today().toordinal() - 1
+    with _store.lock_all():
+        counts["total_pageviews"] = 0
+        counts["total_script_runs"] = 0
+        counts["total_time_seconds"] = 0
+        counts["total_sessions"] = 0
+        counts["per_day"] = DailyCounts(yesterday)
+        counts["per_day"].incr(yesterday, "pageviews", 0)
+        counts["rolled_up"] = {"periods": [], "pageviews": [], "script_runs": []}
+        counts["per_hour"] = TimeBuckets("hour")
+        counts["per_hour_rolled_up"] = TimeBuckets("day")
+        counts["widgets"] = WidgetCounts()
+        counts["unique_visitors"] = UniqueVisitors()
+        counts["start_time"] = datetime.datetime.now().strftime("%d %b %Y, %H:%M:%S")
+        _registered_options.clear()
+        _store.clear_overcounts()
+    _store.changed()
+    _store.emit(("reset", counts["start_time"]), 0)
 
 
 reset_counts()
 
-# Store original streamlit functions. They will be monkey-patched with some wrappers
-# in `start_tracking` (see wrapper functions below).
-_orig_button = st.button
-_orig_checkbox = st.checkbox
-_orig_radio = st.radio
-_orig_selectbox = st.selectbox
-_orig_multiselect = st.multiselect
-_orig_slider = st.slider
-_orig_select_slider = st.select_slider
-_orig_text_input = st.text_input
-_orig_number_input = st.number_input
-_orig_text_area = st.text_area
-_orig_date_input = st.date_input
-_orig_time_input = st.time_input
-_orig_file_uploader = st.file_uploader
-_orig_color_picker = st.color_picker
-
-_orig_sidebar_button = st.sidebar.button
-_orig_sidebar_checkbox = st.sidebar.checkbox
-_orig_sidebar_radio = st.sidebar.radio
-_orig_sidebar_selectbox = st.sidebar.selectbox
-_orig_sidebar_multiselect = st.sidebar.multiselect
-_orig_sidebar_slider = st.sidebar.slider
-_orig_sidebar_select_slider = st.sidebar.select_slider
-_orig_sidebar_text_input = st.sidebar.text_input
-_orig_sidebar_number_input = st.sidebar.number_input
-_orig_sidebar_text_area = st.sidebar.text_area
-_orig_sidebar_date_input = st.sidebar.date_input
-_orig_sidebar_time_input = st.sidebar.time_input
-_orig_sidebar_file_uploader = st.sidebar.file_uploader
-_orig_sidebar_color_picker = st.sidebar.color_picker
-
-
-def _track_user():
-    """Track individual pageviews by storing user id to session state."""
-    today = str(datetime.date.today())
-    if counts["per_day"]["days"][-1] != today:
-        # TODO: Insert 0 for all days between today and last entry.
-        counts["per_day"]["days"].append(today)
-        counts["per_day"]["pageviews"].append(0)
-        counts["per_day"]["script_runs"].append(0)
-    counts["total_script_runs"] += 1
-    counts["per_day"]["script_runs"][-1] += 1
-    now = datetime.datetime.now()
-    counts["total_time_seconds"] += (now - st.session_state.last_time).total_seconds()
+
+def get_counts():
+    """
+    Return a copy of all counts as plain dict, in the same format as the json file.
+
+    Use this instead of reading `counts` directly, which keeps some parts as objects
+    that are faster to update (see `store.CounterStore`).
+    """
+    return _store.snapshot()
+
+
+# Whether the current script run is being tracked. Streamlit runs each user session
+# in its own thread, so this is thread-local. It's set by `start_tracking` and
+# `stop_tracking`.
+_session = threading.local()
+
+
+# Ordinal of the current hour (see `timeseries.hour_of`) and the unix time when it
+# ends, see `_this_hour`.
+_hour = (0, 0.0)
+
+
+def _this_hour():
+    """Return the current hour's ordinal, only looking at the clock once it ends."""
+    global _hour
+    if time.time() >= _hour[1]:
+        now = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+        _hour = (hour_of(now), (now + datetime.timedelta(hours=1)).timestamp())
+    return _hour[0]
+
+
+def _today():
+    """Return the ordinal of the current day."""
+    return _this_hour() // 24
+
+
+# Internal streamlit functions found by `_streamlit_func`, by their candidates.
+_streamlit_funcs = {}
+
+
+def _streamlit_func(candidates):
+    """
+    Return the first function in `candidates` ((module, name) tuples) that exists, or
+    None.
+
+    Streamlit moved some internal functions around across versions. The lookup only
+    happens once, as trying to import modules that don't exist is slow.
+    """
+    if candidates not in _streamlit_funcs:
+        func = None
+        for module, name in candidates:
+            try:
+                func = getattr(importlib.import_module(module), name)
+                break
+            except (ImportError, AttributeError):
+                continue
+        _streamlit_funcs[candidates] = func
+    return _streamlit_funcs[candidates]
+
+
+def _session_id():
+    """Return streamlit's id of the current session, or a random id if not available."""
+    # Where streamlit keeps the context of a script run changed across versions.
+    get_ctx = _streamlit_func(
+        (
+            ("streamlit.runtime.scriptrunner", "get_script_run_ctx"),
+            ("streamlit.scriptrunner", "get_script_run_ctx"),
+            ("streamlit.script_run_context", "get_script_run_ctx"),
+            ("streamlit.report_thread", "get_report_ctx"),
+        )
+    )
+    ctx = get_ctx() if get_ctx is not None else None
+    return ctx.session_id if ctx is not None else uuid.uuid4().hex
+
+
+def _is_sampled(sample_rate):
+    """
+    Return whether the current session is tracked when sampling at `sample_rate`.
+
+    This hashes the session id to a number in [0, 1), so the decision stays the same
+    for the whole session, and sessions that are tracked at some rate are also
+    tracked at any higher rate.
+    """
+    if sample_rate >= 1:
+        return True
+    if "sample_point" not in st.session_state:
+        h = int.from_bytes(digest(_session_id()), "big")
+        st.session_state.sample_point = h / 2**64
+    return st.session_state.sample_point < sample_rate
+
+
+def _headers_and_cookies():
+    """
+    Return the http headers and cookies (as dict) of the current session, or None if
+    not available.
+    """
+    context = getattr(st, "context", None)  # streamlit >= 1.37
+    if context is not None:
+        return context.headers, dict(context.cookies)
+    get_headers = _streamlit_func(
+        (
+            ("streamlit.web.server.websocket_headers", "_get_websocket_headers"),
+            ("streamlit.server.websocket_headers", "_get_websocket_headers"),
+        )
+    )
+    headers = get_headers() if get_headers is not None else None
+    if headers is None:
+        return None
+    cookies = http.cookies.SimpleCookie()
+    try:
+        cookies.load(headers.get("Cookie", ""))
+    except http.cookies.CookieError:
+        pass
+    return headers, {name: morsel.value for name, morsel in cookies.items()}
+
+
+def _visitor_fingerprint():
+    """
+    Return something that stays the same for a visitor across sessions.
+
+    Streamlit sets an XSRF cookie, which the browser keeps until the user deletes
+    cookies. Without it, user agent and forwarded IP address are used (so visitors
+    behind the same proxy with the same browser count once), and as a last resort the
+    session id (so each session counts as a new visitor).
+    """
+    request = _headers_and_cookies()
+    if request is not None:
+        headers, cookies = request
+        if cookies.get("_streamlit_xsrf"):
+            return "cookie:" + cookies["_streamlit_xsrf"]
+        agent = headers.get("User-Agent")
+        ip = headers.get("X-Forwarded-For")
+        if agent or ip:
+            return f"headers:{agent}|{ip}"
+    return "session:" + _session_id()
+
+
+def _track_visitor():
+    """
+    Add the visitor to the unique visitor sketches, once per session and day.
+
+    Only the hash of the fingerprint is kept, in the session state.
+    """
+    today = _today()
+    if "visitor_day" in st.session_state and st.session_state.visitor_day == today:
+        return
+    if "visitor_hash" not in st.session_state:
+        h = int.from_bytes(digest(_visitor_fingerprint()), "big")
+        st.session_state.visitor_hash = h
+    st.session_state.visitor_day = today
+    _store.add_visitor(today, st.session_state.visitor_hash)
+
+
+def _track_user(session_timeout):
+    """
+    Track pageviews, sessions, unique visitors and time spent, using the session state
+    of the user.
+
+    A session ends when the user doesn't rerun the script for `session_timeout`
+    seconds. Only the time between reruns of the same session counts as time spent.
+    """
+    today = _today()
+    hour = _session.hour
+    _track_visitor()
+    _store.incr(("total_script_runs",))
+    _store.incr(("per_day", today, "script_runs"))
+    if hour is not None:
+        _store.incr(("per_hour", hour, "script_runs"))
+    # Monotonic, so changes to the system clock don't add or remove time.
+    now = time.monotonic()
+    last_time = st.session_state.last_time
     st.session_state.last_time = now
+    if last_time is None or now - last_time > session_timeout:
+        _store.incr(("total_sessions",))
+    else:
+        _store.incr(("total_time_seconds",), now - last_time)
     if not st.session_state.user_tracked:
         st.session_state.user_tracked = True
-        counts["total_pageviews"] += 1
-        counts["per_day"]["pageviews"][-1] += 1
+        _store.incr(("total_pageviews",))
+        _store.incr(("per_day", today, "pageviews"))
+        if hour is not None:
+            _store.incr(("per_hour", hour, "pageviews"))
         # print("Tracked new user")
 
 
-def _wrap_checkbox(func):
+def _register_options(label, options):
+    """
+    Register all options of a select widget with the store, if they changed.
+
+    Looping over all options is slow for widgets with thousands of them, so we remember
+    the options of each label and skip that if they are the same object (for tuples,
+    which can't change) or have the same hash as last time.
+    """
+    cached = _registered_options.get(label)
+    if cached is not None and cached[0] is options and isinstance(options, tuple):
+        return
+    try:
+        fingerprint = hash(tuple(options))
+    except TypeError:
+        fingerprint = None  # not hashable, always register
+    if fingerprint is None or cached is None or cached[1] != fingerprint:
+        _store.register(label, [replace_empty(option) for option in options])
+    _registered_options[label] = (options, fingerprint)
+
+
+def _count(label, option=None, max_values=None):
+    """
+    Count an interaction with widget `label` (and `option`, for widgets with options).
+
+    If `max_values` is set, only the most frequent options are kept, see
+    `CounterStore.incr_top`. If hourly counts are on, the interaction is also counted
+    in the current hour.
+    """
+    path = (label,) if option is None else (label, option)
+    if max_values is None:
+        _store.incr(("widgets",) + path)
+    else:
+        _store.incr_top(label, option, max_values)
+    if _session.hour is not None:
+        _store.incr(("per_hour", _session.hour, "widgets") + path)
+
+
+def _wrap_checkbox(func, name):
     """
     Wrap st.checkbox.
     """
 
+    phase = f"wrap.{name}"
+
     def new_func(label, *args, **kwargs):
+        if not getattr(_session, "tracking", False):
+            return func(label, *args, **kwargs)
         checked = func(label, *args, **kwargs)
+        start = stats.start()
         label = replace_empty(label)
-        if label not in counts["widgets"]:
-            counts["widgets"][label] = 0
-        if checked != st.session_state.state_dict.get(label, None):
-            counts["widgets"][label] += 1
-        st.session_state.state_dict[label] = checked
+        _store.register(label)
+        if st.session_state.widget_changes.update(label, checked):
+            _count(label)
+        stats.stop(phase, start)
         return checked
 
     return new_func
 
 
-def _wrap_button(func):
+def _wrap_button(func, name):
     """
     Wrap st.button.
     """
 
+    phase = f"wrap.{name}"
+
     def new_func(label, *args, **kwargs):
+        if not getattr(_session, "tracking", False):
+            return func(label, *args, **kwargs)
         clicked = func(label, *args, **kwargs)
+        start = stats.start()
         label = replace_empty(label)
-        if label not in counts["widgets"]:
-            counts["widgets"][label] = 0
+        _store.register(label)
         if clicked:
-            counts["widgets"][label] += 1
-        st.session_state.state_dict[label] = clicked
+            _count(label)
+        stats.stop(phase, start)
         return clicked
 
     return new_func
 
 
-def _wrap_file_uploader(func):
+def _wrap_file_uploader(func, name):
     """
     Wrap st.file_uploader.
     """
 
+    phase = f"wrap.{name}"
+
     def new_func(label, *args, **kwargs):
+        if not getattr(_session, "tracking", False):
+            return func(label, *args, **kwargs)
         uploaded_file = func(label, *args, **kwargs)
+        start = stats.start()
         label = replace_empty(label)
-        if label not in counts["widgets"]:
-            counts["widgets"][label] = 0
+        _store.register(label)
         # TODO: Right now this doesn't track when multiple files are uploaded one after
         #   another. Maybe compare files directly (but probably not very clever to
         #   store in session state) or hash them somehow and check if a different file
         #   was uploaded.
-        if uploaded_file and not st.session_state.state_dict.get(label, None):
-            counts["widgets"][label] += 1
-        st.session_state.state_dict[label] = bool(uploaded_file)
+        changed = st.session_state.widget_changes.update(label, bool(uploaded_file))
+        if uploaded_file and changed:
+            _count(label)
+        stats.stop(phase, start)
         return uploaded_file
 
     return new_func
 
 
-def _wrap_select(func):
+def _wrap_select(func, name):
     """
     Wrap a streamlit function that returns one selected element out of multiple options,
     e.g. st.radio, st.selectbox, st.select_slider.
     """
 
+    phase = f"wrap.{name}"
+
     def new_func(label, options, *args, **kwargs):
+        if not getattr(_session, "tracking", False):
+            return func(label, options, *args, **kwargs)
         orig_selected = func(label, options, *args, **kwargs)
+        start = stats.start()
         label = replace_empty(label)
         selected = replace_empty(orig_selected)
-        if label not in counts["widgets"]:
-            counts["widgets"][label] = {}
-        for option in options:
-            option = replace_empty(option)
-            if option not in counts["widgets"][label]:
-                counts["widgets"][label][option] = 0
-        if selected != st.session_state.state_dict.get(label, None):
-            counts["widgets"][label][selected] += 1
-        st.session_state.state_dict[label] = selected
+        _register_options(label, options)
+        if st.session_state.widget_changes.update(label, selected):
+            _count(label, selected)
+        stats.stop(phase, start)
         return orig_selected
 
     return new_func
 
 
-def _wrap_multiselect(func):
+def _wrap_multiselect(func, name):
     """
     Wrap a streamlit function that returns multiple selected elements out of multiple
     options, e.g. st.multiselect.
     """
 
+    phase = f"wrap.{name}"
+
     def new_func(label, options, *args, **kwargs):
+        if not getattr(_session, "tracking", False):
+            return func(label, options, *args, **kwargs)
         selected = func(label, options, *args, **kwargs)
+        start = stats.start()
         label = replace_empty(label)
-        if label not in counts["widgets"]:
-            counts["widgets"][label] = {}
-        for option in options:
-            option = replace_empty(option)
-            if option not in counts["widgets"][label]:
-                counts["widgets"][label][option] = 0
-        for sel in selected:
-            sel = replace_empty(sel)
-            if sel not in st.session_state.state_dict.get(label, []):
-                counts["widgets"][label][sel] += 1
-        st.session_state.state_dict[label] = selected
+        _register_options(label, options)
+        selected_options = [replace_empty(sel) for sel in selected]
+        new_options = st.session_state.widget_changes.update_options(
+            label, selected_options
+        )
+        for sel in new_options:
+            _count(label, sel)
+        stats.stop(phase, start)
         return selected
 
     return new_func
 
 
-def _wrap_value(func):
+def _bin_bound(bound):
+    """Format a bin boundary (a `decimal.Decimal`), as int if it's a whole number."""
+    return str(int(bound)) if bound == bound.to_integral_value() else str(bound)
+
+
+def _bin_label(value, bin_width):
+    """
+    Return the histogram bin of number `value`, e.g. "[10, 20)" for 12 and width 10.
+
+    This calculates with decimals, so bounds are exact (0.3 with width 0.1 goes into
+    "[0.3, 0.4)", not "[0.2, 0.30000000000000004)") and neighboring bins never get the
+    same label.
+    """
+    width = decimal.Decimal(str(bin_width))
+    start = math.floor(decimal.Decimal(str(value)) / width) * width
+    return f"[{_bin_bound(start)}, {_bin_bound(start + width)})"
+
+
+def _wrap_value(func, name):
     """
     Wrap a streamlit function that returns a single value (str/int/float/datetime/...),
     e.g. st.slider, st.text_input, st.number_input, st.text_area, st.date_input,
     st.time_input, st.color_picker.
     """
 
+    phase = f"wrap.{name}"
+
     def new_func(label, *args, **kwargs):
+        if not getattr(_session, "tracking", False):
+            return func(label, *args, **kwargs)
         value = func(label, *args, **kwargs)
-        if label not in counts["widgets"]:
-            counts["widgets"][label] = {}
+        start = stats.start()
 
         formatted_value = replace_empty(value)
+        bin_width = _session.numeric_bin_width
+        if (
+            bin_width is not None
+            and isinstance(value, (int, float))
+            and not isinstance(value, bool)
+            and math.isfinite(value)
+        ):
+            # Put numbers into histogram bins, so we don't count every single value.
+            formatted_value = _bin_label(value, bin_width)
         if type(value) == tuple and len(value) == 2:
             # Double-ended slider or date input with start/end, convert to str.
             formatted_value = f"{value[0]} - {value[1]}"
@@ -216,21 +459,114 @@ def _wrap_value(func):
         ):
             formatted_value = str(value)
 
-        if formatted_value not in counts["widgets"][label]:
-            counts["widgets"][label][formatted_value] = 0
-        if formatted_value != st.session_state.state_dict.get(label, None):
-            counts["widgets"][label][formatted_value] += 1
-        st.session_state.state_dict[label] = formatted_value
+        max_values = _session.max_values_per_widget
+        if max_values is None:
+            _store.register(label, [formatted_value])
+        else:
+            _store.register(label, [])
+        if st.session_state.widget_changes.update(label, formatted_value):
+            _count(label, formatted_value, max_values)
+        stats.stop(phase, start)
         return value
 
     return new_func
 
 
+# Streamlit functions that get tracked, with the wrapper for each of them.
+_wrappers = {
+    "button": _wrap_button,
+    "checkbox": _wrap_checkbox,
+    "radio": _wrap_select,
+    "selectbox": _wrap_select,
+    "multiselect": _wrap_multiselect,
+    "slider": _wrap_value,
+    "select_slider": _wrap_select,
+    "text_input": _wrap_value,
+    "number_input": _wrap_value,
+    "text_area": _wrap_value,
+    "date_input": _wrap_value,
+    "time_input": _wrap_value,
+    "file_uploader": _wrap_file_uploader,
+    "color_picker": _wrap_value,
+}
+_wrappers_installed = False
+_wrappers_lock = threading.Lock()
+
+
+def _install_wrappers():
+    """
+    Monkey-patch streamlit to call the wrappers above.
+
+    This only happens once per process. The wrappers stay in place and just call the
+    original streamlit function if the current script run isn't tracked, so sessions
+    can't un-patch each other and reruns don't need to patch again.
+    """
+    global _wrappers_installed
+    if _wrappers_installed:
+        return
+    with _wrappers_lock:
+        if _wrappers_installed:
+            return
+        start = stats.start()
+        for obj in (st, st.sidebar):
+            for name, wrap in _wrappers.items():
+                setattr(obj, name, wrap(getattr(obj, name), name))
+        _wrappers_installed = True
+        stats.stop("install_wrappers", start)
+
+
+# Counts shown on the dashboard, with the version of each of their keys, see
+# `_dashboard_counts`.
+_dashboard_cache = ({}, {})
+
+
+def _dashboard_counts(backends):
+    """
+    Return the counts to show on the dashboard and the version of each of their keys.
+
+    Only keys that changed since the last call are copied again. If backends change
+    what is shown (e.g. to merge counts of other processes, see
+    `storage.StorageBackend.view`), everything is copied if anything changed.
+    """
+    global _dashboard_cache
+    views = tuple(backend.view_version() for backend in backends)
+    # Read versions first, so changes while copying lead to a new copy next time.
+    versions = {key: (_store.versions.get(key), views) for key in counts}
+    cached_versions, results = _dashboard_cache
+    changed = [key for key in versions if versions[key] != cached_versions.get(key)]
+    if changed:
+        if any(view is not None for view in views):
+            results = _store.snapshot()
+            for backend in backends:
+                results = backend.view(results)
+        else:
+            results = dict(results)
+            results.update(_store.snapshot(changed))
+        _dashboard_cache = (versions, results)
+    return versions, results
+
+
 def start_tracking(
     verbose: bool = False,
     firestore_key_file: str = None,
     firestore_collection_name: str = "counts",
     load_from_json: Union[str, Path] = None,
+    load_from_json_check_mtime: bool = False,
+    max_values_per_widget: int = None,
+    numeric_bin_width: float = None,
+    per_day_retention: int = None,
+    per_day_rollup: str = "month",
+    event_log: Union[str, Path] = None,
+    event_log_compact_interval: float = 60,
+    sqlite_file: Union[str, Path] = None,
+    storage_backends: List[storage.StorageBackend] = None,
+    shard_dir: Union[str, Path] = None,
+    shard_ttl: float = 5,
+    session_timeout: float = 30 * 60,
+    firestore_async: bool = False,
+    firestore_timeout: float = 10,
+    per_hour_retention: int = None,
+    sample_rate: float = 1,
 ):
     """
     Start tracking user inputs to a streamlit app.
@@ -239,89 +575,141 @@ def start_tracking(
     `streamlit_analytics.stop_tracking()` at the end of your streamlit script.
     For a more convenient interface, wrap your streamlit calls in
     `with streamlit_analytics.track():`.
-    """
 
-    if firestore_key_file and not counts["loaded_from_firestore"]:
-        firestore.load(counts, firestore_key_file, firestore_collection_name)
-        counts["loaded_from_firestore"] = True
-        if verbose:
-            print("Loaded count data from firestore:")
-            print(counts)
-            print()
+    `load_from_json` is only read on the first script run. If
+    `load_from_json_check_mtime` is True, it's read again (and merged with the counts
+    in memory) whenever another process modified the file.
+
+    Widgets where users enter values (e.g. st.text_input, st.slider) can end up with
+    lots of different values. `max_values_per_widget` keeps only the most frequent ones
+    and counts the rest as "(other values)". `numeric_bin_width` counts numbers in bins
+    of that width instead of every single number.
+
+    If `per_day_retention` is set, only that many days are kept in the daily counts.
+    Older days are summed up per `per_day_rollup` ("week" or "month").
+
+    If `per_hour_retention` is set, pageviews, script runs and widget interactions
+    are also counted per hour, so the dashboard can show them for a date range. Only
+    that many hours are kept, older ones are summed up per day (and kept for
+    `per_day_retention` days, if set).
 
+    If `event_log` is set, every interaction is appended to this file, and counts are
+    loaded from it on the first script run. The log is compacted into a snapshot file
+    every `event_log_compact_interval` seconds (see `eventlog.py` for details).
+
+    If `sqlite_file` is set, counts are loaded from and saved to this sqlite database.
+    `storage_backends` can add more places to load and save counts (see
+    `storage.StorageBackend`). Backends given here are saved to in `stop_tracking`.
+
+    If the app runs in multiple processes, set `shard_dir` to a directory they share.
+    Each process then saves its counts to its own file there, and the dashboard shows
+    the sum of all of them. Files of other processes are read (and this process' file
+    is written) at most every `shard_ttl` seconds.
+
+    A user's session ends after `session_timeout` seconds without any interaction.
+    The next interaction starts a new session. Only time within sessions is counted
+    as time spent.
+
+    If `firestore_async` is True, counts are loaded from firestore in the background,
+    so the first script runs may not show them yet (see `stop_tracking`).
+
+    For apps with lots of traffic, set `sample_rate` (between 0 and 1) to only track
+    that fraction of sessions. Other sessions aren't tracked or saved at all. The
+    dashboard then shows counts scaled up by 1 / `sample_rate`, with error margins.
+    """
+    start = stats.start()
+    if max_values_per_widget is not None and max_values_per_widget < 1:
+        raise ValueError("max_values_per_widget needs to be at least 1")
+    if per_day_rollup not in ("week", "month"):
+        raise ValueError("per_day_rollup needs to be 'week' or 'month'")
+    if per_hour_retention is not None and per_hour_retention < 1:
+        raise ValueError("per_hour_retention needs to be at least 1")
+    if not 0 < sample_rate <= 1:
+        raise ValueError("sample_rate needs to be between 0 (exclusive) and 1")
+
+    # Backends that are saved to at the end of the script run, see `stop_tracking`.
+    session_backends = []
+    if event_log is not None:
+        session_backends.append(
+            storage.register(
+                storage.EventLogBackend(event_log),
+                _store,
+                flush_interval=event_log_compact_interval,
+            )
+        )
+    if sqlite_file is not None:
+        session_backends.append(
+            storage.register(storage.SqliteBackend(sqlite_file), _store)
+        )
+    if shard_dir is not None:
+        session_backends.append(
+            storage.register(
+                storage.ShardedBackend(shard_dir),
+                _store,
+                ttl=shard_ttl,
+                flush_interval=shard_ttl,
+            )
+        )
+    for backend in storage_backends or []:
+        session_backends.append(storage.register(backend, _store))
+    _session.backends = session_backends
+
+    load_backends = list(session_backends)
+    if firestore_key_file:
+        load_backends.insert(
+            0,
+            storage.register(
+                storage.FirestoreBackend(firestore_key_file, firestore_collection_name),
+                _store,
+                asynchronous=firestore_async,
+                timeout=firestore_timeout,
+            ),
+        )
     if load_from_json is not None:
-        if verbose:
-            print(f"Loading counts from json:", load_from_json)
-        try:
-            with Path(load_from_json).open("r") as f:
-                json_counts = json.load(f)
-                for key in json_counts:
-                    if key in counts:
-                        counts[key] = json_counts[key]
+        load_backends.append(
+            storage.register(
+                storage.JsonBackend(load_from_json),
+                _store,
+                check_mtime=load_from_json_check_mtime,
+            )
+        )
+    for backend in load_backends:
+        if storage.load(backend, _store):
+            _registered_options.clear()
             if verbose:
-                print("Success! Loaded counts:")
-                print(counts)
+                print("Loaded counts from", backend.key)
+                print(get_counts())
                 print()
-        except FileNotFoundError as e:
-            if verbose:
-                print(f"File not found, proceeding with empty counts.")
+
+    _store.retention_days = per_day_retention
+    _store.rollup = per_day_rollup
+    _store.retention_hours = per_hour_retention
+    _session.hour = None if per_hour_retention is None else _this_hour()
+
+    _session.sample_rate = sample_rate
+    _session.sampled = _is_sampled(sample_rate)
+    if not _session.sampled:
+        # Sketches can't be scaled up like counts, so visitors are added in all
+        # sessions. The wrappers just call the streamlit functions, nothing else to do.
+        _track_visitor()
+        _session.tracking = False
+        stats.stop("start_tracking", start)
+        return
 
     # Reset session state.
     if "user_tracked" not in st.session_state:
         st.session_state.user_tracked = False
-    if "state_dic" not in st.session_state:
-        st.session_state.state_dict = {}
+    if "widget_changes" not in st.session_state:
+        st.session_state.widget_changes = ChangeTracker()
     if "last_time" not in st.session_state:
-        st.session_state.last_time = datetime.datetime.now()
-    _track_user()
-
-    # Monkey-patch streamlit to call the wrappers above.
-    st.button = _wrap_button(_orig_button)
-    st.checkbox = _wrap_checkbox(_orig_checkbox)
-    st.radio = _wrap_select(_orig_radio)
-    st.selectbox = _wrap_select(_orig_selectbox)
-    st.multiselect = _wrap_multiselect(_orig_multiselect)
-    st.slider = _wrap_value(_orig_slider)
-    st.select_slider = _wrap_select(_orig_select_slider)
-    st.text_input = _wrap_value(_orig_text_input)
-    st.number_input = _wrap_value(_orig_number_input)
-    st.text_area = _wrap_value(_orig_text_area)
-    st.date_input = _wrap_value(_orig_date_input)
-    st.time_input = _wrap_value(_orig_time_input)
-    st.file_uploader = _wrap_file_uploader(_orig_file_uploader)
-    st.color_picker = _wrap_value(_orig_color_picker)
-
-    st.sidebar.button = _wrap_button(_orig_sidebar_button)
-    st.sidebar.checkbox = _wrap_checkbox(_orig_sidebar_checkbox)
-    st.sidebar.radio = _wrap_select(_orig_sidebar_radio)
-    st.sidebar.selectbox = _wrap_select(_orig_sidebar_selectbox)
-    st.sidebar.multiselect = _wrap_multiselect(_orig_sidebar_multiselect)
-    st.sidebar.slider = _wrap_value(_orig_sidebar_slider)
-    st.sidebar.select_slider = _wrap_select(_orig_sidebar_select_slider)
-    st.sidebar.text_input = _wrap_value(_orig_sidebar_text_input)
-    st.sidebar.number_input = _wrap_value(_orig_sidebar_number_input)
-    st.sidebar.text_area = _wrap_value(_orig_sidebar_text_area)
-    st.sidebar.date_input = _wrap_value(_orig_sidebar_date_input)
-    st.sidebar.time_input = _wrap_value(_orig_sidebar_time_input)
-    st.sidebar.file_uploader = _wrap_file_uploader(_orig_sidebar_file_uploader)
-    st.sidebar.color_picker = _wrap_value(_orig_sidebar_color_picker)
-
-    # replacements = {
-    #     "button": _wrap_bool,
-    #     "checkbox": _wrap_bool,
-    #     "radio": _wrap_select,
-    #     "selectbox": _wrap_select,
-    #     "multiselect": _wrap_multiselect,
-    #     "slider": _wrap_value,
-    #     "select_slider": _wrap_select,
-    #     "text_input": _wrap_value,
-    #     "number_input": _wrap_value,
-    #     "text_area": _wrap_value,
-    #     "date_input": _wrap_value,
-    #     "time_input": _wrap_value,
-    #     "file_uploader": _wrap_file_uploader,
-    #     "color_picker": _wrap_value,
-    # }
+        st.session_state.last_time = None
+    _track_user(session_timeout)
+
+    _install_wrappers()
+    _session.max_values_per_widget = max_values_per_widget
+    _session.numeric_bin_width = numeric_bin_width
+    _session.tracking = True
+    stats.stop("start_tracking", start)
 
     if verbose:
         print()
@@ -334,75 +722,104 @@ def stop_tracking(
     firestore_key_file: str = None,
     firestore_collection_name: str = "counts",
     verbose: bool = False,
+    firestore_flush_interval: float = None,
+    firestore_flush_after: int = None,
+    firestore_delta: bool = False,
+    save_to_json_interval: float = None,
+    firestore_async: bool = False,
+    firestore_timeout: float = 10,
+    firestore_retries: int = 5,
 ):
     """
     Stop tracking user inputs to a streamlit app.
 
     Should be called after `streamlit-analytics.start_tracking()`. This method also
     shows the analytics results below your app if you attach `?analytics=on` to the URL.
+
+    If `firestore_flush_interval` (in seconds) or `firestore_flush_after` (number of
+    script runs) is set, counts are saved to firestore from a background thread instead
+    of on every script run.
+
+    If `firestore_delta` is True, only the counters that changed since the last save
+    are sent to firestore, as atomic increments. This keeps saves small and lets
+    multiple replicas of an app save to the same collection.
+
+    If `save_to_json_interval` (in seconds) is set, the json file is written at most
+    once per interval from a background thread, instead of on every script run.
+
+    If `firestore_async` is True, saves to firestore are queued and sent from a
+    background event loop with firestore's AsyncClient, so slow or failing firestore
+    never holds up the app. Each save times out after `firestore_timeout` seconds and
+    is retried up to `firestore_retries` times (see `async_firestore.py`).
     """
     if verbose:
         print("Finished script execution. New counts:")
-        print(counts)
+        print(get_counts())
         print("-" * 80)
 
-    # sess = get_session_state
-    # print(sess.state_dict)
-
-    # Reset streamlit functions.
-    st.button = _orig_button
-    st.checkbox = _orig_checkbox
-    st.radio = _orig_radio
-    st.selectbox = _orig_selectbox
-    st.multiselect = _orig_multiselect
-    st.slider = _orig_slider
-    st.select_slider = _orig_select_slider
-    st.text_input = _orig_text_input
-    st.number_input = _orig_number_input
-    st.text_area = _orig_text_area
-    st.date_input = _orig_date_input
-    st.time_input = _orig_time_input
-    st.file_uploader = _orig_file_uploader
-    st.color_picker = _orig_color_picker
-
-    st.sidebar.button = _orig_sidebar_button
-    st.sidebar.checkbox = _orig_sidebar_checkbox
-    st.sidebar.radio = _orig_sidebar_radio
-    st.sidebar.selectbox = _orig_sidebar_selectbox
-    st.sidebar.multiselect = _orig_sidebar_multiselect
-    st.sidebar.slider = _orig_sidebar_slider
-    st.sidebar.select_slider = _orig_sidebar_select_slider
-    st.sidebar.text_input = _orig_sidebar_text_input
-    st.sidebar.number_input = _orig_sidebar_number_input
-    st.sidebar.text_area = _orig_sidebar_text_area
-    st.sidebar.date_input = _orig_sidebar_date_input
-    st.sidebar.time_input = _orig_sidebar_time_input
-    st.sidebar.file_uploader = _orig_sidebar_file_uploader
-    st.sidebar.color_picker = _orig_sidebar_color_picker
-
-    # Save count data to firestore.
-    # TODO: Maybe don't save on every iteration but on regular intervals in a background
-    #   thread.
+    # Stop tracking, so the wrappers just call the original streamlit functions.
+    _session.tracking = False
+    start = stats.start()
+
+    # Save count data to all backends, either right away or by marking it for their
+    # background flusher.
+    backends = getattr(_session, "backends", [])
+    _session.backends = []
     if firestore_key_file:
-        if verbose:
-            print("Saving count data to firestore:")
-            print(counts)
-            print()
-        firestore.save(counts, firestore_key_file, firestore_collection_name)
-
-    # Dump the counts to json file if `save_to_json` is set.
-    # TODO: Make sure this is not locked if writing from multiple threads.
+        backends.append(
+            storage.register(
+                storage.FirestoreBackend(firestore_key_file, firestore_collection_name),
+                _store,
+                delta=firestore_delta,
+                flush_interval=firestore_flush_interval,
+                flush_after=firestore_flush_after,
+                asynchronous=firestore_async,
+                timeout=firestore_timeout,
+                retries=firestore_retries,
+            )
+        )
     if save_to_json is not None:
-        with Path(save_to_json).open("w") as f:
-            json.dump(counts, f)
-        if verbose:
-            print("Storing results to file:", save_to_json)
+        backends.append(
+            storage.register(
+                storage.JsonBackend(save_to_json),
+                _store,
+                flush_interval=save_to_json_interval,
+            )
+        )
+    # Sessions that aren't sampled didn't change any counts.
+    if getattr(_session, "sampled", True):
+        for backend in backends:
+            saved = storage.save(backend, _store)
+            if verbose:
+                action = "Saved counts to" if saved else "Marked counts to be saved to"
+                print(action, backend.key)
+    if verbose and firestore_key_file:
+        print("Firestore stats:", firestore.stats)
+        print()
+    stats.stop("stop_tracking", start)
 
     # Show analytics results in the streamlit app if `?analytics=on` is set in the URL.
     query_params = st.experimental_get_query_params()
     if "analytics" in query_params and "on" in query_params["analytics"]:
         st.write("---")
-        display.show_results(counts, reset_counts, unsafe_password)
+        start = stats.start()
+        versions, results = _dashboard_counts(backends)
+        # The index and hourly counts in the store don't fit if backends change
+        # what's shown, e.g. to merge counts of other processes.
+        widget_index = hourly = None
+        if all(backend.view_version() is None for backend in backends):
+            widget_index = _store.indexed_widgets()
+            hourly = _store.hourly()
+        display.show_results(
+            results,
+            reset_counts,
+            unsafe_password,
+            versions=versions,
+            widget_index=widget_index,
+            hourly=hourly,
+            sample_rate=getattr(_session, "sample_rate", 1),
+        )
+        stats.stop("dashboard", start)
 
 
 @contextmanager
@@ -413,6 +830,27 @@ def track(
     firestore_collection_name: str = "counts",
     verbose=False,
     load_from_json: Union[str, Path] = None,
+    firestore_flush_interval: float = None,
+    firestore_flush_after: int = None,
+    firestore_delta: bool = False,
+    save_to_json_interval: float = None,
+    load_from_json_check_mtime: bool = False,
+    max_values_per_widget: int = None,
+    numeric_bin_width: float = None,
+    per_day_retention: int = None,
+    per_day_rollup: str = "month",
+    event_log: Union[str, Path] = None,
+    event_log_compact_interval: float = 60,
+    sqlite_file: Union[str, Path] = None,
+    storage_backends: List[storage.StorageBackend] = None,
+    shard_dir: Union[str, Path] = None,
+    shard_ttl: float = 5,
+    session_timeout: float = 30 * 60,
+    firestore_async: bool = False,
+    firestore_timeout: float = 10,
+    firestore_retries: int = 5,
+    per_hour_retention: int = None,
+    sample_rate: float = 1,
 ):
     """
     Context manager to start and stop tracking user inputs to a streamlit app.
@@ -427,6 +865,22 @@ def track(
         firestore_key_file=firestore_key_file,
         firestore_collection_name=firestore_collection_name,
         load_from_json=load_from_json,
+        load_from_json_check_mtime=load_from_json_check_mtime,
+        max_values_per_widget=max_values_per_widget,
+        numeric_bin_width=numeric_bin_width,
+        per_day_retention=per_day_retention,
+        per_day_rollup=per_day_rollup,
+        event_log=event_log,
+        event_log_compact_interval=event_log_compact_interval,
+        sqlite_file=sqlite_file,
+        storage_backends=storage_backends,
+        shard_dir=shard_dir,
+        shard_ttl=shard_ttl,
+        session_timeout=session_timeout,
+        firestore_async=firestore_async,
+        firestore_timeout=firestore_timeout,
+        per_hour_retention=per_hour_retention,
+        sample_rate=sample_rate,
     )
 
     # Yield here to execute the code in the with statement. This will call the wrappers
@@ -438,4 +892,11 @@ def track(
         firestore_key_file=firestore_key_file,
         firestore_collection_name=firestore_collection_name,
         verbose=verbose,
+        firestore_flush_interval=firestore_flush_interval,
+        firestore_flush_after=firestore_flush_after,
+        firestore_delta=firestore_delta,
+        save_to_json_interval=save_to_json_interval,
+        firestore_async=firestore_async,
+        firestore_timeout=firestore_timeout,
+        firestore_retries=firestore_retries,
     )
@@ -0,0 +1,102 @@
+"""
+Sharded counts for apps that run in multiple processes, e.g. replicas behind a load
+balancer.
+
+Each process saves its own counts to a shard file in a shared directory, named after
+host and process id, so processes never overwrite each other. To show the counts of
+the whole app, all shards are summed up. Shards of stopped processes stay in the
+directory, so their counts are kept. Unique visitor sketches are merged by taking the
+highest rank of each register instead, so visitors of multiple processes count once.
+
+Resetting the counts writes a reset file with a new reset id. Each shard stores the
+reset id its process has seen, and only shards with the current reset id are summed
+up. Other processes reset their own counts once they see the new id.
+"""
+
+import json
+import os
+import socket
+import uuid
+from pathlib import Path
+
+from . import json_file
+from .hyperloglog import UniqueVisitors
+from .utils import flatten_counts
+
+RESET_FILE = "reset.json"
+
+
+def shard_path(directory):
+    """Return the path of the shard of this process."""
+    return Path(directory) / f"shard-{socket.gethostname()}-{os.getpid()}.json"
+
+
+def read_reset(directory):
+    """Return reset id and start time of the last reset, or (None, None)."""
+    try:
+        with (Path(directory) / RESET_FILE).open("r") as f:
+            reset = json.load(f)
+    except FileNotFoundError:
+        return None, None
+    return reset["reset_id"], reset["start_time"]
+
+
+def write_reset(directory, start_time):
+    """Mark all shards as reset at `start_time`. Returns the new reset id."""
+    reset_id = uuid.uuid4().hex
+    json_file.save(
+        {"reset_id": reset_id, "start_time": start_time},
+        Path(directory) / RESET_FILE,
+    )
+    return reset_id
+
+
+def load(counts, directory, reset_id):
+    """
+    Load the shard of this process into `counts`, if it has `reset_id`.
+
+    Returns True if anything was loaded.
+    """
+    try:
+        with shard_path(directory).open("r") as f:
+            shard = json.load(f)
+    except FileNotFoundError:
+        return False
+    if shard.get("reset_id") != reset_id:
+        return False
+    for key in shard:
+        if key in counts:
+            counts[key] = shard[key]
+    return True
+
+
+def save(counts, directory, reset_id):
+    """Save `counts` to the shard of this process."""
+    json_file.save(dict(counts, reset_id=reset_id), shard_path(directory))
+
+
+def merge(directory, reset_id, exclude=None):
+    """
+    Sum up all shards in `directory` with `reset_id`, except the one at `exclude`.
+
+    Returns a flat dict of {path: number} (see `utils.flatten_counts`), which also
+    has the registers of the unique visitor sketches (see
+    `hyperloglog.UniqueVisitors.registers`).
+    """
+    flat = {}
+    for path in Path(directory).glob("shard-*.json"):
+        if exclude is not None and path == Path(exclude):
+            continue
+        try:
+            with path.open("r") as f:
+                shard = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue  # shard was removed or is from an incompatible version
+        if shard.get("reset_id") != reset_id:
+            continue
+        for counter, n in flatten_counts(shard).items():
+            flat[counter] = flat.get(counter, 0) + n
+        visitors = UniqueVisitors.from_dict(shard.get("unique_visitors", {}))
+        for register, rank in visitors.registers().items():
+            flat[register] = max(flat.get(register, 0), rank)
+    return flat
@@ -0,0 +1,159 @@
+"""
+Opt-in timing of everything streamlit-analytics does, e.g. to check how much it slows
+down an app.
+
+Call `enable()` to start measuring. Times are collected per phase (e.g.
+"start_tracking", "wrap.selectbox" for the tracking part of a widget call,
+"save.json" or "dashboard") in histograms, which can be read with `get_stats` or
+exported with `prometheus_text`. They are also shown on the dashboard. When
+disabled, measuring costs a function call and an `if` per phase.
+"""
+
+import bisect
+import threading
+import time
+
+# Upper bounds of the histogram buckets in seconds, from 1 microsecond to 10 seconds.
+# One more bucket catches everything above.
+# fmt: off
+BUCKETS = (
+    1e-6, 2.5e-6, 5e-6,
+    1e-5, 2.5e-5, 5e-5,
+    1e-4, 2.5e-4, 5e-4,
+    1e-3, 2.5e-3, 5e-3,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0,
+    10.0,
+)
+# fmt: on
+
+enabled = False
+
+# Histograms by phase.
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+class Histogram:
+    """Number of measurements per bucket (see `BUCKETS`), plus their count and sum."""
+
+    __slots__ = ("buckets", "count", "sum", "_lock")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def snapshot(self):
+        """Return a consistent copy of (buckets, count, sum)."""
+        with self._lock:
+            return list(self.buckets), self.count, self.sum
+
+
+def _quantile(buckets, count, q):
+    """Return the upper bound of the bucket that contains quantile `q`."""
+    if not count:
+        return None
+    seen = 0
+    for bound, n in zip(BUCKETS + (float("inf"),), buckets):
+        seen += n
+        if seen >= q * count:
+            return bound
+
+
+def enable():
+    """Start measuring."""
+    global enabled
+    enabled = True
+
+
+def disable():
+    """Stop measuring. Measurements so far are kept."""
+    global enabled
+    enabled = False
+
+
+def clear():
+    """Forget all measurements."""
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def start():
+    """Return the start time of a measurement, or None if disabled."""
+    if enabled:
+        return time.perf_counter()
+    return None
+
+
+def stop(phase, start_time):
+    """Record the time since `start_time` (from `start`) for `phase`."""
+    if start_time is None:
+        return
+    seconds = time.perf_counter() - start_time
+    histogram = _histograms.get(phase)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(phase, Histogram())
+    histogram.observe(seconds)
+
+
+def get_stats():
+    """
+    Return all measurements by phase.
+
+    For each phase, this is a dict with the number of measurements ("count"), the
+    total and mean time ("sum_seconds", "mean_seconds"), the upper bounds of the
+    buckets with the median and 99th percentile ("p50_seconds", "p99_seconds"), and
+    the number of measurements up to each bucket bound ("buckets", cumulative like in
+    Prometheus).
+    """
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    results = {}
+    for phase, histogram in sorted(histograms.items()):
+        buckets, count, total = histogram.snapshot()
+        cumulative = {}
+        seen = 0
+        for bound, n in zip(BUCKETS + (float("inf"),), buckets):
+            seen += n
+            cumulative[bound] = seen
+        results[phase] = {
+            "count": count,
+            "sum_seconds": total,
+            "mean_seconds": total / count if count else None,
+            "p50_seconds": _quantile(buckets, count, 0.5),
+            "p99_seconds": _quantile(buckets, count, 0.99),
+            "buckets": cumulative,
+        }
+    return results
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text():
+    """Return all measurements in the Prometheus text format, as one histogram."""
+    name = "streamlit_analytics_seconds"
+    lines = [
+        f"# HELP {name} Time spent in streamlit-analytics, by phase.",
+        f"# TYPE {name} histogram",
+    ]
+    for phase, phase_stats in get_stats().items():
+        label = f'phase="{_escape(phase)}"'
+        for bound, n in phase_stats["buckets"].items():
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{name}_bucket{{{label},le="{le}"}} {n}')
+        lines.append(f"{name}_sum{{{label}}} {phase_stats['sum_seconds']!r}")
+        lines.append(f"{name}_count{{{label}}} {phase_stats['count']}")
+    return "\n".join(lines) + "\n"
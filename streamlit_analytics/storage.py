@@ -0,0 +1,768 @@
+"""
+Storage backends that persist counts, e.g. to a json file, firestore or sqlite.
+"""
+
+import atexit
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import traceback
+
+from . import eventlog, firestore, flusher, json_file, shards, stats
+from .hyperloglog import UniqueVisitors
+from .utils import add_counts, empty_counts, flatten_counts, readable_path
+
+
+class StorageBackend:
+    """
+    Base class for places to persist counts to.
+
+    All methods are optional. A backend gets the counts in one (or more) of these ways:
+    - `flush` with a snapshot of all counts, e.g. to write them to a file. This is
+      skipped if `uses_snapshot` is False (by default if `uses_delta` is True).
+    - `apply_delta` with the changes since the last flush, if `uses_delta` is True.
+      This is cheaper if only few counters change between flushes.
+    - `record` on every single change, if `records_changes` is True.
+
+    Flushes happen at the end of every script run, or from a background thread every
+    `flush_interval` seconds / after `flush_after` script runs, if one of them is set.
+    Only one backend per `key` is used per process (see `register`), so backends can
+    be created on every script run. Creating one should therefore be cheap, e.g.
+    connect on first use.
+    """
+
+    uses_delta = False
+    records_changes = False
+    flush_interval = None
+    flush_after = None
+
+    def __new__(cls, *args, **kwargs):
+        backend = super().__new__(cls)
+        # For the default `key`.
+        backend._args = (args, sorted(kwargs.items()))
+        return backend
+
+    @property
+    def key(self):
+        """
+        Identifies where this backend stores data.
+
+        Defaults to the class and the arguments it was created with, so a backend that
+        is created with the same arguments on every script run is only used once.
+        """
+        cls = type(self)
+        return (cls.__name__, cls.__module__, repr(self._args))
+
+    def load(self, counts):
+        """Load persisted counts into `counts`. Returns True if anything was loaded."""
+        return False
+
+    def needs_load(self):
+        """Whether `load` should be called (again) before the next script run."""
+        return False
+
+    def fetch(self):
+        """
+        Called before `load`, without blocking changes to the counts, e.g. to get data
+        over the network. Returns False if `load` shouldn't be called yet.
+        """
+        return True
+
+    @property
+    def uses_snapshot(self):
+        """Whether `flush` needs a snapshot of all counts, which takes a while."""
+        return not self.uses_delta
+
+    def can_flush(self):
+        """Whether to flush now. If not, changes are kept for a later flush."""
+        return True
+
+    def finish_load(self):
+        """Called at exit if `can_flush` is False, e.g. to wait for a pending load."""
+
+    def apply_delta(self, delta):
+        """Apply changes since the last flush, as {path: change} (see `DeltaBuffer`)."""
+
+    def record(self, path, amount):
+        """Called whenever `amount` is added to the counter at `path`."""
+
+    def flush(self, counts):
+        """Persist `counts`, a snapshot of all counts (or None, see `uses_snapshot`)."""
+
+    def view(self, counts):
+        """Return the counts to show in the dashboard, given the counts in memory."""
+        return counts
+
+    def view_version(self):
+        """Something that changes whenever `view` would return different counts."""
+        return None
+
+    def close(self):
+        """Release all resources, e.g. at exit."""
+
+
+class DeltaBuffer:
+    """
+    Collects the changes to all counters between two flushes.
+
+    Changes are stored as {path: change}, with paths like in `utils.flatten_counts`.
+    If counts were reset, the buffer only contains the changes after the reset, plus
+    the key ("reset", start time). Registers of unique visitor sketches keep their
+    highest rank instead of a sum (see `CounterStore.add_visitor`).
+    """
+
+    def __init__(self):
+        self._delta = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, path, amount):
+        with self._lock:
+            if path[0] == "reset":
+                self._delta = {path: 0}
+            else:
+                self._add(path, amount)
+
+    def _add(self, path, amount):
+        if path[0] == "unique_visitors":
+            self._delta[path] = max(self._delta.get(path, 0), amount)
+        else:
+            self._delta[path] = self._delta.get(path, 0) + amount
+
+    def peek(self):
+        """Return a copy of all changes since the last `take`."""
+        with self._lock:
+            return dict(self._delta)
+
+    def take(self):
+        """Return all changes since the last call and start collecting anew."""
+        with self._lock:
+            delta, self._delta = self._delta, {}
+        return delta
+
+    def restore(self, delta):
+        """Put back changes from `take`, e.g. because they couldn't be saved."""
+        with self._lock:
+            if any(path[0] == "reset" for path in self._delta):
+                return  # counts were reset in the meantime, old changes don't matter
+            for path, amount in delta.items():
+                self._add(path, amount)
+
+
+class JsonBackend(StorageBackend):
+    """
+    Stores counts in a json file, see `json_file.py`.
+
+    If `check_mtime` is True, the file is loaded again (and merged) whenever another
+    process modified it.
+    """
+
+    def __init__(self, path, check_mtime=False, flush_interval=None):
+        self.path = path
+        self.check_mtime = check_mtime
+        self.flush_interval = flush_interval
+
+    @property
+    def key(self):
+        return ("json", os.path.abspath(self.path))
+
+    def needs_load(self):
+        return json_file.needs_load(self.path, self.check_mtime)
+
+    def load(self, counts):
+        return json_file.load_once(counts, self.path, check_mtime=self.check_mtime)
+
+    def flush(self, counts):
+        json_file.save(counts, self.path, check_mtime=self.check_mtime)
+
+
+class FirestoreBackend(StorageBackend):
+    """
+    Stores counts in a firestore document, see `firestore.py`.
+
+    If `delta` is True, only the changes since the last flush are sent, as increments
+    (see `firestore.delta_write`). Otherwise, each flush overwrites the document with
+    all counts.
+
+    If `asynchronous` is True, saves are queued and sent from a background event loop
+    with firestore's AsyncClient, see `async_firestore.py`. Loading doesn't wait for
+    firestore either: The document is fetched in the background and put into the
+    counts by a later script run, once it arrived. If firestore doesn't answer within
+    `timeout` seconds, fetching is tried again later, waiting longer after each
+    failure. Nothing is saved until counts were loaded, so firestore isn't
+    overwritten. What was counted in the meantime is added to the loaded counts. At
+    exit, the document is waited for, so these counts are still saved. If it doesn't
+    arrive, delta saves add all counts to firestore instead.
+    """
+
+    # Changes are collected even if `delta` is off, as it's usually only turned on by
+    # the settings of `stop_tracking`, after the first changes were made.
+    uses_delta = True
+
+    def __init__(
+        self,
+        key_file,
+        collection_name="counts",
+        delta=False,
+        flush_interval=None,
+        flush_after=None,
+        asynchronous=False,
+        timeout=10,
+        retries=5,
+        backoff=0.5,
+    ):
+        self.key_file = key_file
+        self.collection_name = collection_name
+        self.delta = delta
+        self.flush_interval = flush_interval
+        self.flush_after = flush_after
+        self.asynchronous = asynchronous
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._loaded = False
+        self._load_failures = 0
+        self._next_load = 0.0
+        self._fetch_lock = threading.Lock()
+        self._fetching = None  # future of the document, if `asynchronous`
+        self._fetched = None  # (document,) until `load` puts it into the counts
+        self._closing = False
+        # Whether firestore has all our counts, apart from the changes since the last
+        # flush, i.e. whether delta saves can just send the changes.
+        self._synced = False
+
+    @property
+    def key(self):
+        return ("firestore", os.path.abspath(self.key_file), self.collection_name)
+
+    @property
+    def uses_snapshot(self):
+        return not (self.delta and self._synced)
+
+    def needs_load(self):
+        return not self._loaded and time.monotonic() >= self._next_load
+
+    def can_flush(self):
+        # Adding all counts is fine without loading, overwriting firestore isn't. Only
+        # at exit though, otherwise the document that arrives later counts them twice.
+        return self._loaded or not self.asynchronous or (self._closing and self.delta)
+
+    def finish_load(self):
+        if not self.asynchronous:
+            return
+        from . import async_firestore
+
+        with self._fetch_lock:
+            if self._fetched is None and self._fetching is None:
+                self._fetching = async_firestore.fetch(
+                    self.key_file, self.collection_name, timeout=self.timeout
+                )
+            fetching = self._fetching
+        if fetching is not None:
+            concurrent.futures.wait([fetching], timeout=self.timeout)
+        self._next_load = 0.0
+        self._closing = True
+
+    def fetch(self):
+        with self._fetch_lock:
+            if self._fetched is not None:
+                return True
+            if not self.asynchronous:
+                self._fetched = (firestore.fetch(self.key_file, self.collection_name),)
+                return True
+
+            from . import async_firestore
+
+            if self._fetching is None:
+                self._fetching = async_firestore.fetch(
+                    self.key_file, self.collection_name, timeout=self.timeout
+                )
+            if not self._fetching.done():
+                return False
+            future, self._fetching = self._fetching, None
+            try:
+                self._fetched = (future.result(),)
+            except Exception:
+                traceback.print_exc()
+                # Don't ask firestore on every script run while it's down.
+                self._next_load = time.monotonic() + min(
+                    async_firestore.MAX_BACKOFF, self.backoff * 2**self._load_failures
+                )
+                self._load_failures += 1
+                return False
+            return True
+
+    def load(self, counts):
+        with self._fetch_lock:
+            fetched, self._fetched = self._fetched, None
+        if fetched is None:
+            return False
+        found = firestore.apply_loaded(counts, fetched[0])
+        counts["loaded_from_firestore"] = True
+        self._loaded = True
+        # If there's no document yet, the first delta save adds all counts.
+        self._synced = found
+        return found
+
+    def apply_delta(self, delta):
+        # Otherwise, `flush` sends all counts.
+        if self.delta and self._synced:
+            self._send(firestore.delta_write(delta))
+
+    def flush(self, counts):
+        if counts is None:
+            return
+        if not self.delta:
+            self._send((counts, False))
+        else:
+            # Nothing was loaded, so add all our counts to what's in firestore.
+            self._send(firestore.add_all_write(counts))
+            self._synced = True
+
+    def _send(self, write):
+        if write is None:
+            return
+        if self.asynchronous:
+            from . import async_firestore
+
+            async_firestore.send(
+                write,
+                self.key_file,
+                self.collection_name,
+                timeout=self.timeout,
+                retries=self.retries,
+                backoff=self.backoff,
+            )
+        else:
+            firestore.send(write, self.key_file, self.collection_name)
+
+    def close(self):
+        if self.asynchronous:
+            from . import async_firestore
+
+            async_firestore.close(timeout=self.timeout * (self.retries + 1))
+
+
+class EventLogBackend(StorageBackend):
+    """
+    Appends every change to a log file, see `eventlog.py`.
+
+    Flushing compacts the log, so this should only happen every few seconds.
+    """
+
+    records_changes = True
+
+    def __init__(self, path, compact_interval=60):
+        self.path = path
+        self.flush_interval = compact_interval
+        self._log = eventlog.EventLog(path)
+        self._loaded = False
+
+    @property
+    def key(self):
+        return ("event_log", os.path.abspath(self.path))
+
+    def needs_load(self):
+        return not self._loaded
+
+    def load(self, counts):
+        self._log.load(counts)
+        self._loaded = True
+        return True
+
+    def record(self, path, amount):
+        self._log.append(path, amount)
+
+    def flush(self, counts):
+        self._log.compact()
+
+    def close(self):
+        self._log.compact()
+        self._log.close()
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Stores counts in a sqlite database, one row per counter.
+
+    Flushing only adds the changes to each row (`count = count + ?`), so multiple
+    processes on one machine can share the same database without overwriting each
+    other's counts. Unique visitor sketches are stored as one row per register, which
+    keeps the highest rank (`count = max(count, ?)`). The database uses write-ahead
+    logging, so reading and writing from multiple processes at once is fine.
+    """
+
+    uses_delta = True
+
+    def __init__(self, path, flush_interval=None, flush_after=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_after = flush_after
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        """Return the connection to the database, opening it if needed."""
+        if self._conn is None:
+            import sqlite3
+
+            conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS counts "
+                    "(path TEXT PRIMARY KEY, count REAL NOT NULL)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+                )
+            self._conn = conn
+        return self._conn
+
+    @property
+    def key(self):
+        return ("sqlite", os.path.abspath(self.path))
+
+    def needs_load(self):
+        return not self._loaded
+
+    def load(self, counts):
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute("SELECT path, count FROM counts").fetchall()
+            start_time = conn.execute(
+                "SELECT value FROM meta WHERE key = 'start_time'"
+            ).fetchone()
+            if start_time is None:
+                with conn:
+                    conn.execute(
+                        "INSERT INTO meta VALUES ('start_time', ?)",
+                        (counts["start_time"],),
+                    )
+        self._loaded = True
+        if start_time is None and not rows:
+            return False
+
+        if start_time is not None:
+            counts["start_time"] = start_time[0]
+        loaded = empty_counts(counts["start_time"])
+        add_counts(
+            loaded,
+            {
+                tuple(json.loads(path)): int(count) if count.is_integer() else count
+                for path, count in rows
+            },
+        )
+        for key in loaded:
+            if key in counts:
+                counts[key] = loaded[key]
+        return True
+
+    def apply_delta(self, delta):
+        rows = []
+        register_rows = []
+        dropped_days = []
+        reset_start_time = None
+        for path, amount in delta.items():
+            if path[0] == "reset":
+                reset_start_time = path[1]
+                continue
+            path = readable_path(path)
+            if path[0] == "unique_visitors" and len(path) == 2:
+                # Matches the rows of all registers of that day.
+                dropped_days.append((json.dumps(list(path))[:-1] + ", %",))
+                continue
+            if not amount:
+                continue  # e.g. an hour that was counted and rolled up since
+            row = (json.dumps(path, default=str), amount)
+            (register_rows if path[0] == "unique_visitors" else rows).append(row)
+
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                if reset_start_time is not None:
+                    conn.execute("DELETE FROM counts")
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta VALUES ('start_time', ?)",
+                        (reset_start_time,),
+                    )
+                conn.executemany(
+                    "INSERT INTO counts (path, count) VALUES (?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET count = count + excluded.count",
+                    rows,
+                )
+                conn.executemany(
+                    "INSERT INTO counts (path, count) VALUES (?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET "
+                    "count = max(count, excluded.count)",
+                    register_rows,
+                )
+                conn.executemany("DELETE FROM counts WHERE path LIKE ?", dropped_days)
+                if any(amount < 0 for _, amount in rows):
+                    # E.g. hours that were rolled up, so the table doesn't keep growing.
+                    conn.execute("DELETE FROM counts WHERE count = 0")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class ShardedBackend(StorageBackend):
+    """
+    Saves the counts of this process to its own file in a shared directory.
+
+    Use this if the app runs in multiple processes (e.g. replicas behind a load
+    balancer). The dashboard shows the sum of all shards, and resetting the counts
+    resets all shards, see `shards.py`. Shards of other processes and resets done by
+    them are read at most every `ttl` seconds.
+    """
+
+    records_changes = True
+
+    def __init__(self, directory, ttl=5, flush_interval=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._loaded = False
+        self._lock = threading.Lock()
+        # Reset id of the counts in this process, the last one read from the reset
+        # file (with its start time) and when to read it again.
+        self._reset_id = None
+        self._last_reset = (None, None)
+        self._next_reset_check = 0
+        # Merged shards of other processes as (expiry time, reset id, flat counts).
+        self._others = None
+
+    @property
+    def key(self):
+        return ("shards", os.path.abspath(self.directory))
+
+    def _read_reset(self):
+        now = time.monotonic()
+        if now >= self._next_reset_check:
+            self._last_reset = shards.read_reset(self.directory)
+            self._next_reset_check = now + self.ttl
+        return self._last_reset
+
+    def needs_load(self):
+        return not self._loaded or self._read_reset()[0] != self._reset_id
+
+    def load(self, counts):
+        os.makedirs(self.directory, exist_ok=True)
+        reset_id, start_time = self._read_reset()
+        first_load = not self._loaded
+        self._loaded = True
+        self._reset_id = reset_id
+        if first_load:
+            # Continue with our shard if there is one, e.g. because the app restarted
+            # with the same pid (common in containers).
+            if reset_id is not None:
+                counts["start_time"] = start_time
+            return shards.load(counts, self.directory, reset_id)
+        # Another process reset the counts.
+        for key, value in empty_counts(start_time).items():
+            if key in counts:
+                counts[key] = value
+        return True
+
+    def record(self, path, amount):
+        if path[0] != "reset":
+            return
+        reset_id = shards.write_reset(self.directory, path[1])
+        with self._lock:
+            self._reset_id = reset_id
+            self._last_reset = (reset_id, path[1])
+            self._others = None
+
+    def flush(self, counts):
+        shards.save(counts, self.directory, self._reset_id)
+
+    def view_version(self):
+        return self._reset_id, int(time.monotonic() // self.ttl)
+
+    def view(self, counts):
+        with self._lock:
+            if (
+                self._others is None
+                or self._others[1] != self._reset_id
+                or time.monotonic() >= self._others[0]
+            ):
+                flat = shards.merge(
+                    self.directory,
+                    self._reset_id,
+                    exclude=shards.shard_path(self.directory),
+                )
+                self._others = (time.monotonic() + self.ttl, self._reset_id, flat)
+            others = self._others[2]
+        merged = empty_counts(counts.get("start_time"))
+        merged["unique_visitors"] = counts.get("unique_visitors", {})
+        add_counts(merged, flatten_counts(counts))
+        add_counts(merged, others)
+        return merged
+
+
+# Backends in use in this process, by key, the stores they're used with, the buffers
+# with their changes, the listeners added to the stores, and locks so only one
+# snapshot per backend is taken and flushed at a time.
+_backends = {}
+_stores = {}
+_buffers = {}
+_listeners = {}
+_flush_locks = {}
+_backends_lock = threading.Lock()
+
+
+def register(backend, store, **settings):
+    """
+    Start using `backend` with `store`, i.e. send all changes in `store` to it.
+
+    Returns the backend that is actually used: If another backend with the same key
+    is already in use, that one is kept. `settings` (e.g. `flush_interval=10`) are
+    then set as attributes on it, and used from the next `save` on.
+    """
+    key = backend.key
+    registered = _backends.get(key)
+    if registered is None:
+        with _backends_lock:
+            if key not in _backends:
+                listeners = []
+                if backend.uses_delta:
+                    _buffers[key] = DeltaBuffer()
+                    listeners.append(_buffers[key])
+                if backend.records_changes:
+                    listeners.append(backend.record)
+                store.listeners.extend(listeners)
+                _listeners[key] = listeners
+                _flush_locks[key] = threading.Lock()
+                _stores[key] = store
+                _backends[key] = backend
+            registered = _backends[key]
+    for name, value in settings.items():
+        setattr(registered, name, value)
+    return registered
+
+
+def load(backend, store):
+    """
+    Load counts from `backend` into `store`, if needed. Returns True if loaded.
+
+    Changes that weren't flushed to the backend yet are added to the loaded counts.
+    """
+    # Slow work happens here, so other users can keep counting in the meantime.
+    if not backend.needs_load() or not backend.fetch():
+        return False
+    with store.lock_all():
+        # Check again, another user might have loaded while we waited.
+        if not backend.needs_load():
+            return False
+        buffer = _buffers.get(backend.key)
+        unsaved = buffer.peek() if buffer is not None else {}
+        before = dict(store.data)
+        visitors = store.data.get("unique_visitors")
+        start_time = store.data.get("start_time")
+        loaded = backend.load(store.data)
+        if loaded and any(path[0] == "reset" for path in unsaved):
+            # The next flush overwrites what was loaded with the reset counts.
+            store.data.update(before)
+            loaded = False
+        elif loaded and unsaved:
+            add_counts(
+                store.data, {readable_path(path): n for path, n in unsaved.items()}
+            )
+        if (
+            visitors
+            and store.data.get("unique_visitors") is not visitors
+            and store.data.get("start_time") == start_time
+        ):
+            # Sketches can't be added up like counters, so backends just replace them.
+            # Merge back the visitors we had, as long as counts weren't reset.
+            merged = UniqueVisitors.load(store.data["unique_visitors"])
+            merged.merge(UniqueVisitors.load(visitors))
+            store.data["unique_visitors"] = merged
+        store.changed()
+        return loaded
+
+
+def _flush(backend, store):
+    start = stats.start()
+    lock = _flush_locks.get(backend.key)
+    if lock is None:
+        return  # closed by `close_all`
+    # Otherwise, an older snapshot could be flushed after a newer one and overwrite it.
+    with lock:
+        if not backend.can_flush():
+            return
+        buffer = _buffers.get(backend.key)
+        delta = buffer.take() if buffer is not None else None
+        try:
+            if delta:
+                backend.apply_delta(delta)
+            backend.flush(store.snapshot() if backend.uses_snapshot else None)
+        except Exception:
+            if delta:
+                buffer.restore(delta)
+            raise
+    stats.stop(f"save.{backend.key[0]}", start)
+
+
+def save(backend, store):
+    """
+    Save the counts in `store` to `backend`.
+
+    This happens right away, or from a background thread if the backend has a
+    `flush_interval` or `flush_after`. Returns True if it happened right away.
+    """
+    key = ("backend",) + backend.key
+    if backend.flush_interval is None and backend.flush_after is None:
+        # In case both were set before, there's no need for the thread anymore.
+        flusher.stop(key)
+        _flush(backend, store)
+        return True
+    flusher.get(
+        key,
+        lambda: _flush(backend, store),
+        interval=backend.flush_interval,
+        max_dirty=backend.flush_after,
+    ).mark_dirty()
+    return False
+
+
+@atexit.register
+def close_all():
+    """Close all backends, e.g. at exit."""
+    # Save what the background flushers still have, before the backends are closed.
+    flusher.stop_all()
+    with _backends_lock:
+        backends = list(_backends.values())
+    for backend in backends:
+        if backend.can_flush():
+            continue
+        # E.g. the app exits before the counts were loaded, which happens in a later
+        # script run. Load them now, so what was counted until here isn't lost.
+        store = _stores[backend.key]
+        try:
+            backend.finish_load()
+            load(backend, store)
+            _flush(backend, store)
+        except Exception:
+            traceback.print_exc()
+        if not backend.can_flush():
+            print(f"Couldn't load counts from {backend.key[0]}, so they weren't saved")
+    with _backends_lock:
+        # Otherwise, stores keep sending changes to the closed backends.
+        for key, listeners in _listeners.items():
+            store = _stores[key]
+            store.listeners = [
+                listener for listener in store.listeners if listener not in listeners
+            ]
+        _backends.clear()
+        _stores.clear()
+        _buffers.clear()
+        _listeners.clear()
+        _flush_locks.clear()
+    for backend in backends:
+        backend.close()
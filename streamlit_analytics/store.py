@@ -0,0 +1,332 @@
+"""
+Thread-safe storage for the counts dict, which is shared by all users of an app.
+"""
+
+import copy
+import itertools
+import threading
+from contextlib import contextmanager
+
+from .hyperloglog import UniqueVisitors
+from .timeseries import DailyCounts, TimeBuckets, parse_day, period_of
+from .utils import BUCKETS, add_counts
+from .widget_counts import WidgetCounts
+from .widget_index import WidgetIndex
+
+# Key that collects the counts of rare values once a widget has too many of them.
+OTHER = "(other values)"
+
+# Keys in `data` that are kept as objects instead of plain dicts, see `snapshot`.
+_LIVE_KEYS = ("per_day", "widgets", "unique_visitors") + tuple(BUCKETS)
+
+
+class CounterStore:
+    """
+    Wraps the `counts` dict so multiple threads can increment counters at once.
+
+    Streamlit runs each user session in its own thread, and read-modify-writes like
+    `counts["total_script_runs"] += 1` lose updates when they overlap. The store
+    guards every counter with one of `num_stripes` locks (picked by widget label or
+    top-level key), so sessions only wait for each other if they touch the same
+    counter. `data` keeps the usual dict shape and can be read directly, except for
+    "per_day", "widgets", the hourly counts and "unique_visitors", which are kept as
+    `timeseries.DailyCounts`, `widget_counts.WidgetCounts`, `timeseries.TimeBuckets`
+    and `hyperloglog.UniqueVisitors` (use `snapshot` to get plain dicts). `versions`
+    holds a number for each top-level key that changes whenever the counts under that
+    key change, e.g. to cache things computed from them.
+    """
+
+    def __init__(self, data, num_stripes=32):
+        self.data = data
+        self._stripes = [threading.Lock() for _ in range(num_stripes)]
+        # If set, only keep this many days in "per_day" and add older days to
+        # "rolled_up", summed per `rollup` period ("week" or "month").
+        self.retention_days = None
+        self.rollup = "month"
+        # If set, only keep this many hours in "per_hour" and add older hours to
+        # "per_hour_rolled_up", summed per day (and kept for `retention_days`).
+        self.retention_hours = None
+        # Functions that get called with (path, amount) on every increment, e.g. to
+        # log all interactions.
+        self.listeners = []
+        # How much the count of each value tracked by `incr_top` may be too high:
+        # {label: {value: overcount}}. Only kept in memory.
+        self._overcounts = {}
+        self._convert_lock = threading.Lock()
+        self._next_version = itertools.count(1)
+        self.versions = {}
+        # Flat index of "widgets", updated along with it. Use `indexed_widgets`.
+        self.widget_index = WidgetIndex()
+
+    def changed(self, *keys):
+        """Update `versions` of `keys` (default: all), e.g. after changing `data`."""
+        # Each call gets a new number, so a version never goes back to a value someone
+        # has already seen, even if threads assign it out of order.
+        version = next(self._next_version)
+        for key in keys or list(self.data):
+            self.versions[key] = version
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def incr(self, path, amount=1):
+        """
+        Add `amount` to the counter at `path`.
+
+        Paths are tuples like in `utils.flatten_counts`, e.g. ("total_pageviews",),
+        ("per_day", "2021-06-01", "pageviews"), ("widgets", label, option) or
+        ("per_hour", "2021-06-01 13:00", "widgets", label, option). Days and hours may
+        also be ordinals (see `timeseries.hour_of`), which is faster.
+        """
+        kind = path[0]
+        changes = ()
+        if kind == "widgets":
+            with self._stripe(path[1]):
+                widgets = self._widgets()
+                i = widgets.incr(path[1], path[2] if len(path) > 2 else None, amount)
+                self.widget_index.add(widgets, i, amount)
+        elif kind == "per_day":
+            with self._stripe("per_day"):
+                per_day = self._per_day()
+                per_day.incr(parse_day(path[1]), path[2], amount)
+                if self.retention_days is not None:
+                    dropped = per_day.trim(self.retention_days)
+                    if dropped:
+                        changes = self._roll_up(dropped)
+                        self.changed("rolled_up")
+        elif kind in BUCKETS:
+            with self._stripe("per_hour"):
+                buckets = self._buckets(kind)
+                buckets.incr(buckets.parse(path[1]), path[2:], amount)
+                if kind == "per_hour" and self.retention_hours is not None:
+                    dropped = buckets.trim(self.retention_hours)
+                    if dropped:
+                        changes = self._roll_up_hours(dropped)
+                        self.changed("per_hour_rolled_up")
+        else:
+            with self._stripe(kind):
+                self.data[kind] = self.data.get(kind, 0) + amount
+        self.changed(kind)
+        if self.listeners:
+            for change_path, change in changes:
+                self.emit(change_path, change)
+            self.emit(path, amount)
+
+    def emit(self, path, amount):
+        """Call all listeners, e.g. for changes that don't go through `incr`."""
+        for listener in self.listeners:
+            listener(path, amount)
+
+    def _per_day(self):
+        """Return "per_day" as `DailyCounts`, converting it if it was just loaded."""
+        per_day = self.data["per_day"]
+        if isinstance(per_day, dict):
+            per_day = self.data["per_day"] = DailyCounts.from_dict(per_day)
+        return per_day
+
+    def _widgets(self):
+        """Return "widgets" as `WidgetCounts`, converting it if it was just loaded."""
+        widgets = self.data["widgets"]
+        if isinstance(widgets, dict):
+            # Threads hold different stripes here, so only one of them may convert.
+            with self._convert_lock:
+                widgets = self.data["widgets"]
+                if isinstance(widgets, dict):
+                    widgets = self.data["widgets"] = WidgetCounts.from_dict(widgets)
+        return widgets
+
+    def _buckets(self, key):
+        """Return hourly/daily counts as `TimeBuckets`, converting them if needed."""
+        buckets = self.data.get(key)
+        if not isinstance(buckets, TimeBuckets):
+            buckets = TimeBuckets.from_dict(buckets or {}, BUCKETS[key])
+            self.data[key] = buckets
+        return buckets
+
+    def hourly(self):
+        """Return "per_hour" and "per_hour_rolled_up" as `TimeBuckets`."""
+        with self._stripe("per_hour"):
+            return self._buckets("per_hour"), self._buckets("per_hour_rolled_up")
+
+    def _roll_up_hours(self, hours):
+        """
+        Add hours that were dropped from "per_hour" to "per_hour_rolled_up", and drop
+        days from there that are older than `retention_days`.
+
+        Returns all changes as [(path, change)], so they can be sent to listeners.
+        """
+        days = self._buckets("per_hour_rolled_up")
+        changes = []
+        for hour, bucket in hours.items():
+            for counter, n in bucket.items():
+                days.incr(hour // 24, counter, n)
+                changes.append((("per_hour", hour) + counter, -n))
+                changes.append((("per_hour_rolled_up", hour // 24) + counter, n))
+        if self.retention_days is not None:
+            for day, bucket in days.trim(self.retention_days).items():
+                for counter, n in bucket.items():
+                    changes.append((("per_hour_rolled_up", day) + counter, -n))
+        return changes
+
+    def _roll_up(self, days):
+        """
+        Add counts of days that were dropped from "per_day" to "rolled_up".
+
+        Returns all changes as [(path, change)], so they can be sent to listeners.
+        """
+        flat = {}
+        changes = []
+        for day, day_counts in days.items():
+            period = period_of(day, self.rollup)
+            for key, n in day_counts.items():
+                path = ("rolled_up", period, key)
+                flat[path] = flat.get(path, 0) + n
+                if n:
+                    changes.append((("per_day", day, key), -n))
+        add_counts(self.data, flat)
+        return changes + [(path, n) for path, n in flat.items() if n]
+
+    def _visitors(self):
+        """Return "unique_visitors" as `UniqueVisitors`, converting it if needed."""
+        visitors = self.data.get("unique_visitors")
+        if not isinstance(visitors, UniqueVisitors):
+            visitors = self.data["unique_visitors"] = UniqueVisitors.load(visitors)
+        return visitors
+
+    def add_visitor(self, day, h):
+        """
+        Add the visitor with hash `h` (64 bits) to the unique visitors of `day` and of
+        all time.
+
+        Sketches aren't counters, so listeners don't get increments but the new rank of
+        each changed register, at paths like ("unique_visitors", day, register), and
+        amount 0 at ("unique_visitors", day) for days that were dropped (see
+        `UniqueVisitors.apply`).
+        """
+        with self._stripe("unique_visitors"):
+            visitors = self._visitors()
+            changes = visitors.add(day, h)
+            dropped = visitors.trim() if changes else []
+        if not changes:
+            return
+        self.changed("unique_visitors")
+        if self.listeners:
+            for key, i, rank in changes:
+                self.emit(("unique_visitors", key, i), rank)
+            for dropped_day in dropped:
+                self.emit(("unique_visitors", dropped_day), 0)
+
+    def incr_top(self, label, value, max_values, amount=1):
+        """
+        Add `amount` to the counter of `value`, keeping at most `max_values` values.
+
+        This uses the Space-Saving algorithm, so frequent values are kept even if they
+        show up late: If the widget already has `max_values` values, the one with the
+        lowest (estimated) count is evicted and its count goes to the `OTHER` bucket.
+        The new value then inherits that estimate as possible overcount. Counts in the
+        dict always add up to the number of interactions.
+        """
+        changes = []
+        with self._stripe(label):
+            widgets = self._widgets()
+            ids = widgets.option_ids(label)
+            counts = widgets.counts
+            overcounts = self._overcounts.setdefault(label, {})
+            if value not in ids:
+                overcount = 0
+                while len(ids) - (OTHER in ids) >= max_values:
+                    evicted = min(
+                        (v for v in ids if v != OTHER),
+                        key=lambda v: counts[ids[v]] + overcounts.get(v, 0),
+                    )
+                    evicted_count = counts[ids[evicted]]
+                    # Remove from the index first, the id may be reused right away.
+                    self.widget_index.remove(widgets, ids[evicted])
+                    widgets.remove(label, evicted)
+                    other = widgets.incr(label, OTHER, evicted_count)
+                    self.widget_index.add(widgets, other, evicted_count)
+                    overcount = evicted_count + overcounts.pop(evicted, 0)
+                    changes.append((("widgets", label, evicted), -evicted_count))
+                    changes.append((("widgets", label, OTHER), evicted_count))
+                if overcount:
+                    overcounts[value] = overcount
+            i = widgets.incr(label, value, amount)
+            self.widget_index.add(widgets, i, amount)
+        self.changed("widgets")
+        if self.listeners:
+            # Evictions are sent as changes too, so listeners that add up changes
+            # (e.g. `storage.DeltaBuffer`) end up with the same counts.
+            for path, change in changes:
+                self.emit(path, change)
+            self.emit(("widgets", label, value), amount)
+
+    def clear_overcounts(self):
+        """Forget the estimates of `incr_top`, e.g. after resetting the counts."""
+        self._overcounts.clear()
+
+    def register(self, label, options=None):
+        """
+        Make sure there's a counter for widget `label`, starting at 0.
+
+        If `options` is given, the widget gets a dict with a counter for each option
+        instead.
+        """
+        widgets = self._widgets()
+        if options is None:
+            if widgets.id(label) is None:
+                with self._stripe(label):
+                    if widgets.id(label) is None:
+                        self.widget_index.add(widgets, widgets.add(label), 0)
+                self.changed("widgets")
+            return
+        ids = widgets.ids.get(label)
+        if ids is not None and all(option in ids for option in options):
+            return
+        with self._stripe(label):
+            ids = widgets.option_ids(label)
+            for option in options:
+                if option not in ids:
+                    self.widget_index.add(widgets, widgets.add(label, option), 0)
+        self.changed("widgets")
+
+    def indexed_widgets(self):
+        """Return `widget_index`, building it first if "widgets" was replaced."""
+        if self.widget_index.source is not self._widgets():
+            with self.lock_all():
+                if self.widget_index.source is not self._widgets():
+                    self.widget_index.build(self._widgets())
+        return self.widget_index
+
+    @contextmanager
+    def lock_all(self):
+        """Block all changes, e.g. to load or reset the whole dict."""
+        for lock in self._stripes:
+            lock.acquire()
+        try:
+            yield self.data
+        finally:
+            for lock in reversed(self._stripes):
+                lock.release()
+
+    def snapshot(self, keys=None):
+        """
+        Return a consistent deep copy of the counts as plain dict, e.g. to save it.
+
+        If `keys` is given, only these top-level keys are copied.
+        """
+        with self.lock_all():
+            data = {
+                k: v
+                for k, v in self.data.items()
+                if k not in _LIVE_KEYS and (keys is None or k in keys)
+            }
+            data = copy.deepcopy(data)
+            for key in _LIVE_KEYS:
+                value = self.data.get(key)
+                if value is not None and (keys is None or key in keys):
+                    data[key] = (
+                        value.to_dict()
+                        if hasattr(value, "to_dict")
+                        else copy.deepcopy(value)
+                    )
+            return data
@@ -0,0 +1,332 @@
+"""
+Compact storage for counts over time.
+"""
+
+import datetime
+import threading
+from array import array
+
+KEYS = ("pageviews", "script_runs")
+
+
+def parse_day(day):
+    """Convert a "YYYY-MM-DD" string (or an ordinal) to the day's ordinal."""
+    if isinstance(day, int):
+        return day
+    year, month, day = day.split("-")
+    return datetime.date(int(year), int(month), int(day)).toordinal()
+
+
+def hour_of(dt):
+    """Return the ordinal of a datetime's hour, i.e. date ordinal * 24 + hour."""
+    return dt.toordinal() * 24 + dt.hour
+
+
+def hour_label(hour):
+    """Convert an hour ordinal to a "YYYY-MM-DD HH:00" string."""
+    return f"{datetime.date.fromordinal(hour // 24)} {hour % 24:02}:00"
+
+
+def parse_hour(hour):
+    """Convert a "YYYY-MM-DD HH:00" string (or an ordinal) to the hour's ordinal."""
+    if isinstance(hour, int):
+        return hour
+    day, time = hour.split(" ")
+    return parse_day(day) * 24 + int(time.split(":")[0])
+
+
+def period_of(day, rollup):
+    """Return the label of the week ("2021-W22") or month ("2021-06") of `day`."""
+    date = datetime.date.fromordinal(day)
+    if rollup == "week":
+        year, week, _ = date.isocalendar()
+        return f"{year}-W{week:02}"
+    elif rollup == "month":
+        return f"{date.year}-{date.month:02}"
+    else:
+        raise ValueError(f"rollup must be 'week' or 'month', not {rollup!r}")
+
+
+class DailyCounts:
+    """
+    Pageviews and script runs per day, without gaps between days.
+
+    Counts are stored in arrays, indexed by the number of days since `first_day` (a
+    date ordinal). Use `to_dict` to get the `counts["per_day"]` format, i.e. lists of
+    date strings, pageviews and script runs.
+    """
+
+    def __init__(self, first_day):
+        self.first_day = first_day
+        self.counts = {key: array("q") for key in KEYS}
+
+    def __len__(self):
+        return len(self.counts[KEYS[0]])
+
+    @property
+    def last_day(self):
+        return self.first_day + len(self) - 1
+
+    def incr(self, day, key, amount=1):
+        """Add `amount` to `key` on `day` (an ordinal), filling missing days with 0."""
+        i = day - self.first_day
+        if i < 0:
+            for k in KEYS:
+                self.counts[k] = array("q", [0] * -i) + self.counts[k]
+            self.first_day = day
+            i = 0
+        elif i >= len(self):
+            missing = [0] * (i - len(self) + 1)
+            for k in KEYS:
+                self.counts[k].extend(missing)
+        self.counts[key][i] += amount
+
+    def trim(self, max_days):
+        """
+        Drop the oldest days so at most `max_days` are left.
+
+        Returns the dropped days as {day ordinal: {key: count}}.
+        """
+        n = len(self) - max_days
+        if n <= 0:
+            return {}
+        dropped = {
+            self.first_day + i: {k: self.counts[k][i] for k in KEYS} for i in range(n)
+        }
+        for k in KEYS:
+            del self.counts[k][:n]
+        self.first_day += n
+        return dropped
+
+    def to_dict(self):
+        days = [
+            str(datetime.date.fromordinal(self.first_day + i)) for i in range(len(self))
+        ]
+        d = {"days": days}
+        d.update({k: self.counts[k].tolist() for k in KEYS})
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        """Create from the `counts["per_day"]` format (see `to_dict`)."""
+        days = [parse_day(day) for day in d["days"]]
+        daily = cls(min(days) if days else datetime.date.today().toordinal())
+        for i, day in enumerate(days):
+            for k in KEYS:
+                if d[k][i]:
+                    daily.incr(day, k, int(d[k][i]))
+        if days:
+            daily.incr(max(days), KEYS[0], 0)  # make sure all days are there
+        return daily
+
+    def __repr__(self):
+        return f"DailyCounts({self.to_dict()})"
+
+
+def nest_bucket(bucket):
+    """
+    Convert a bucket of `TimeBuckets` ({counter: count}) to the nested format, i.e.
+    {"pageviews": n, "script_runs": n, "widgets": {label: n or {option: n}}}.
+    """
+    nested = {}
+    for counter, n in bucket.items():
+        if n:
+            parent = nested
+            for key in counter[:-1]:
+                parent = parent.setdefault(key, {})
+            parent[counter[-1]] = n
+    return nested
+
+
+def bucket_items(nested, prefix=()):
+    """Yield (counter, count) for all counters in a nested bucket (see above)."""
+    for key, value in nested.items():
+        if isinstance(value, dict):
+            yield from bucket_items(value, prefix + (key,))
+        else:
+            yield prefix + (key,), value
+
+
+def add_to_bucket(nested, counter, n):
+    """Add `n` to `counter` in a nested bucket, removing counters that end up at 0."""
+    parents = [nested]
+    for key in counter[:-1]:
+        parents.append(parents[-1].setdefault(key, {}))
+    leaf = parents[-1]
+    leaf[counter[-1]] = leaf.get(counter[-1], 0) + n
+    if not leaf[counter[-1]]:
+        del leaf[counter[-1]]
+        # Remove dicts that are empty now, e.g. of a widget without counts left.
+        for key, parent in zip(reversed(counter[:-1]), reversed(parents[:-1])):
+            if parent[key]:
+                break
+            del parent[key]
+
+
+def _merge(into, bucket, sign=1):
+    for counter, n in bucket.items():
+        into[counter] = into.get(counter, 0) + sign * n
+
+
+class TimeBuckets:
+    """
+    Counts per hour (or per day, if `unit` is "day"), without gaps.
+
+    Each bucket is a dict of {counter: count}, where counters are paths like in
+    `utils.flatten_counts` without the top-level key, i.e. ("pageviews",),
+    ("script_runs",), ("widgets", label) or ("widgets", label, option). Buckets are
+    kept in a list, indexed by the number of hours (or days) since `first`.
+
+    A Fenwick tree (aka binary indexed tree) over the buckets sums up any range of
+    them by merging O(log n) of its nodes, and incrementing a counter only updates
+    O(log n) nodes. Use `to_dict` to get the format saved in `counts`, i.e.
+    {"YYYY-MM-DD HH:00" (or "YYYY-MM-DD"): nested bucket}, see `nest_bucket`.
+    """
+
+    def __init__(self, unit="hour"):
+        if unit not in ("hour", "day"):
+            raise ValueError(f"unit must be 'hour' or 'day', not {unit!r}")
+        self.unit = unit
+        self.first = None  # ordinal of the first bucket, None while there is none
+        self.buckets = []
+        # Node i (starting at 1) holds the sum of buckets i - (i & -i) to i - 1.
+        self._tree = [{}]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    @property
+    def last(self):
+        return None if self.first is None else self.first + len(self.buckets) - 1
+
+    def label(self, t):
+        """Convert an ordinal of this unit to the label used in `to_dict`."""
+        if self.unit == "hour":
+            return hour_label(t)
+        return str(datetime.date.fromordinal(t))
+
+    def parse(self, label):
+        """Convert a label from `to_dict` (or an ordinal) to the ordinal."""
+        return parse_hour(label) if self.unit == "hour" else parse_day(label)
+
+    def _append(self):
+        """Add an empty bucket at the end, with its tree node."""
+        self.buckets.append({})
+        i = len(self.buckets)
+        # The node is the sum of the nodes i - 1, i - 2, i - 4, ... that it spans.
+        node = {}
+        j = i - 1
+        while j > i - (i & -i):
+            _merge(node, self._tree[j])
+            j -= j & -j
+        self._tree.append(node)
+
+    def _rebuild(self):
+        """Build the tree from the buckets, in O(n) merges."""
+        self._tree = [{}] + [dict(bucket) for bucket in self.buckets]
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                _merge(self._tree[parent], self._tree[i])
+
+    def incr(self, t, counter, amount=1):
+        """Add `amount` to `counter` in the bucket of `t` (an ordinal)."""
+        with self._lock:
+            if self.first is None:
+                self.first = t
+            i = t - self.first
+            if i < 0:
+                # Rare, e.g. when loading older counts, so simply build anew.
+                self.buckets = [{} for _ in range(-i)] + self.buckets
+                self.first = t
+                self._rebuild()
+                i = 0
+            while i >= len(self.buckets):
+                self._append()
+            bucket = self.buckets[i]
+            bucket[counter] = bucket.get(counter, 0) + amount
+            j = i + 1
+            while j < len(self._tree):
+                node = self._tree[j]
+                node[counter] = node.get(counter, 0) + amount
+                j += j & -j
+
+    def trim(self, max_len):
+        """
+        Drop the oldest buckets so at most `max_len` are left.
+
+        Returns the dropped buckets as {ordinal: {counter: count}}.
+        """
+        with self._lock:
+            n = len(self.buckets) - max_len
+            if n <= 0:
+                return {}
+            dropped = {
+                self.first + i: bucket
+                for i, bucket in enumerate(self.buckets[:n])
+                if bucket
+            }
+            del self.buckets[:n]
+            self.first += n
+            self._rebuild()
+            return dropped
+
+    def _prefix(self, n):
+        """Return the sum of the first `n` buckets, as {counter: count}."""
+        total = {}
+        while n > 0:
+            _merge(total, self._tree[n])
+            n -= n & -n
+        return total
+
+    def sum(self, start, end):
+        """Return the sum of the buckets from ordinal `start` to `end` (exclusive)."""
+        with self._lock:
+            if self.first is None:
+                return {}
+            start = min(max(start - self.first, 0), len(self.buckets))
+            end = min(max(end - self.first, start), len(self.buckets))
+            total = self._prefix(end)
+            _merge(total, self._prefix(start), -1)
+        return {counter: n for counter, n in total.items() if n}
+
+    def to_dict(self):
+        with self._lock:
+            buckets = [
+                (self.first + i, nest_bucket(bucket))
+                for i, bucket in enumerate(self.buckets)
+            ]
+        return {self.label(t): nested for t, nested in buckets if nested}
+
+    @classmethod
+    def from_dict(cls, d, unit="hour"):
+        """Create from the format saved in `counts` (see `to_dict`)."""
+        buckets = cls(unit)
+        ordinals = {buckets.parse(label): nested for label, nested in d.items()}
+        if ordinals:
+            buckets.first = min(ordinals)
+            buckets.buckets = [{} for _ in range(max(ordinals) - buckets.first + 1)]
+            for t, nested in ordinals.items():
+                bucket = buckets.buckets[t - buckets.first]
+                for counter, n in bucket_items(nested):
+                    if n:
+                        bucket[counter] = int(n)
+            buckets._rebuild()
+        return buckets
+
+    def __repr__(self):
+        return f"TimeBuckets({self.unit!r}, {self.to_dict()})"
+
+
+def range_counts(hours, days, start, end):
+    """
+    Return the counts from hour ordinal `start` to `end` (exclusive), as
+    {counter: count}.
+
+    `hours` are hourly `TimeBuckets` and `days` daily ones, which hold the hours that
+    were rolled up since. Days count completely if any of their hours is in range.
+    """
+    total = hours.sum(start, end)
+    _merge(total, days.sum(start // 24, (end - 1) // 24 + 1))
+    return total
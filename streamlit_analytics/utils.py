@@ -1,5 +1,25 @@
+import bisect
 import datetime
 
+from .hyperloglog import UniqueVisitors
+from .timeseries import add_to_bucket, bucket_items, hour_label, parse_day
+
+# Keys in `counts` that hold a single number.
+TOTALS = (
+    "total_pageviews",
+    "total_script_runs",
+    "total_time_seconds",
+    "total_sessions",
+)
+
+# Keys in `counts` that hold counts over time, with the key of their list of days or
+# periods. See `timeseries.DailyCounts` for the live version of "per_day".
+SERIES = {"per_day": "days", "rolled_up": "periods"}
+
+# Keys in `counts` that hold counts per hour or day as {time: bucket}, with their
+# unit. See `timeseries.TimeBuckets`, which is also the live version of them.
+BUCKETS = {"per_hour": "hour", "per_hour_rolled_up": "day"}
+
 
 def format_seconds(s: int) -> str:
     """Formats seconds to 00:00:00 format."""
@@ -29,3 +49,149 @@ def replace_empty(s):
         return " "
     else:
         return s
+
+
+def empty_counts(start_time=None):
+    """Return counts without any data, e.g. to add counters from a flat dict to."""
+    return {
+        "total_pageviews": 0,
+        "total_script_runs": 0,
+        "total_time_seconds": 0,
+        "total_sessions": 0,
+        "per_day": {"days": [], "pageviews": [], "script_runs": []},
+        "rolled_up": {"periods": [], "pageviews": [], "script_runs": []},
+        "per_hour": {},
+        "per_hour_rolled_up": {},
+        "widgets": {},
+        "unique_visitors": {},
+        "start_time": start_time,
+    }
+
+
+def flatten_counts(counts):
+    """
+    Return all counters in `counts` as a flat dict of {path: number}.
+
+    Paths are tuples, e.g. ("total_pageviews",), ("per_day", "2021-06-01", "pageviews"),
+    ("rolled_up", "2021-05", "script_runs"), ("widgets", "Click me"),
+    ("widgets", "Select your favorite", "cat") or, for hourly counts,
+    ("per_hour", "2021-06-01 13:00", "widgets", "Click me").
+
+    Unique visitor sketches aren't counters, so they're left out (see
+    `hyperloglog.UniqueVisitors.registers` for them as flat dict).
+    """
+    flat = {}
+    for key in TOTALS:
+        if key in counts:
+            flat[(key,)] = counts[key]
+    for series_key, index_key in SERIES.items():
+        series = counts.get(series_key)
+        if hasattr(series, "to_dict"):
+            series = series.to_dict()
+        if not series:
+            continue
+        for i, day in enumerate(series[index_key]):
+            for key in ("pageviews", "script_runs"):
+                path = (series_key, day, key)
+                flat[path] = flat.get(path, 0) + series[key][i]
+    for bucket_key in BUCKETS:
+        buckets = counts.get(bucket_key)
+        if hasattr(buckets, "to_dict"):
+            buckets = buckets.to_dict()
+        for time, nested in (buckets or {}).items():
+            for counter, n in bucket_items(nested):
+                flat[(bucket_key, time) + counter] = n
+    for label, value in counts.get("widgets", {}).items():
+        if isinstance(value, dict):
+            for option, n in value.items():
+                flat[("widgets", label, option)] = n
+        else:
+            flat[("widgets", label)] = value
+    return flat
+
+
+def diff_counts(old, new):
+    """Return {path: change} for all counters that differ between two flat dicts."""
+    diff = {}
+    for path, n in new.items():
+        change = n - old.get(path, 0)
+        if change:
+            diff[path] = change
+    for path, n in old.items():
+        if path not in new and n:
+            diff[path] = -n
+    return diff
+
+
+def add_counts(counts, flat):
+    """
+    Add counters from a flat dict of {path: number} (see above) to `counts`.
+
+    Paths of unique visitor sketches (see `CounterStore.add_visitor`) raise their
+    register to the number instead. Days that go down to 0 are dropped.
+    """
+    visitor_changes = {}
+    for path, n in flat.items():
+        if path[0] in SERIES:
+            series_key, day, key = path
+            index_key = SERIES[series_key]
+            series = counts.setdefault(
+                series_key, {index_key: [], "pageviews": [], "script_runs": []}
+            )
+            if hasattr(series, "incr"):
+                series.incr(parse_day(day), key, n)
+                continue
+            days = series[index_key]
+            i = bisect.bisect_left(days, day)
+            if i == len(days) or days[i] != day:
+                days.insert(i, day)
+                series["pageviews"].insert(i, 0)
+                series["script_runs"].insert(i, 0)
+            series[key][i] += n
+            if n < 0 and not series["pageviews"][i] and not series["script_runs"][i]:
+                # Only days that were rolled up go down, see `CounterStore._roll_up`.
+                del days[i]
+                del series["pageviews"][i]
+                del series["script_runs"][i]
+        elif path[0] in BUCKETS:
+            buckets = counts.setdefault(path[0], {})
+            if hasattr(buckets, "incr"):
+                buckets.incr(buckets.parse(path[1]), path[2:], n)
+            else:
+                bucket = buckets.setdefault(path[1], {})
+                add_to_bucket(bucket, path[2:], n)
+                if not bucket:
+                    del buckets[path[1]]
+        elif path[0] == "widgets":
+            widgets = counts["widgets"]
+            if hasattr(widgets, "incr"):
+                widgets.incr(path[1], path[2] if len(path) > 2 else None, n)
+            elif len(path) == 2:
+                widgets[path[1]] = widgets.get(path[1], 0) + n
+            else:
+                options = widgets.setdefault(path[1], {})
+                options[path[2]] = options.get(path[2], 0) + n
+        elif path[0] == "unique_visitors":
+            visitor_changes[path[1:]] = n
+        else:
+            counts[path[0]] = counts.get(path[0], 0) + n
+    if visitor_changes:
+        # Decode the sketches only once, not for every register.
+        visitors = UniqueVisitors.load(counts.get("unique_visitors"))
+        for path, rank in visitor_changes.items():
+            visitors.apply(path, rank)
+        if not isinstance(counts.get("unique_visitors"), UniqueVisitors):
+            counts["unique_visitors"] = visitors.to_dict()
+
+
+def readable_path(path):
+    """
+    Convert date and hour ordinals in a path (see `CounterStore.incr`) to the strings
+    used in `counts`, e.g. before saving it.
+    """
+    if len(path) > 1 and isinstance(path[1], int):
+        if path[0] in ("per_day", "per_hour_rolled_up", "unique_visitors"):
+            return (path[0], str(datetime.date.fromordinal(path[1]))) + path[2:]
+        if path[0] == "per_hour":
+            return (path[0], hour_label(path[1])) + path[2:]
+    return path
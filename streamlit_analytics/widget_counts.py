@@ -0,0 +1,115 @@
+"""
+Compact storage for widget counts.
+"""
+
+import threading
+from array import array
+from collections.abc import Mapping
+
+
+class WidgetCounts(Mapping):
+    """
+    Counts of all widgets, with each (label, option) pair interned as an integer id.
+
+    A pair gets an id the first time it's added (option None for widgets without
+    options, e.g. buttons), and its count is stored at that index of an array, so
+    counting doesn't create any objects. Ids of removed pairs are reused.
+
+    Reading works like the `counts["widgets"]` dict, i.e. {label: count} or
+    {label: {option: count}}, but builds the dict of each label on the fly. Use
+    `to_dict` to get all of it, e.g. to save it. Only one thread at a time may change
+    the pairs of a label, `CounterStore` takes care of that.
+    """
+
+    def __init__(self):
+        # {label: id} for widgets without options, {label: {option: id}} otherwise.
+        self.ids = {}
+        # Label, option and count by id. Lists instead of (label, option) tuples, which
+        # would take more memory than everything else.
+        self.labels = []
+        self.options = []
+        self.counts = array("q")
+        self._free = []
+        self._alloc_lock = threading.Lock()  # ids are shared across all labels
+
+    def _new_id(self, label, option):
+        with self._alloc_lock:
+            if self._free:
+                i = self._free.pop()
+                self.labels[i] = label
+                self.options[i] = option
+                self.counts[i] = 0
+            else:
+                i = len(self.labels)
+                self.labels.append(label)
+                self.options.append(option)
+                self.counts.append(0)
+        return i
+
+    def id(self, label, option=None):
+        """Return the id of a pair, or None if it wasn't added."""
+        if option is None:
+            return self.ids.get(label)
+        options = self.ids.get(label)
+        return None if options is None else options.get(option)
+
+    def option_ids(self, label):
+        """Return {option: id} of a label with options. Don't change it."""
+        return self.ids.setdefault(label, {})
+
+    def add(self, label, option=None):
+        """Return the id of a pair, adding it with count 0 if needed."""
+        if option is None:
+            i = self.ids.get(label)
+            if i is None:
+                i = self.ids[label] = self._new_id(label, None)
+            return i
+        options = self.ids.setdefault(label, {})
+        i = options.get(option)
+        if i is None:
+            i = options[option] = self._new_id(label, option)
+        return i
+
+    def incr(self, label, option=None, amount=1):
+        """Add `amount` to the count of a pair, adding it if needed. Returns its id."""
+        i = self.add(label, option)
+        self.counts[i] += amount
+        return i
+
+    def remove(self, label, option):
+        """Remove a pair with an option. Its id may be reused right away."""
+        i = self.ids[label].pop(option)
+        with self._alloc_lock:
+            self.labels[i] = self.options[i] = None
+            self._free.append(i)
+
+    def __getitem__(self, label):
+        ids = self.ids[label]
+        if isinstance(ids, dict):
+            return {option: self.counts[i] for option, i in ids.items()}
+        return self.counts[ids]
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def to_dict(self):
+        return {label: self[label] for label in self.ids}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Create from the `counts["widgets"]` format (see `to_dict`)."""
+        widgets = cls()
+        for label, value in d.items():
+            if isinstance(value, dict):
+                widgets.option_ids(label)  # keep labels without any options
+                for option, n in value.items():
+                    widgets.incr(label, option, int(n))
+            else:
+                widgets.incr(label, None, int(value))
+        return widgets
+
+    def __repr__(self):
+        return f"WidgetCounts({self.to_dict()})"
@@ -0,0 +1,130 @@
+"""
+Flat index of widget counts, so the dashboard can show the top rows without walking
+the whole nested `counts["widgets"]` dict.
+"""
+
+import bisect
+import threading
+
+from .widget_counts import WidgetCounts
+
+
+class WidgetIndex:
+    """
+    All counters in `counts["widgets"]` as rows of (label, option, count).
+
+    Rows are the ids of `WidgetCounts`, grouped in buckets by count, and the distinct
+    counts are kept sorted, so incrementing a row only moves it to the next bucket
+    and the rows with the highest counts can be read right away. Buttons etc. that
+    don't have options get option None. Also keeps the total count of each label in
+    `totals`.
+
+    `CounterStore` updates the index on every change of the `WidgetCounts` it was
+    built from (`source`). If that gets replaced (e.g. when loading or resetting
+    counts), changes are ignored until the index is built again.
+    """
+
+    def __init__(self):
+        self.source = None
+        self.totals = {}
+        self._lock = threading.Lock()
+        self._buckets = {}  # {count: {id: None}}, dicts keep the order
+        self._levels = []  # distinct counts, ascending
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _place(self, i, count):
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = {}
+            bisect.insort(self._levels, count)
+        bucket[i] = None
+
+    def _unplace(self, i, count):
+        """Remove row `i` from the bucket of `count`. Returns whether it was there."""
+        bucket = self._buckets.get(count)
+        if bucket is None or i not in bucket:
+            return False
+        del bucket[i]
+        if not bucket:
+            del self._buckets[count]
+            del self._levels[bisect.bisect_left(self._levels, count)]
+        return True
+
+    def build(self, widgets):
+        """
+        Index all counters in `widgets` (`WidgetCounts` or the plain dict), replacing
+        everything indexed so far.
+        """
+        if not isinstance(widgets, WidgetCounts):
+            widgets = WidgetCounts.from_dict(widgets)
+        with self._lock:
+            self.source = widgets
+            self.totals = {}
+            self._buckets = {}
+            self._levels = []
+            self._size = 0
+            for label, ids in widgets.ids.items():
+                if isinstance(ids, dict):
+                    total = 0
+                    for i in ids.values():
+                        self._place(i, widgets.counts[i])
+                        total += widgets.counts[i]
+                    self._size += len(ids)
+                    self.totals[label] = total
+                else:
+                    self._place(ids, widgets.counts[ids])
+                    self._size += 1
+                    self.totals[label] = widgets.counts[ids]
+
+    def add(self, widgets, i, amount):
+        """
+        Move row `i` after `amount` was added to it (or add it), if the index was
+        built from `widgets`.
+        """
+        with self._lock:
+            if widgets is not self.source:
+                return
+            count = widgets.counts[i]
+            if not self._unplace(i, count - amount):
+                self._size += 1
+            self._place(i, count)
+            label = widgets.labels[i]
+            self.totals[label] = self.totals.get(label, 0) + amount
+
+    def remove(self, widgets, i):
+        """Remove row `i`, if the index was built from `widgets`."""
+        with self._lock:
+            if widgets is not self.source:
+                return
+            count = widgets.counts[i]
+            if self._unplace(i, count):
+                self._size -= 1
+                self.totals[widgets.labels[i]] -= count
+
+    def top(self, limit=None, search=None):
+        """
+        Return the rows with the highest counts, as list of (label, option, count).
+
+        If `search` is given, only rows whose label or option contain it (ignoring
+        case) are returned.
+        """
+        if search:
+            search = search.lower()
+        rows = []
+        with self._lock:
+            source = self.source
+            for count in reversed(self._levels):
+                for i in self._buckets[count]:
+                    label, option = source.labels[i], source.options[i]
+                    if search and not (
+                        search in str(label).lower()
+                        or (option is not None and search in str(option).lower())
+                    ):
+                        continue
+                    rows.append((label, option, count))
+                    if limit is not None and len(rows) >= limit:
+                        return rows
+        return rows
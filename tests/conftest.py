@@ -0,0 +1,34 @@
+"""
+Runs the tests with fake `streamlit` and `google.cloud.firestore` modules, see
+`fakes.py`.
+"""
+
+import pytest
+
+from tests import fakes
+
+fakes.install()
+
+from streamlit_analytics import main, storage  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fresh_counts():
+    """Start each test with empty counts and without any storage backends."""
+    fakes.clear_session()
+    yield
+    storage.close_all()
+    main._store.retention_days = None
+    main._store.retention_hours = None
+    main.reset_counts()
+    fakes.firestore_docs.clear()
+    fakes.firestore_failures = 0
+    fakes.firestore_latency = 0.0
+
+
+@pytest.fixture
+def key_file(tmp_path):
+    """Path of a (fake) firestore key file."""
+    path = tmp_path / "firestore-key.json"
+    path.write_text("{}")
+    return str(path)
@@ -0,0 +1,267 @@
+"""
+Fake `streamlit` and `google.cloud.firestore` modules, so the tests and benchmarks can
+run streamlit-analytics without a streamlit server or a firestore database.
+
+Call `install()` before importing streamlit_analytics. Each thread acts as one user
+session: it has its own session state and widget values (see `set_value`).
+"""
+
+import asyncio
+import json
+import sys
+import threading
+import time
+import types
+
+_local = threading.local()
+
+
+class _SessionState:
+    """Session state of the current thread, like `st.session_state`."""
+
+    def _state(self):
+        if not hasattr(_local, "state"):
+            _local.state = {}
+        return _local.state
+
+    def __contains__(self, key):
+        return key in self._state()
+
+    def __getattr__(self, key):
+        try:
+            return self._state()[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self._state()[key] = value
+
+
+def _values():
+    if not hasattr(_local, "values"):
+        _local.values = {}
+    return _local.values
+
+
+def set_value(label, value):
+    """Set what the widget `label` returns in the current thread, like a user would."""
+    _values()[label] = value
+
+
+def session_state():
+    """Return the session state of the current thread as dict."""
+    return st_session_state._state()
+
+
+def clear_session():
+    """Start a new session in the current thread, i.e. reset its session state."""
+    _local.state = {}
+    _local.values = {}
+
+
+def _widget(default):
+    def widget(label, *args, **kwargs):
+        return _values().get(label, default)
+
+    return widget
+
+
+def _slider(label, *args, value=None, **kwargs):
+    # Double-ended sliders return a tuple.
+    default = tuple(value) if isinstance(value, (list, tuple)) else 0
+    return _values().get(label, default)
+
+
+def _option_widget(label, options, *args, **kwargs):
+    return _values().get(label, list(options)[0])
+
+
+def _multiselect(label, options, *args, **kwargs):
+    return _values().get(label, [])
+
+
+def _noop(*args, **kwargs):
+    pass
+
+
+def _add_widgets(obj):
+    widgets = {
+        "button": _widget(False),
+        "checkbox": _widget(False),
+        "radio": _option_widget,
+        "selectbox": _option_widget,
+        "multiselect": _multiselect,
+        "slider": _slider,
+        "select_slider": _option_widget,
+        "text_input": _widget(""),
+        "number_input": _widget(0.0),
+        "text_area": _widget(""),
+        "date_input": _widget(None),
+        "time_input": _widget(None),
+        "file_uploader": _widget(None),
+        "color_picker": _widget("#000000"),
+    }
+    for name, func in widgets.items():
+        setattr(obj, name, func)
+
+
+st_session_state = _SessionState()
+
+
+def _make_streamlit():
+    st = types.ModuleType("streamlit")
+    st.session_state = st_session_state
+    _add_widgets(st)
+    st.sidebar = types.SimpleNamespace()
+    _add_widgets(st.sidebar)
+    st.experimental_get_query_params = lambda: {}
+    st.title = st.write = st.markdown = st.header = _noop
+    return st
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+DELETE_FIELD = object()
+
+
+def _encode(value):
+    if isinstance(value, Increment):
+        return {"increment": value.value}
+    return str(value)
+
+
+def _merge(target, data):
+    for key, value in data.items():
+        if isinstance(value, Increment):
+            target[key] = target.get(key, 0) + value.value
+        elif value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict):
+            _merge(target.setdefault(key, {}), value)
+        else:
+            target[key] = value
+
+
+class _Snapshot:
+    def __init__(self, data):
+        self._data = data
+
+    def to_dict(self):
+        return None if self._data is None else json.loads(json.dumps(self._data))
+
+
+class _Document:
+    def __init__(self, key):
+        self.key = key
+
+    def get(self, field_paths=None):
+        _wait()
+        return _Snapshot(firestore_docs.get(self.key))
+
+    def set(self, data, merge=False):
+        _wait()
+        self._set(data, merge)
+
+    def _set(self, data, merge):
+        # Count what would be sent over the wire.
+        size = len(json.dumps(data, default=_encode))
+        with _writes_lock:
+            firestore_writes["count"] += 1
+            firestore_writes["bytes"] += size
+        if merge:
+            _merge(firestore_docs.setdefault(self.key, {}), data)
+        else:
+            firestore_docs[self.key] = json.loads(json.dumps(data))
+
+
+class _AsyncDocument(_Document):
+    async def get(self, field_paths=None):
+        await _async_wait()
+        return _Snapshot(firestore_docs.get(self.key))
+
+    async def set(self, data, merge=False):
+        await _async_wait()
+        self._set(data, merge)
+
+
+class _Collection:
+    def __init__(self, name, document_class):
+        self.name = name
+        self.document_class = document_class
+
+    def document(self, name):
+        return self.document_class((self.name, name))
+
+
+class _Client:
+    @classmethod
+    def from_service_account_json(cls, path):
+        return cls()
+
+    def collection(self, name):
+        return _Collection(name, _Document)
+
+
+class _AsyncClient(_Client):
+    def collection(self, name):
+        return _Collection(name, _AsyncDocument)
+
+
+# Documents in the fake firestore, and the number and size of writes to it.
+firestore_docs = {}
+firestore_writes = {"count": 0, "bytes": 0}
+_writes_lock = threading.Lock()
+
+# Seconds each call to the fake firestore takes, and the number of calls that should
+# fail from now on.
+firestore_latency = 0.0
+firestore_failures = 0
+
+
+def _fail():
+    global firestore_failures
+    with _writes_lock:
+        if firestore_failures > 0:
+            firestore_failures -= 1
+            raise ConnectionError("fake firestore is down")
+
+
+def _wait():
+    if firestore_latency:
+        time.sleep(firestore_latency)
+    _fail()
+
+
+async def _async_wait():
+    if firestore_latency:
+        await asyncio.sleep(firestore_latency)
+    _fail()
+
+
+def _make_firestore():
+    firestore = types.ModuleType("google.cloud.firestore")
+    firestore.Client = _Client
+    firestore.AsyncClient = _AsyncClient
+    firestore.Increment = Increment
+    firestore.DELETE_FIELD = DELETE_FIELD
+    google = types.ModuleType("google")
+    cloud = types.ModuleType("google.cloud")
+    google.cloud = cloud
+    cloud.firestore = firestore
+    return {
+        "google": google,
+        "google.cloud": cloud,
+        "google.cloud.firestore": firestore,
+    }
+
+
+def install(firestore=True):
+    """Put the fake modules into `sys.modules`."""
+    if "streamlit_analytics" in sys.modules:
+        raise RuntimeError("Call install() before importing streamlit_analytics")
+    sys.modules["streamlit"] = _make_streamlit()
+    if firestore:
+        sys.modules.update(_make_firestore())
@@ -0,0 +1,151 @@
+import time
+
+import pytest
+
+import streamlit_analytics
+from streamlit_analytics import async_firestore, firestore, main, storage
+from tests import fakes
+
+DOC = ("counts", "counts")
+
+# (timeout, retries, backoff) of writes.
+SETTINGS = (1, 2, 0.001)
+
+
+@pytest.fixture
+def writer():
+    writer = async_firestore.AsyncWriter()
+    yield writer
+    writer.close(timeout=5)
+
+
+def _submit(writer, key_file, data, merge=True):
+    key = firestore.doc_key(key_file, "counts")
+    writer.submit(key, key_file, "counts", (data, merge), SETTINGS)
+
+
+def _track(key_file, reruns, **kwargs):
+    for _ in range(reruns):
+        with streamlit_analytics.track(
+            firestore_key_file=key_file, firestore_async=True, **kwargs
+        ):
+            pass
+
+
+def _increment(n):
+    return {"total_script_runs": fakes.Increment(n)}
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_retries_failed_writes(writer, key_file):
+    retries = firestore.stats["retries"]
+    fakes.firestore_failures = 2
+    _submit(writer, key_file, _increment(1))
+    writer.close(timeout=5)
+    assert fakes.firestore_docs[DOC] == {"total_script_runs": 1}
+    assert firestore.stats["retries"] - retries == 2
+
+
+def test_failed_write_is_sent_with_the_next_one(writer, key_file):
+    failed = firestore.stats["failed_saves"]
+    fakes.firestore_failures = 3  # the write and both retries
+    _submit(writer, key_file, _increment(1))
+    _wait_for(lambda: firestore.stats["failed_saves"] > failed)
+    assert DOC not in fakes.firestore_docs
+
+    writes = fakes.firestore_writes["count"]
+    _submit(writer, key_file, _increment(2))
+    writer.close(timeout=5)
+    assert fakes.firestore_docs[DOC] == {"total_script_runs": 3}
+    assert fakes.firestore_writes["count"] - writes == 1
+
+
+def test_overwrite_replaces_failed_write(writer, key_file):
+    failed = firestore.stats["failed_saves"]
+    fakes.firestore_failures = 3
+    _submit(writer, key_file, _increment(1))
+    _wait_for(lambda: firestore.stats["failed_saves"] > failed)
+    _submit(writer, key_file, {"total_script_runs": 10}, merge=False)
+    writer.close(timeout=5)
+    assert fakes.firestore_docs[DOC] == {"total_script_runs": 10}
+
+
+def test_close_drains_queue(writer, key_file):
+    fakes.firestore_latency = 0.05
+    writes = fakes.firestore_writes["count"]
+    for _ in range(10):
+        _submit(writer, key_file, _increment(1))
+    writer.close(timeout=5)
+    assert fakes.firestore_docs[DOC] == {"total_script_runs": 10}
+    # Writes that arrived while one was in flight were combined.
+    assert fakes.firestore_writes["count"] - writes < 10
+
+
+def test_close_retries_failed_writes(writer, key_file):
+    failed = firestore.stats["failed_saves"]
+    fakes.firestore_failures = 3
+    _submit(writer, key_file, _increment(1))
+    _wait_for(lambda: firestore.stats["failed_saves"] > failed)
+    writer.close(timeout=5)
+    assert fakes.firestore_docs[DOC] == {"total_script_runs": 1}
+
+
+def test_load_does_not_wait_for_firestore(key_file):
+    fakes.firestore_docs[DOC] = {"total_script_runs": 10, "start_time": "then"}
+    fakes.firestore_latency = 0.2
+    store = main._store
+    backend = storage.register(
+        storage.FirestoreBackend(key_file, delta=True, asynchronous=True), store
+    )
+    start = time.perf_counter()
+    assert not storage.load(backend, store)
+    assert time.perf_counter() - start < 0.1
+
+    # Counted before firestore answered, and not saved until it's loaded.
+    store.incr(("total_script_runs",))
+    storage.save(backend, store)
+    _wait_for(lambda: storage.load(backend, store))
+    assert main.counts["total_script_runs"] == 11
+    assert main.counts["start_time"] == "then"
+
+    storage.save(backend, store)
+    async_firestore.close(timeout=5)
+    assert fakes.firestore_docs[DOC]["total_script_runs"] == 11
+
+
+def test_load_is_retried(key_file):
+    fakes.firestore_docs[DOC] = {"total_script_runs": 10, "start_time": "then"}
+    fakes.firestore_failures = 1
+    store = main._store
+    backend = storage.register(
+        storage.FirestoreBackend(key_file, asynchronous=True), store, backoff=0.05
+    )
+    _wait_for(lambda: storage.load(backend, store))
+    assert backend._load_failures == 1
+    assert main.counts["total_script_runs"] == 10
+
+
+@pytest.mark.parametrize("delta", [True, False])
+def test_exit_before_load_saves_counts(key_file, delta):
+    fakes.firestore_docs[DOC] = {"total_script_runs": 10, "start_time": "then"}
+    fakes.firestore_latency = 0.1
+    _track(key_file, 5, firestore_delta=delta)
+    # The app exits before a script run put the document into the counts.
+    storage.close_all()
+    assert fakes.firestore_docs[DOC]["total_script_runs"] == 15
+    assert fakes.firestore_docs[DOC]["start_time"] == "then"
+
+
+def test_exit_without_firestore_adds_counts(key_file):
+    fakes.firestore_docs[DOC] = {"total_script_runs": 10, "start_time": "then"}
+    # Both loads fail, the one of the first script run and the one at exit.
+    fakes.firestore_failures = 2
+    _track(key_file, 5, firestore_delta=True)
+    storage.close_all()
+    assert fakes.firestore_docs[DOC]["total_script_runs"] == 15
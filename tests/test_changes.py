@@ -0,0 +1,58 @@
+import streamlit as st
+
+import streamlit_analytics
+from streamlit_analytics import main
+from streamlit_analytics.changes import ChangeTracker, digest
+from tests import fakes
+
+
+def _rerun(*values):
+    """Run a script with a slider and a multiselect, set to `values`."""
+    fakes.set_value("Size", values[0])
+    fakes.set_value("Toppings", values[1])
+    with streamlit_analytics.track():
+        st.slider("Size")
+        st.multiselect("Toppings", ["a", "b", "c"])
+    return main.get_counts()["widgets"]
+
+
+def test_unchanged_values_are_counted_once():
+    for _ in range(3):
+        widgets = _rerun(3, ["a"])
+    assert widgets["Size"] == {3: 1}
+    assert widgets["Toppings"] == {"a": 1, "b": 0, "c": 0}
+
+    widgets = _rerun(5, ["a", "b"])
+    widgets = _rerun(3, ["b"])
+    widgets = _rerun(3, ["a", "b"])
+    assert widgets["Size"] == {3: 2, 5: 1}
+    # Only options that weren't selected in the last script run count.
+    assert widgets["Toppings"] == {"a": 2, "b": 1, "c": 0}
+
+    # The session state only keeps hashes, one entry per widget.
+    assert len(fakes.session_state()["widget_changes"]) == 2
+
+
+def test_new_session_counts_again():
+    _rerun(3, ["a"])
+    fakes.clear_session()
+    widgets = _rerun(3, ["a"])
+    assert widgets["Size"] == {3: 2}
+    assert widgets["Toppings"]["a"] == 2
+
+
+def test_digest():
+    assert digest("text") == digest("text")
+    assert len(digest("x" * 100000)) == 8
+    # Python's `hash` is the same for these.
+    assert digest(-1) != digest(-2)
+    assert digest(1) != digest("1")
+
+
+def test_update_options():
+    tracker = ChangeTracker()
+    assert tracker.update_options("Toppings", ["a", "b", "a"]) == ["a", "b"]
+    assert tracker.update_options("Toppings", ["b", "c"]) == ["c"]
+    # A single value replaces the selected options.
+    assert tracker.update("Toppings", "a")
+    assert tracker.update_options("Toppings", ["b"]) == ["b"]
@@ -0,0 +1,110 @@
+import datetime
+
+import streamlit as st
+
+import streamlit_analytics
+from streamlit_analytics import main, storage
+from streamlit_analytics.hyperloglog import HyperLogLog
+from streamlit_analytics.timeseries import hour_label, hour_of
+from tests import fakes
+
+DOC = ("counts", "counts")
+
+
+def _track(key_file, reruns=1, **kwargs):
+    for _ in range(reruns):
+        with streamlit_analytics.track(
+            firestore_key_file=key_file, firestore_delta=True, **kwargs
+        ):
+            st.button("Click me")
+
+
+def test_delta_saves_increments(key_file):
+    fakes.firestore_docs[DOC] = {
+        "total_script_runs": 10,
+        "widgets": {"Click me": 3},
+        "start_time": "01 Jun 2021, 12:00:00",
+    }
+    fakes.set_value("Click me", True)
+    writes = fakes.firestore_writes["count"]
+    _track(key_file, reruns=3)
+
+    doc = fakes.firestore_docs[DOC]
+    assert doc["total_script_runs"] == 13
+    assert doc["widgets"] == {"Click me": 6}
+    today = str(datetime.date.today())
+    assert doc["per_day_counts"][today] == {"pageviews": 1, "script_runs": 3}
+    assert fakes.firestore_writes["count"] - writes == 3
+    assert main.get_counts()["total_script_runs"] == 13
+
+    # Another replica saves in between. Its counts are kept, as we only add ours.
+    doc["total_script_runs"] += 5
+    _track(key_file)
+    assert fakes.firestore_docs[DOC]["total_script_runs"] == 19
+
+
+def test_first_save_adds_all_counts(key_file):
+    _track(key_file, reruns=2)
+    doc = fakes.firestore_docs[DOC]
+    assert doc["total_script_runs"] == 2
+    assert doc["start_time"] == main.counts["start_time"]
+
+
+def test_reset_overwrites(key_file):
+    fakes.firestore_docs[DOC] = {"total_script_runs": 10, "start_time": "then"}
+    _track(key_file, reruns=2)
+    main.reset_counts()
+    _track(key_file)
+
+    doc = fakes.firestore_docs[DOC]
+    assert doc["total_script_runs"] == 1
+    assert doc["start_time"] == main.counts["start_time"]
+    assert "per_day_counts" not in doc
+    assert sum(doc["per_day"]["script_runs"]) == 1
+
+
+def test_rolled_up_hours_are_deleted(key_file):
+    store = main._store
+    backend = storage.register(
+        storage.FirestoreBackend(key_file, delta=True), store, flush_interval=None
+    )
+    storage.load(backend, store)
+    store.retention_hours = 1
+    hour = hour_of(datetime.datetime.now())
+    store.incr(("per_hour", hour, "pageviews"))
+    storage.save(backend, store)
+    store.incr(("per_hour", hour + 1, "pageviews"), 2)
+    storage.save(backend, store)
+
+    doc = fakes.firestore_docs[DOC]
+    assert doc["per_hour"] == {hour_label(hour + 1): {"pageviews": 2}}
+    day = str(datetime.date.fromordinal(hour // 24))
+    assert doc["per_hour_rolled_up"] == {day: {"pageviews": 1}}
+
+
+def test_visitor_sketches_are_merged(key_file):
+    remote = HyperLogLog()
+    remote.add(1 << 63)
+    fakes.firestore_docs[DOC] = {
+        "total_script_runs": 0,
+        "start_time": "then",
+        "unique_visitors": {"all_time": remote.to_base64(), "per_day": {}},
+    }
+    # Visitor hashes of this session and the next one, so all four visitors end up in
+    # different registers.
+    fakes.session_state()["visitor_hash"] = 5 << 60
+    _track(key_file)
+    # Another replica adds a visitor in between, which must not get lost.
+    other = HyperLogLog.from_base64(
+        fakes.firestore_docs[DOC]["unique_visitors"]["all_time"]
+    )
+    other.add(3 << 61)
+    fakes.firestore_docs[DOC]["unique_visitors"]["all_time"] = other.to_base64()
+    fakes.clear_session()
+    fakes.session_state()["visitor_hash"] = 7 << 59
+    _track(key_file)
+
+    saved = fakes.firestore_docs[DOC]["unique_visitors"]
+    assert HyperLogLog.from_base64(saved["all_time"]).count() == 4
+    today = str(datetime.date.today())
+    assert HyperLogLog.from_base64(saved["per_day"][today]).count() == 2
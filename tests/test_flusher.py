@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+import streamlit_analytics
+from streamlit_analytics import flusher, storage
+from tests import fakes
+
+DOC = ("counts", "counts")
+ROOT = Path(__file__).resolve().parent.parent
+
+# Runs the app in another process, which exits with unsaved counts.
+OTHER_PROCESS = """
+import sys
+
+from tests import fakes
+
+fakes.install()
+
+import streamlit_analytics
+
+for _ in range(3):
+    with streamlit_analytics.track(
+        save_to_json=sys.argv[1], save_to_json_interval=60
+    ):
+        pass
+"""
+
+
+def _track(key_file, reruns, **kwargs):
+    for _ in range(reruns):
+        with streamlit_analytics.track(firestore_key_file=key_file, **kwargs):
+            pass
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_interval_batches_firestore_writes(key_file):
+    writes = fakes.firestore_writes["count"]
+    _track(key_file, 20, firestore_flush_interval=60)
+    assert fakes.firestore_writes["count"] == writes
+    storage.close_all()
+    assert fakes.firestore_writes["count"] - writes == 1
+    assert fakes.firestore_docs[DOC]["total_script_runs"] == 20
+
+
+def test_flush_after_script_runs(key_file):
+    _track(key_file, 4, firestore_flush_after=5)
+    time.sleep(0.05)
+    assert DOC not in fakes.firestore_docs
+    _track(key_file, 1, firestore_flush_after=5)
+    _wait_for(lambda: DOC in fakes.firestore_docs)
+    assert fakes.firestore_docs[DOC]["total_script_runs"] == 5
+
+
+def test_failed_flush_is_retried():
+    calls = []
+
+    def save():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ConnectionError("down")
+
+    f = flusher.Flusher(save, interval=60)
+    f.mark_dirty()
+    with pytest.raises(ConnectionError):
+        f.flush()
+    # The changes are still marked, so stopping saves them.
+    f.stop()
+    assert len(calls) == 2
+    f.stop()
+    assert len(calls) == 2
+
+
+def test_flush_at_exit(tmp_path):
+    path = tmp_path / "counts.json"
+    subprocess.run(
+        [sys.executable, "-c", OTHER_PROCESS, str(path)],
+        env=dict(os.environ, PYTHONPATH=str(ROOT)),
+        check=True,
+    )
+    assert json.loads(path.read_text())["total_script_runs"] == 3
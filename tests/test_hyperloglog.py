@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from streamlit_analytics.hyperloglog import MAX_DAYS, HyperLogLog, UniqueVisitors
+
+
+def _hashes(n, seed=0):
+    rng = random.Random(seed)
+    return [rng.getrandbits(64) for _ in range(n)]
+
+
+@pytest.mark.parametrize("n", [0, 1, 10, 100, 1000, 50000])
+def test_count(n):
+    sketch = HyperLogLog()
+    for h in _hashes(n):
+        sketch.add(h)
+    # About 2.3% standard error, so this should hold with a few sigmas to spare.
+    assert abs(sketch.count() - n) <= max(1, 0.08 * n)
+
+
+def test_adding_again_changes_nothing():
+    sketch = HyperLogLog()
+    hashes = _hashes(1000)
+    changes = [sketch.add(h) for h in hashes]
+    count = sketch.count()
+    assert all(sketch.add(h) is None for h in hashes)
+    assert sketch.count() == count
+    # Each change is the register and its new rank.
+    for change in changes:
+        if change is not None:
+            i, rank = change
+            assert sketch.registers[i] >= rank
+
+
+def test_merge_is_union():
+    a, b, both = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for h in _hashes(3000, seed=1):
+        a.add(h)
+        both.add(h)
+    for h in _hashes(3000, seed=2) + _hashes(1000, seed=1):
+        b.add(h)
+        both.add(h)
+    a.merge(b)
+    assert a.registers == both.registers
+    assert abs(a.count() - 6000) <= 0.08 * 6000
+
+    with pytest.raises(ValueError):
+        a.merge(HyperLogLog(precision=4))
+
+
+def test_base64_round_trip():
+    sketch = HyperLogLog()
+    for h in _hashes(500):
+        sketch.add(h)
+    assert HyperLogLog.from_base64(sketch.to_base64()).registers == sketch.registers
+
+
+def test_unique_visitors_per_day():
+    visitors = UniqueVisitors()
+    day = 738000
+    hashes = _hashes(200)
+    for i, h in enumerate(hashes):
+        visitors.add(day + i % 2, h)
+    assert abs(visitors.count() - 200) <= 16
+    assert abs(visitors.count([day]) - 100) <= 8
+    assert visitors.count([day, day + 1]) == visitors.count()
+
+    loaded = UniqueVisitors.from_dict(visitors.to_dict())
+    assert loaded.count([day]) == visitors.count([day])
+
+
+def test_unique_visitors_trim():
+    visitors = UniqueVisitors()
+    first = 738000
+    days = range(first, first + MAX_DAYS + 5)
+    for day, h in zip(days, _hashes(len(days))):
+        visitors.add(day, h)
+    assert visitors.trim() == list(range(first, first + 5))
+    assert len(visitors.per_day) == MAX_DAYS
+    assert min(visitors.per_day) == first + 5
+    # They still count as visitors of all time.
+    assert abs(visitors.count() - len(days)) <= 3
@@ -0,0 +1,118 @@
+import json
+import os
+import stat
+import threading
+
+import streamlit as st
+
+import streamlit_analytics
+from streamlit_analytics import json_file, main
+from tests import fakes
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_save_keeps_permissions(tmp_path):
+    path = tmp_path / "counts.json"
+    umask = os.umask(0)
+    os.umask(umask)
+    json_file.save({"total_pageviews": 1}, path)
+    assert _mode(path) == 0o666 & ~umask
+
+    path.chmod(0o640)
+    json_file.save({"total_pageviews": 2}, path)
+    assert _mode(path) == 0o640
+    assert json.loads(path.read_text()) == {"total_pageviews": 2}
+
+
+def test_save_only_flattens_counts_to_check_mtime(tmp_path, monkeypatch):
+    flattened = []
+    monkeypatch.setattr(json_file, "flatten_counts", flattened.append)
+    path = tmp_path / "counts.json"
+    json_file.save({"total_pageviews": 1}, path)
+    assert not flattened
+    json_file.save({"total_pageviews": 1}, path, check_mtime=True)
+    assert flattened == [{"total_pageviews": 1}]
+
+
+def test_concurrent_saves(tmp_path):
+    path = tmp_path / "counts.json"
+    num_sessions = 8
+    num_reruns = 25
+    errors = []
+
+    def session():
+        fakes.clear_session()
+        try:
+            for _ in range(num_reruns):
+                with streamlit_analytics.track(save_to_json=path):
+                    st.button("Click me")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=session) for _ in range(num_sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    # Only the file itself is left, no temporary files.
+    assert os.listdir(tmp_path) == ["counts.json"]
+    saved = json.loads(path.read_text())
+    assert saved["total_script_runs"] == num_sessions * num_reruns
+    assert saved["total_pageviews"] == num_sessions
+    assert sum(saved["per_day"]["script_runs"]) == num_sessions * num_reruns
+    assert saved["widgets"] == {"Click me": 0}
+
+
+def _rerun(path, check_mtime=True):
+    with streamlit_analytics.track(
+        load_from_json=path, load_from_json_check_mtime=check_mtime, save_to_json=path
+    ):
+        pass
+
+
+def _add_from_other_process(path, script_runs):
+    saved = json.loads(path.read_text())
+    saved["total_script_runs"] += script_runs
+    path.write_text(json.dumps(saved))
+    # Make sure the mtime changes, even on file systems with coarse timestamps.
+    mtime = os.stat(path).st_mtime_ns + 10**9
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_load_once(tmp_path):
+    path = tmp_path / "counts.json"
+    path.write_text(json.dumps({"total_script_runs": 5, "start_time": "then"}))
+    _rerun(path, check_mtime=False)
+    _add_from_other_process(path, 10)
+    _rerun(path, check_mtime=False)
+    # Not loaded again, so the counts of the other process were overwritten.
+    assert json.loads(path.read_text())["total_script_runs"] == 7
+
+
+def test_changes_by_other_processes_are_merged(tmp_path):
+    path = tmp_path / "counts.json"
+    path.write_text(json.dumps({"total_script_runs": 5, "start_time": "then"}))
+    _rerun(path)
+    _rerun(path)
+    _add_from_other_process(path, 10)
+    _rerun(path)
+    assert json.loads(path.read_text())["total_script_runs"] == 5 + 2 + 10 + 1
+    assert main.counts["total_script_runs"] == 18
+    assert main.counts["start_time"] == "then"
+
+
+def test_reset_is_kept_when_merging(tmp_path):
+    path = tmp_path / "counts.json"
+    path.write_text(json.dumps({"total_script_runs": 5, "start_time": "then"}))
+    _rerun(path)
+    main.reset_counts()
+    _add_from_other_process(path, 10)
+    _rerun(path)
+    saved = json.loads(path.read_text())
+    assert saved["total_script_runs"] == 1
+    assert saved["start_time"] == main.counts["start_time"]
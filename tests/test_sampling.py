@@ -0,0 +1,48 @@
+import pytest
+
+import streamlit_analytics
+from streamlit_analytics import main
+from tests import fakes
+
+
+def _sessions(n, reruns=3, sample_rate=0.5):
+    """Run `n` sessions, returns how many of them were sampled."""
+    sampled = 0
+    for _ in range(n):
+        fakes.clear_session()
+        for _ in range(reruns):
+            with streamlit_analytics.track(sample_rate=sample_rate):
+                pass
+        sampled += fakes.session_state()["sample_point"] < sample_rate
+    return sampled
+
+
+def test_only_sampled_sessions_are_counted():
+    sampled = _sessions(400)
+    assert 150 <= sampled <= 250
+    counts = main.get_counts()
+    assert counts["total_pageviews"] == sampled
+    assert counts["total_script_runs"] == 3 * sampled
+
+
+def test_all_visitors_are_counted():
+    _sessions(400)
+    # Each session is a new visitor here. Sketches can't be scaled up, so visitors
+    # are added in all sessions.
+    visitors = main._store.data["unique_visitors"].count()
+    assert abs(visitors - 400) <= 0.08 * 400
+
+
+def test_decision_sticks_to_the_session():
+    fakes.session_state()["sample_point"] = 0.3
+    for rate, tracked in [(0.5, True), (0.2, False), (1, True)]:
+        with streamlit_analytics.track(sample_rate=rate):
+            pass
+        assert main._session.sampled is tracked
+    assert main.get_counts()["total_script_runs"] == 2
+
+
+def test_invalid_sample_rate():
+    for rate in (0, 1.5):
+        with pytest.raises(ValueError):
+            main.start_tracking(sample_rate=rate)
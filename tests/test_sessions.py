@@ -0,0 +1,53 @@
+import time
+import types
+
+import pytest
+
+import streamlit_analytics
+from streamlit_analytics import main
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace the monotonic clock of `main`, returns the list holding its time."""
+    now = [1000.0]
+    fake_time = types.SimpleNamespace(time=time.time, monotonic=lambda: now[0])
+    monkeypatch.setattr(main, "time", fake_time)
+    return now
+
+
+def _rerun_after(clock, seconds, **kwargs):
+    clock[0] += seconds
+    with streamlit_analytics.track(**kwargs):
+        pass
+
+
+def test_reruns_within_timeout_are_one_session(clock):
+    for _ in range(3):
+        _rerun_after(clock, 60)
+    counts = main.get_counts()
+    assert counts["total_sessions"] == 1
+    assert counts["total_pageviews"] == 1
+    assert counts["total_time_seconds"] == 120
+
+
+def test_session_ends_after_timeout(clock):
+    _rerun_after(clock, 0)
+    _rerun_after(clock, 60)
+    # The tab was left open for an hour.
+    _rerun_after(clock, 3600)
+    _rerun_after(clock, 30)
+    counts = main.get_counts()
+    assert counts["total_sessions"] == 2
+    assert counts["total_time_seconds"] == 90
+    # Still the same page load.
+    assert counts["total_pageviews"] == 1
+
+
+def test_custom_timeout(clock):
+    _rerun_after(clock, 0, session_timeout=10)
+    _rerun_after(clock, 5, session_timeout=10)
+    _rerun_after(clock, 11, session_timeout=10)
+    counts = main.get_counts()
+    assert counts["total_sessions"] == 2
+    assert counts["total_time_seconds"] == 5
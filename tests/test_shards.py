@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import streamlit_analytics
+from streamlit_analytics import main, storage
+
+ROOT = Path(__file__).resolve().parent.parent
+TTL = 0.05
+
+# Runs the app in another process, which saves its shard when it exits.
+OTHER_PROCESS = """
+import sys
+
+from tests import fakes
+
+fakes.install()
+
+import streamlit_analytics
+
+for _ in range(int(sys.argv[2])):
+    with streamlit_analytics.track(shard_dir=sys.argv[1]):
+        pass
+"""
+
+
+def _run_other_process(shard_dir, reruns):
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    subprocess.run(
+        [sys.executable, "-c", OTHER_PROCESS, str(shard_dir), str(reruns)],
+        env=env,
+        check=True,
+    )
+
+
+def _track(shard_dir, reruns):
+    for _ in range(reruns):
+        with streamlit_analytics.track(shard_dir=shard_dir, shard_ttl=TTL):
+            pass
+
+
+def _merged(shard_dir):
+    """Return the counts the dashboard would show."""
+    backend = storage.register(storage.ShardedBackend(shard_dir), main._store)
+    time.sleep(2 * TTL)  # so shards of other processes are read again
+    storage.load(backend, main._store)
+    return backend.view(main.get_counts())
+
+
+def test_two_processes(tmp_path):
+    shard_dir = tmp_path / "shards"
+    _track(shard_dir, 3)
+    _run_other_process(shard_dir, 2)
+
+    assert len(list(shard_dir.glob("shard-*.json"))) == 2
+    merged = _merged(shard_dir)
+    assert merged["total_script_runs"] == 5
+    assert merged["total_pageviews"] == 2
+    assert sum(merged["per_day"]["script_runs"]) == 5
+
+
+def test_reset_resets_all_processes(tmp_path):
+    shard_dir = tmp_path / "shards"
+    _run_other_process(shard_dir, 2)
+    _track(shard_dir, 1)
+    assert _merged(shard_dir)["total_script_runs"] == 3
+
+    main.reset_counts()
+    _track(shard_dir, 1)
+    assert _merged(shard_dir)["total_script_runs"] == 1
+
+    # A process that starts after the reset only counts from then on.
+    _run_other_process(shard_dir, 2)
+    merged = _merged(shard_dir)
+    assert merged["total_script_runs"] == 3
+    assert merged["start_time"] == main.counts["start_time"]
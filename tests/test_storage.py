@@ -0,0 +1,141 @@
+import datetime
+import time
+
+import pytest
+
+from streamlit_analytics import flusher, main, storage
+from streamlit_analytics.utils import empty_counts, flatten_counts
+
+
+def _backends(tmp_path):
+    return {
+        "sqlite": lambda: storage.SqliteBackend(tmp_path / "counts.db"),
+        "event_log": lambda: storage.EventLogBackend(tmp_path / "events.jsonl"),
+    }
+
+
+def _nonzero(counts):
+    return {path: n for path, n in flatten_counts(counts).items() if n}
+
+
+@pytest.mark.parametrize("kind", ["sqlite", "event_log"])
+def test_round_trip_with_roll_ups(tmp_path, kind):
+    new_backend = _backends(tmp_path)[kind]
+    store = main._store
+    backend = storage.register(new_backend(), store)
+    storage.load(backend, store)
+    store.retention_days = 3
+    store.retention_hours = 2
+
+    today = datetime.date.today().toordinal()
+    for i in range(10):
+        store.incr(("per_day", today + i, "pageviews"), 2)
+        store.incr(("per_day", today + i, "script_runs"))
+        store.incr(("per_hour", today * 24 + i, "widgets", "Click me"))
+        store.incr(("widgets", "Click me"))
+        storage.save(backend, store)
+    storage.close_all()
+
+    counts = main.get_counts()
+    assert len(counts["per_day"]["days"]) == 3
+    assert sum(counts["rolled_up"]["pageviews"]) == 14
+    assert len(counts["per_hour"]) == 2
+    day = str(datetime.date.fromordinal(today))
+    assert counts["per_hour_rolled_up"] == {day: {"widgets": {"Click me": 8}}}
+
+    # Load into new counts, like after a restart.
+    loaded = empty_counts(counts["start_time"])
+    new_backend().load(loaded)
+    assert _nonzero(loaded) == _nonzero(counts)
+    assert len(loaded["per_day"]["days"]) == 3
+
+
+def test_sqlite_drops_rolled_up_rows(tmp_path):
+    store = main._store
+    backend = storage.register(storage.SqliteBackend(tmp_path / "counts.db"), store)
+    storage.load(backend, store)
+    store.retention_days = 3
+    today = datetime.date.today().toordinal()
+    for i in range(10):
+        store.incr(("per_day", today + i, "pageviews"))
+        storage.save(backend, store)
+
+    rows = backend._connect().execute("SELECT path FROM counts").fetchall()
+    assert len([row for row in rows if "per_day" in row[0]]) == 3
+
+
+def test_reset_clears_sqlite(tmp_path):
+    store = main._store
+    backend = storage.register(storage.SqliteBackend(tmp_path / "counts.db"), store)
+    storage.load(backend, store)
+    store.incr(("total_pageviews",), 5)
+    storage.save(backend, store)
+    main.reset_counts()
+    store.incr(("total_pageviews",))
+    storage.save(backend, store)
+    storage.close_all()
+
+    loaded = empty_counts()
+    storage.SqliteBackend(tmp_path / "counts.db").load(loaded)
+    assert loaded["total_pageviews"] == 1
+    assert loaded["start_time"] == main.counts["start_time"]
+
+
+class _CustomBackend(storage.StorageBackend):
+    records_changes = True
+
+    def __init__(self, path):
+        self.path = path
+
+
+def test_backend_created_every_rerun_is_used_once(tmp_path):
+    for _ in range(50):
+        storage.register(_CustomBackend(tmp_path), main._store)
+    assert len(main._store.listeners) == 1
+    storage.register(_CustomBackend(tmp_path / "other"), main._store)
+    assert len(main._store.listeners) == 2
+
+
+def test_flush_after_close_all(tmp_path):
+    store = main._store
+    backend = storage.register(
+        storage.JsonBackend(tmp_path / "counts.json", flush_interval=60), store
+    )
+    store.incr(("total_pageviews",))
+    storage.save(backend, store)
+    storage.close_all()
+    # The flusher saved what was left before the backend was closed.
+    assert (tmp_path / "counts.json").exists()
+    storage.save(backend, store)
+    storage._flush(backend, store)
+
+
+def test_close_all_detaches_listeners(tmp_path):
+    store = main._store
+    listeners = list(store.listeners)
+    storage.register(storage.SqliteBackend(tmp_path / "counts.db"), store)
+    storage.register(storage.EventLogBackend(tmp_path / "events.jsonl"), store)
+    assert len(store.listeners) == len(listeners) + 2
+    storage.close_all()
+    assert store.listeners == listeners
+
+
+def test_register_applies_new_flush_interval(tmp_path):
+    store = main._store
+    path = tmp_path / "counts.json"
+    backend = storage.register(storage.JsonBackend(path, flush_interval=60), store)
+    store.incr(("total_pageviews",))
+    assert not storage.save(backend, store)
+
+    backend = storage.register(storage.JsonBackend(path), store, flush_interval=0.01)
+    store.incr(("total_pageviews",))
+    storage.save(backend, store)
+    deadline = time.monotonic() + 5
+    while not path.exists():
+        assert time.monotonic() < deadline, "not flushed with the new interval"
+        time.sleep(0.01)
+
+    # Without interval, it's saved right away and the thread is stopped.
+    backend = storage.register(storage.JsonBackend(path), store, flush_interval=None)
+    assert storage.save(backend, store)
+    assert ("backend",) + backend.key not in flusher._flushers
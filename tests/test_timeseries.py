@@ -0,0 +1,90 @@
+import random
+
+from streamlit_analytics import main
+from streamlit_analytics.timeseries import TimeBuckets, hour_label, range_counts
+
+START = 738000 * 24  # an hour ordinal
+
+
+def _brute_sum(increments, start, end):
+    total = {}
+    for t, counter, n in increments:
+        if start <= t < end:
+            total[counter] = total.get(counter, 0) + n
+    return {counter: n for counter, n in total.items() if n}
+
+
+def _random_increments(rng, n=300):
+    counters = [("pageviews",), ("widgets", "Click me"), ("widgets", "Pick", "a")]
+    return [
+        (START + rng.randrange(-5, 40), rng.choice(counters), rng.randint(1, 3))
+        for _ in range(n)
+    ]
+
+
+def test_range_sums():
+    rng = random.Random(0)
+    increments = _random_increments(rng)
+    buckets = TimeBuckets()
+    for t, counter, n in increments:
+        buckets.incr(t, counter, n)
+
+    for start in range(START - 7, START + 42, 3):
+        for end in range(start, START + 42, 2):
+            assert buckets.sum(start, end) == _brute_sum(increments, start, end)
+
+
+def test_trim():
+    rng = random.Random(1)
+    increments = _random_increments(rng)
+    buckets = TimeBuckets()
+    for t, counter, n in increments:
+        buckets.incr(t, counter, n)
+
+    dropped = buckets.trim(10)
+    assert len(buckets) == 10
+    assert buckets.first == START + 30
+    for t, bucket in dropped.items():
+        assert t < START + 30
+        assert bucket == _brute_sum(increments, t, t + 1)
+    # The sums are still right after the tree was rebuilt.
+    assert buckets.sum(START, START + 50) == _brute_sum(
+        increments, START + 30, START + 50
+    )
+    buckets.incr(START + 35, ("pageviews",), 5)
+    assert buckets.sum(START + 35, START + 36) == _brute_sum(
+        increments + [(START + 35, ("pageviews",), 5)], START + 35, START + 36
+    )
+
+
+def test_round_trip():
+    buckets = TimeBuckets()
+    buckets.incr(START, ("widgets", "Pick", "a"), 2)
+    buckets.incr(START + 3, ("pageviews",))
+    d = buckets.to_dict()
+    assert d == {
+        hour_label(START): {"widgets": {"Pick": {"a": 2}}},
+        hour_label(START + 3): {"pageviews": 1},
+    }
+    loaded = TimeBuckets.from_dict(d)
+    assert loaded.to_dict() == d
+    assert loaded.sum(START, START + 4) == buckets.sum(START, START + 4)
+
+
+def test_hours_are_rolled_up_per_day():
+    store = main._store
+    store.retention_hours = 24
+    day = START // 24
+    # Two days and a bit, so the first day is rolled up.
+    for t in range(START, START + 50):
+        store.incr(("per_hour", t, "pageviews"))
+    hours, days = store.hourly()
+    assert len(hours) == 24
+    assert hours.first == START + 26
+    assert days.sum(day, day + 2) == {("pageviews",): 26}
+
+    # Rolled-up days count completely if any of their hours is in range. The first
+    # two hours of the second day were rolled up too, so they count along.
+    assert range_counts(hours, days, START + 1, START + 2) == {("pageviews",): 24}
+    total = range_counts(hours, days, START + 40, START + 42)
+    assert total == {("pageviews",): 4}
@@ -0,0 +1,44 @@
+from streamlit_analytics import main
+from streamlit_analytics.store import OTHER
+from streamlit_analytics.widget_counts import WidgetCounts
+
+
+def test_reads_like_a_dict():
+    widgets = WidgetCounts()
+    widgets.incr("Click me")
+    widgets.incr("Pick", "a", 2)
+    widgets.add("Pick", "b")
+    widgets.option_ids("Empty")
+    d = {"Click me": 1, "Pick": {"a": 2, "b": 0}, "Empty": {}}
+    assert widgets.to_dict() == d
+    assert dict(widgets) == d
+    assert WidgetCounts.from_dict(d).to_dict() == d
+
+
+def test_removed_ids_are_reused():
+    widgets = WidgetCounts()
+    a = widgets.incr("Name", "a", 5)
+    widgets.incr("Name", "b")
+    widgets.remove("Name", "a")
+    assert widgets.id("Name", "a") is None
+
+    # The new pair gets the id of "a", but not its count.
+    c = widgets.incr("Other", "c")
+    assert c == a
+    assert widgets.to_dict() == {"Name": {"b": 1}, "Other": {"c": 1}}
+    assert len(widgets.counts) == 2
+
+
+def test_evicted_values_keep_index_right():
+    store = main._store
+    for i in range(200):
+        store.incr_top("Name", f"value {i % 50}", 3)
+    widgets = main.get_counts()["widgets"]["Name"]
+    assert len(widgets) == 4
+    assert sum(widgets.values()) == 200
+
+    # Ids were reused for all evicted values, and the index agrees with the counts.
+    assert len(store.data["widgets"].counts) == 4
+    rows = store.indexed_widgets().top(10)
+    assert {option: count for _, option, count in rows} == widgets
+    assert OTHER in widgets
@@ -0,0 +1,48 @@
+import streamlit as st
+
+import streamlit_analytics
+from streamlit_analytics import main
+from streamlit_analytics.store import OTHER
+from tests import fakes
+
+
+def _enter(label, values, widget="number_input", **kwargs):
+    """Enter `values` into a widget, one per script run."""
+    for value in values:
+        fakes.set_value(label, value)
+        with streamlit_analytics.track(**kwargs):
+            getattr(st, widget)(label)
+    return main.get_counts()["widgets"][label]
+
+
+def test_numeric_bins():
+    counts = _enter("Amount", [12, 15, 27, 0.35], numeric_bin_width=10)
+    # 15 is in the same bin as 12, so it's not a change.
+    assert counts == {"[10, 20)": 1, "[20, 30)": 1, "[0, 10)": 1}
+
+
+def test_numeric_bins_are_exact():
+    counts = _enter("Amount", [1234567, 1234568, 1234569], numeric_bin_width=1)
+    assert counts == {
+        "[1234567, 1234568)": 1,
+        "[1234568, 1234569)": 1,
+        "[1234569, 1234570)": 1,
+    }
+    counts = _enter("Share", [0.3, 0.45], numeric_bin_width=0.1)
+    assert counts == {"[0.3, 0.4)": 1, "[0.4, 0.5)": 1}
+
+
+def test_max_values_counts_rare_values_as_other():
+    values = ["a", "b", "a", "c", "a", "d"]
+    counts = _enter("Name", values, widget="text_input", max_values_per_widget=2)
+    # "b" and then "c" were evicted, "a" is kept as the most frequent value.
+    assert counts == {"a": 3, "d": 1, OTHER: 2}
+    assert sum(counts.values()) == len(values)
+
+
+def test_frequent_late_value_is_kept():
+    store = main._store
+    for value in ["a"] * 3 + ["b"] + ["c"] * 6 + ["d"]:
+        store.incr_top("Name", value, 2)
+    # "b" and then "a" were evicted. "c" came late, but is the most frequent one.
+    assert main.get_counts()["widgets"]["Name"] == {"c": 6, "d": 1, OTHER: 4}